@@ -0,0 +1,290 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import bisect
+import ipaddress
+import threading
+import time
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .generic_json_rpc import fmg_session, call_with_relogin, get_session_key
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+ADDRESS_URL = "/pm/config/adom/{adom}/obj/firewall/address"
+ADDRGRP_URL = "/pm/config/adom/{adom}/obj/firewall/addrgrp"
+ADDRESS_FIELDS = ["name", "type", "subnet", "start-ip", "end-ip", "wildcard"]
+ADDRGRP_FIELDS = ["name", "member"]
+# Address types returned by FortiManager when verbose output is off
+ADDRESS_TYPES = {0: "ipmask", 1: "iprange", 2: "fqdn", 3: "wildcard"}
+# Seconds an index is used before the table checksums are compared to decide whether to rebuild it
+DEFAULT_INDEX_MAX_STALENESS = 300
+
+
+def parse_ip_pair(value) -> Union[tuple, None]:
+    """
+    Address and mask of a subnet or wildcard attribute, given as [ip, mask], "ip mask" or "ip/prefix".
+    """
+    if isinstance(value, str):
+        value = value.replace("/", " ").split()
+    if not isinstance(value, list) or len(value) != 2:
+        return None
+    try:
+        address = int(ipaddress.IPv4Address(value[0]))
+        mask = value[1]
+        mask = int(ipaddress.IPv4Network(f"0.0.0.0/{mask}").netmask) if str(mask).isdigit() else \
+            int(ipaddress.IPv4Address(mask))
+    except ValueError:
+        return None
+    return address, mask
+
+
+def address_interval(obj: dict) -> Union[tuple, None]:
+    """
+    First and last IPv4 address, as integers, covered by an ipmask or iprange address object.
+    """
+    address_type = obj.get("type", "ipmask")
+    address_type = ADDRESS_TYPES.get(address_type, address_type)
+    if address_type == "ipmask":
+        pair = parse_ip_pair(obj.get("subnet"))
+        if pair is None:
+            return None
+        address, mask = pair
+        start = address & mask
+        return start, start | (~mask & 0xFFFFFFFF)
+    if address_type == "iprange":
+        try:
+            return int(ipaddress.IPv4Address(obj.get("start-ip"))), int(ipaddress.IPv4Address(obj.get("end-ip")))
+        except ValueError:
+            return None
+    return None
+
+
+def parse_query(query: str) -> tuple:
+    """
+    :return: Tuple of the first and last address of an IP, CIDR or start-end range query
+    """
+    try:
+        if "-" in query:
+            start, end = query.split("-", 1)
+            return int(ipaddress.IPv4Address(start.strip())), int(ipaddress.IPv4Address(end.strip()))
+        network = ipaddress.IPv4Network(query.strip(), strict=False)
+        return int(network.network_address), int(network.broadcast_address)
+    except ValueError as e:
+        raise ConnectorError(f"Invalid IPv4 address, subnet or range: {query}. {e}")
+
+
+class AddressIndex:
+    """
+    Interval index of the IPv4 address objects and groups of an ADOM.
+
+    The address space is cut at every object boundary into segments, and each segment stores the objects covering it,
+    so a lookup is one binary search. Wildcard addresses are not intervals and are checked one by one. Groups are
+    resolved upwards from the matched addresses, memoizing the groups that contain each member, nested ones included.
+    """
+
+    def __init__(self, addresses: list, groups: list):
+        self.addresses = {}
+        self.intervals = []
+        self.wildcards = []
+        for obj in addresses:
+            if not isinstance(obj, dict) or obj.get("name") is None:
+                continue
+            name = str(obj["name"])
+            address_type = ADDRESS_TYPES.get(obj.get("type"), obj.get("type", "ipmask"))
+            self.addresses[name] = address_type
+            if address_type == "wildcard":
+                pair = parse_ip_pair(obj.get("wildcard"))
+                if pair is not None:
+                    self.wildcards.append((pair[0] & pair[1], pair[1], name))
+                continue
+            interval = address_interval(obj)
+            if interval is not None and interval[0] <= interval[1]:
+                self.intervals.append((interval[0], interval[1], name))
+
+        # Sweep the boundaries once, recording the objects active in each segment
+        events = {}
+        for start, end, name in self.intervals:
+            events.setdefault(start, ([], []))[0].append(name)
+            events.setdefault(end + 1, ([], []))[1].append(name)
+        self.boundaries = sorted(events)
+        self.segments = []
+        active = {}
+        for boundary in self.boundaries:
+            added, removed = events[boundary]
+            for name in removed:
+                active[name] -= 1
+                if not active[name]:
+                    del active[name]
+            for name in added:
+                active[name] = active.get(name, 0) + 1
+            self.segments.append(tuple(active))
+        self.ranges = {name: (start, end) for start, end, name in self.intervals}
+
+        self.parents = {}
+        self.groups = set()
+        for group in groups:
+            if not isinstance(group, dict) or group.get("name") is None:
+                continue
+            self.groups.add(str(group["name"]))
+            members = group.get("member") or []
+            for member in members if isinstance(members, list) else [members]:
+                self.parents.setdefault(str(member), set()).add(str(group["name"]))
+        self._containing = {}
+
+    def covering_addresses(self, start: int, end: int) -> list:
+        """
+        Names of the address objects covering every address in [start, end].
+        """
+        names = []
+        position = bisect.bisect_right(self.boundaries, start) - 1
+        if position >= 0:
+            names.extend(name for name in self.segments[position] if self.ranges[name][1] >= end)
+        # A contiguous range goes through every value of the bits below its highest differing bit
+        varying = (1 << (start ^ end).bit_length()) - 1
+        for address, mask, name in self.wildcards:
+            if varying & mask == 0 and start & mask == address:
+                names.append(name)
+        return names
+
+    def containing_groups(self, name: str) -> frozenset:
+        """
+        Groups containing name directly or through nested groups, memoized. The walk is iterative so deeply nested or
+        cyclic groups neither exhaust the stack nor loop.
+        """
+        cached = self._containing.get(name)
+        if cached is not None:
+            return cached
+        groups = set()
+        pending = list(self.parents.get(name, ()))
+        while pending:
+            group = pending.pop()
+            if group in groups:
+                continue
+            groups.add(group)
+            known = self._containing.get(group)
+            if known is not None:
+                groups.update(known)
+            else:
+                pending.extend(self.parents.get(group, ()))
+        self._containing[name] = frozenset(groups)
+        return self._containing[name]
+
+    def lookup(self, query: str) -> dict:
+        start, end = parse_query(query)
+        addresses = sorted(self.covering_addresses(start, end))
+        groups = set()
+        for name in addresses:
+            groups.update(self.containing_groups(name))
+        return {"addresses": addresses, "groups": sorted(groups)}
+
+
+class AddressIndexCache:
+    """
+    One AddressIndex per server, account and ADOM. An index older than the staleness bound is only rebuilt when the
+    checksum of the address or group table changed.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, config: dict, adom: str, max_staleness: float, force: bool = False) -> tuple:
+        """
+        :return: Tuple of (AddressIndex, whether it was rebuilt, age in seconds)
+        """
+        # Per account, as the tables are read with the account's ADOM rights
+        key = (get_session_key(config), adom)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is not None and not force and now - entry["checked_at"] < max_staleness:
+                return entry["index"], False, round(now - entry["built_at"], 3)
+            urls = [ADDRESS_URL.format(adom=adom), ADDRGRP_URL.format(adom=adom)]
+            with fmg_session(config) as fmg:
+                checksums = read_checksums(fmg, urls)
+                if entry is not None and not force and None not in checksums and checksums == entry["checksums"]:
+                    entry["checked_at"] = time.monotonic()
+                    return entry["index"], False, round(entry["checked_at"] - entry["built_at"], 3)
+                addresses, groups = read_tables(fmg, urls)
+            start = time.monotonic()
+            index = AddressIndex(addresses, groups)
+            logger.info(f"Built the address index of ADOM {adom} with {len(index.addresses)} addresses and "
+                        f"{len(index.groups)} groups in {time.monotonic() - start:.3f}s")
+            now = time.monotonic()
+            self._entries[key] = {"index": index, "checksums": checksums, "built_at": now, "checked_at": now}
+            return index, True, 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+address_index_cache = AddressIndexCache()
+
+
+def read_checksums(fmg, urls: list) -> list:
+    status, results = call_with_relogin(fmg, fmg.free_form, "get", data=[{"url": url, "option": "chksum"}
+                                                                         for url in urls])
+    checksums = []
+    for position in range(len(urls)):
+        entry = results[position] if isinstance(results, list) and position < len(results) else None
+        data = entry.get("data") if isinstance(entry, dict) else None
+        checksums.append(data.get("chksum") if isinstance(data, dict) else None)
+    return checksums
+
+
+def read_tables(fmg, urls: list) -> tuple:
+    """
+    Read the address and group tables with a single multi-param get.
+    """
+    status, results = call_with_relogin(fmg, fmg.free_form, "get", data=[
+        {"url": urls[0], "fields": ADDRESS_FIELDS}, {"url": urls[1], "fields": ADDRGRP_FIELDS}])
+    tables = []
+    for position, url in enumerate(urls):
+        entry = results[position] if isinstance(results, list) and position < len(results) else None
+        code = entry.get("status", {}).get("code", -1) if isinstance(entry, dict) else -1
+        if code != 0:
+            raise ConnectorError(f"Failed to read {url}. Status: {code}")
+        data = entry.get("data") or []
+        tables.append(data if isinstance(data, list) else [])
+    return tables[0], tables[1]
+
+
+def parse_queries(queries: Union[list, str, None]) -> list:
+    if isinstance(queries, str):
+        queries = [query.strip() for query in queries.replace("\n", ",").split(",")]
+    if not isinstance(queries, list):
+        raise ConnectorError("Queries must be a list or a comma separated string of IPs, subnets or ranges")
+    queries = [str(query).strip() for query in queries if str(query).strip()]
+    if not queries:
+        raise ConnectorError("At least one IP, subnet or range is required")
+    return queries
+
+
+def perform_address_lookup(config: dict, params: dict) -> dict:
+    adom = params.get("adom") or "root"
+    queries = parse_queries(params.get("queries"))
+    max_staleness = params.get("max_staleness")
+    try:
+        max_staleness = DEFAULT_INDEX_MAX_STALENESS if max_staleness in (None, "") else float(max_staleness)
+    except (TypeError, ValueError):
+        max_staleness = DEFAULT_INDEX_MAX_STALENESS
+    index, rebuilt, age = address_index_cache.get(config, adom, max_staleness, params.get("force_refresh", False))
+    start = time.monotonic()
+    results = {query: index.lookup(query) for query in queries}
+    return {
+        "results": results,
+        "index": {"adom": adom, "addresses": len(index.addresses), "groups": len(index.groups), "rebuilt": rebuilt,
+                  "age": age, "lookup_time": round(time.monotonic() - start, 6)},
+        "status": 0
+    }
@@ -0,0 +1,205 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from typing import Union
+
+from connectors.core.connector import get_logger
+
+from .log_utils import summarize
+from .session_pool import session_pool, INVALID_SESSION_CODE
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Overall number of seconds to wait for an ADOM lock before giving up
+DEFAULT_LOCK_TIMEOUT = 1800
+# First and maximum sleep in seconds between two lock attempts against the server
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 10.0
+
+
+class BackoffStrategy:
+    """
+    Capped exponential backoff with decorrelated jitter, bounded by an overall deadline in seconds.
+    """
+
+    def __init__(self, timeout: float = DEFAULT_LOCK_TIMEOUT, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP):
+        self.timeout = timeout
+        self.base = base
+        self.cap = cap
+
+    def delays(self):
+        sleep = self.base
+        while True:
+            sleep = min(self.cap, random.uniform(self.base, sleep * 3))
+            yield sleep
+
+
+class LockWaitQueue:
+    """
+    In-process FIFO of workers waiting for the same ADOM. Only the worker at the head of the queue polls the
+    server, the others wait to be woken up when the worker ahead of them releases the ADOM.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queues = {}
+
+    def enter(self, key: tuple, deadline: float) -> Union[object, None]:
+        """
+        Wait until the caller is at the head of the queue for key.
+
+        :return: Ticket to pass to leave, or None if the deadline passed first
+        """
+        ticket = object()
+        with self._cond:
+            queue = self._queues.setdefault(key, deque())
+            queue.append(ticket)
+            while queue[0] is not ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._remove(key, ticket)
+                    return None
+                self._cond.wait(remaining)
+        return ticket
+
+    def leave(self, key: tuple, ticket: object):
+        with self._cond:
+            self._remove(key, ticket)
+
+    def waiting(self, key: tuple) -> int:
+        with self._cond:
+            return len(self._queues.get(key, ()))
+
+    def _remove(self, key, ticket):
+        queue = self._queues.get(key)
+        if queue is not None:
+            if ticket in queue:
+                queue.remove(ticket)
+            if not queue:
+                del self._queues[key]
+        self._cond.notify_all()
+
+
+lock_wait_queue = LockWaitQueue()
+
+
+class LockResult:
+    """
+    Outcome of an ADOM lock acquisition. Truthy when the ADOM may be written to.
+    """
+
+    def __init__(self, adom: str, key: tuple, ticket: Union[object, None]):
+        self.adom = adom
+        self.key = key
+        self.ticket = ticket
+        self.acquired = False
+        self.locked = False
+        self.attempts = 0
+        self.wait_time = 0.0
+
+    def __bool__(self):
+        return self.acquired
+
+
+def lock_adom(fmg, adom: str, url: str, data: Union[list, dict],
+              strategy: Union[BackoffStrategy, None] = None) -> LockResult:
+    """
+    Acquire the workspace lock for adom, queueing behind other workers of this process that wait for the same ADOM.
+
+    The returned LockResult must be passed to unlock_adom once the caller is done with the ADOM, whether or not the
+    lock was acquired. data is only used in log messages, pass a PayloadSummary to apply the logging settings of a
+    config.
+    """
+    strategy = strategy or BackoffStrategy()
+    # Rendered only if a record is emitted, and bounded unless payload tracing is enabled
+    payload = summarize(data)
+    start = time.monotonic()
+    deadline = start + strategy.timeout
+    key = (fmg._host, adom)
+    result = LockResult(adom, key, lock_wait_queue.enter(key, deadline))
+    if result.ticket is None:
+        result.wait_time = time.monotonic() - start
+        logger.error(f"Lock timeout of {strategy.timeout} seconds reached while queued for ADOM: {adom} using URL: "
+                     f"{url}.")
+        return result
+
+    delays = strategy.delays()
+    try:
+        while True:
+            result.attempts += 1
+            status, _ = fmg.lock_adom(adom)
+            if status == INVALID_SESSION_CODE and not fmg.api_key_used:
+                session_pool.relogin(fmg)
+                status, _ = fmg.lock_adom(adom)
+            # If the lock was acquired, stop retrying
+            if status == 0:
+                result.acquired = result.locked = True
+                logger.debug("Acquired lock for ADOM: %s using URL: %s with PAYLOAD: %s.", adom, url, payload)
+                break
+            # status == -9 means that the command for the url is invalid. This happens when an adom is attempted to
+            # be locked when workspaces isn't enabled. This is a workaround for a pyFMG bug where uses_workspace is
+            # True when it should be False. That happens because pyFMG checks a 0 or 1 int, but verbose mode returns
+            # a string.
+            if status == -9:
+                logger.debug(f"Workspaces not enabled. Locking ADOM: {adom} not required.")
+                result.acquired = True
+                break
+            # status == -6 when URL is invalid. This could occur when a nonexistent adom is attempted to be locked.
+            if status == -6:
+                logger.error(f"URL is invalid. ADOM: {adom} does not exist.")
+                break
+            sleep_time = min(next(delays), deadline - time.monotonic())
+            if sleep_time <= 0:
+                logger.error("Lock timeout of %s seconds reached. Could not acquire lock for ADOM: %s using URL: %s "
+                             "with PAYLOAD: %s.", strategy.timeout, adom, url, payload)
+                break
+            logger.debug("Failed to acquire lock for ADOM: %s using URL: %s with PAYLOAD: %s. Sleeping %.2f seconds "
+                         "and retrying...", adom, url, payload, sleep_time)
+            time.sleep(sleep_time)
+    except BaseException:
+        # The caller gets no LockResult to unlock, give the ADOM to the next queued worker here
+        lock_wait_queue.leave(key, result.ticket)
+        raise
+
+    result.wait_time = time.monotonic() - start
+    logger.info(f"Waited {result.wait_time:.3f} seconds over {result.attempts} attempts for lock on ADOM: {adom}.")
+    if not result.acquired:
+        lock_wait_queue.leave(key, result.ticket)
+        result.ticket = None
+    return result
+
+
+def unlock_adom(fmg, lock: LockResult):
+    """
+    Release the server side lock taken by lock_adom, and hand the ADOM to the next worker queued in this process.
+    """
+    try:
+        if lock.locked and fmg.sid is not None:
+            status, _ = fmg.unlock_adom(lock.adom)
+            if status != 0:
+                logger.debug(f"Failed to unlock ADOM: {lock.adom}. Status: {status}")
+            lock.locked = False
+    finally:
+        if lock.ticket is not None:
+            lock_wait_queue.leave(lock.key, lock.ticket)
+            lock.ticket = None
+
+
+def parse_lock_timeout(config: dict) -> int:
+    """
+    Parse the ADOM lock timeout in seconds from the config.
+    """
+    lock_timeout = config.get("lock_timeout")
+    try:
+        lock_timeout = int(lock_timeout)
+    except (TypeError, ValueError):
+        return DEFAULT_LOCK_TIMEOUT
+    return lock_timeout if lock_timeout > 0 else DEFAULT_LOCK_TIMEOUT
@@ -0,0 +1,456 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import asyncio
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import Union
+
+import aiohttp
+from connectors.core.connector import get_logger, ConnectorError
+from pyFMG.fortimgr import FortiManager
+
+from .adom_lock import BackoffStrategy, parse_lock_timeout
+from .codec import dumps, loads
+from .generic_json_rpc import (get_config, get_session_key, parse_idle_ttl, parse_data, parse_adoms_from_input,
+                               parse_track_task_params, invalidate_cached_responses, record_writes, uses_ssl,
+                               SPECIAL_CASES)
+from .log_utils import summarize
+from .response_cache import get_response_cache
+from .session_pool import PROBE_AFTER, MAX_IDLE_PER_KEY, session_expired
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Seconds between two task progress reads while tracking a task
+TASK_POLL_INTERVAL = 3
+
+
+class AsyncFortiManager:
+    """
+    Minimal asyncio FortiManager JSON-RPC client.
+
+    Requests and responses are shaped exactly like pyFMG's so results are interchangeable with the sync path.
+    """
+
+    def __init__(self, host: str, user: Union[str, None] = None, passwd: Union[str, None] = None,
+                 apikey: Union[str, None] = None, verify_ssl: bool = True, verbose: bool = True, timeout: int = 300,
+                 use_ssl: bool = True):
+        self._host = host
+        self._user = user
+        self._passwd = passwd
+        self._apikey = apikey
+        self._verify_ssl = verify_ssl
+        self._verbose = verbose
+        self._timeout = timeout
+        self._url = "{proto}://{host}/jsonrpc".format(proto="https" if use_ssl else "http", host=host)
+        self._session = None
+        self._req_id = 0
+        self.sid = None
+        self.uses_workspace = False
+        self.locked_adoms = set()
+
+    @property
+    def api_key_used(self) -> bool:
+        return self._passwd is None and self._apikey is not None
+
+    async def login(self):
+        headers = {"content-type": "application/json"}
+        if self.api_key_used:
+            headers["Authorization"] = "Bearer {apikey}".format(apikey=self._apikey)
+        self._session = aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=self._timeout))
+        if self.api_key_used:
+            self.sid = "apikey"
+        else:
+            self.sid = None
+            params = FortiManager.common_datagram_params("execute", "sys/login/user", user=self._user,
+                                                         passwd=self._passwd)
+            response = await self._send("exec", params)
+            self.sid = response.get("session")
+            if self.sid is None:
+                await self.close()
+                raise ConnectorError("Failed to login to FortiManager")
+        await self.check_mode()
+
+    async def check_mode(self):
+        status, resp_obj = await self.get("/cli/global/system/global", fields=["workspace-mode"])
+        workspace_mode = resp_obj.get("workspace-mode") if isinstance(resp_obj, dict) else None
+        self.uses_workspace = status == 0 and workspace_mode not in (None, 0, "0", "disabled")
+
+    async def logout(self):
+        if self.sid is not None:
+            try:
+                for adom in list(self.locked_adoms):
+                    await self.unlock_adom(adom)
+                if not self.api_key_used:
+                    await self._post_request("exec", FortiManager.common_datagram_params("execute", "sys/logout"))
+            finally:
+                self.sid = None
+                await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.logout()
+
+    async def _send(self, method: str, params: list, verbose: bool = False) -> dict:
+        self._req_id += 1
+        json_request = {"method": method, "params": params, "session": self.sid, "id": self._req_id}
+        if verbose:
+            json_request["verbose"] = 1
+        try:
+            async with self._session.post(self._url, data=dumps(json_request),
+                                          ssl=None if self._verify_ssl else False) as resp:
+                body = await resp.read()
+        except aiohttp.ClientError as e:
+            raise ConnectorError("Connection error: {err_type} {err}".format(err_type=type(e), err=e))
+        try:
+            return loads(body)
+        except ValueError:
+            raise ConnectorError("Could not decode FortiManager response: {}".format(body[:200]))
+
+    async def _post_request(self, method: str, params: list, free_form: bool = False) -> tuple:
+        if self.sid is None:
+            raise ConnectorError("No valid FortiManager session for {} {}".format(method, params[0].get("url")))
+        response = await self._send(method, params, verbose=method == "get" and self._verbose)
+        if free_form:
+            return 200, response["result"]
+        result = response["result"][0] if isinstance(response["result"], list) else response["result"]
+        if "data" in result:
+            return result["status"]["code"], result["data"]
+        return result["status"]["code"], result
+
+    async def get(self, url, *args, **kwargs):
+        return await self._post_request("get", FortiManager.common_datagram_params("get", url, *args, **kwargs))
+
+    async def add(self, url, *args, **kwargs):
+        return await self._post_request("add", FortiManager.common_datagram_params("add", url, *args, **kwargs))
+
+    async def set(self, url, *args, **kwargs):
+        return await self._post_request("set", FortiManager.common_datagram_params("set", url, *args, **kwargs))
+
+    async def delete(self, url, *args, **kwargs):
+        return await self._post_request("delete",
+                                        FortiManager.common_datagram_params("delete", url, *args, **kwargs))
+
+    async def execute(self, url, *args, **kwargs):
+        return await self._post_request("exec", FortiManager.common_datagram_params("execute", url, *args, **kwargs))
+
+    async def free_form(self, method, **kwargs):
+        if not kwargs.get("data"):
+            raise ConnectorError("Free Form Request was not formed correctly. A data key is required")
+        return await self._post_request(method, kwargs["data"], free_form=True)
+
+    @staticmethod
+    def _workspace_url(adom: str, operation: str) -> str:
+        if adom.lower() == "global":
+            return "/dvmdb/global/workspace/{operation}/".format(operation=operation)
+        return "/dvmdb/adom/{adom}/workspace/{operation}/".format(adom=adom, operation=operation)
+
+    async def lock_adom(self, adom: str):
+        code, resp_obj = await self.execute(self._workspace_url(adom, "lock"), {})
+        if code == 0:
+            self.locked_adoms.add(adom)
+        return code, resp_obj
+
+    async def unlock_adom(self, adom: str):
+        code, resp_obj = await self.execute(self._workspace_url(adom, "unlock"), {})
+        if code == 0:
+            self.locked_adoms.discard(adom)
+        return code, resp_obj
+
+    async def commit_changes(self, adom: str):
+        return await self.execute(self._workspace_url(adom, "commit"), {})
+
+    async def track_task(self, task_id, timeout: int = 21600, zero_percent_timeout: int = 30,
+                         task_stale_timeout: int = 120, sleep_time: float = TASK_POLL_INTERVAL, **kwargs):
+        """
+        Poll /task/task/<id> without blocking the event loop until the task completes or a timeout is reached.
+        """
+        start = last_progress = time.monotonic()
+        last_percent = 0
+        while True:
+            code, task_info = await self.get("/task/task/{taskid}".format(taskid=task_id))
+            now = time.monotonic()
+            if code == 0 and isinstance(task_info, dict):
+                percent = int(task_info.get("percent", 0))
+                if percent >= 100:
+                    task_info["total_task_time"] = str(round(now - start, 3))
+                    return code, task_info
+                if percent != last_percent:
+                    last_percent, last_progress = percent, now
+                if percent == 0 and now - start >= zero_percent_timeout:
+                    return 1, {"msg": "Task did not progress past 0% in {} seconds".format(zero_percent_timeout)}
+                if percent and now - last_progress >= task_stale_timeout:
+                    return 1, {"msg": "Task did not progress for {} seconds".format(task_stale_timeout)}
+            if now - start >= timeout:
+                return 1, {"msg": "Task did not complete in efficient time. The timeout value was {}".format(timeout)}
+            await asyncio.sleep(sleep_time)
+
+
+class LoopState:
+    """
+    Idle sessions and ADOM locks of one event loop, and the async generator that releases them when the loop shuts
+    down.
+    """
+
+    def __init__(self):
+        self.idle = {}
+        self.adom_locks = {}
+        self.closer = None
+
+
+class AsyncSessionPool:
+    """
+    Pool of logged in AsyncFortiManager sessions. aiohttp sessions are bound to the event loop that created them,
+    so idle sessions are kept per event loop, in a WeakKeyDictionary so a collected loop never leaves state behind.
+
+    asyncio.run closes the async generators of a loop before closing it, so each loop gets one whose cleanup logs out
+    the sessions of the loop. Loops run without shutdown_asyncgens must call close_all before they are closed.
+    """
+
+    def __init__(self, max_idle_per_key: int = MAX_IDLE_PER_KEY):
+        self.max_idle_per_key = max_idle_per_key
+        self._loops = weakref.WeakKeyDictionary()
+
+    async def _state(self) -> LoopState:
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = LoopState()
+            state.closer = self._close_on_shutdown()
+            # The first iteration registers the generator with the running loop
+            await state.closer.__anext__()
+        return state
+
+    async def _close_on_shutdown(self):
+        try:
+            yield
+        finally:
+            await self.close_all()
+
+    async def adom_lock(self, host: str, adom: str) -> asyncio.Lock:
+        """
+        asyncio lock of a server and ADOM in the running loop, so coroutines of a worker wait for the same ADOM in FIFO
+        order.
+        """
+        return (await self._state()).adom_locks.setdefault((host, adom), asyncio.Lock())
+
+    async def acquire(self, key, factory, idle_ttl: int):
+        sessions = (await self._state()).idle.get(key)
+        while sessions:
+            fmg, last_used = sessions.pop()
+            idle_time = time.monotonic() - last_used
+            if idle_time <= idle_ttl:
+                if idle_time <= PROBE_AFTER:
+                    return fmg
+                try:
+                    status, _ = await fmg.get("/sys/status")
+                    if status == 0:
+                        return fmg
+                except ConnectorError:
+                    pass
+            await self._close(fmg)
+        fmg = factory()
+        await fmg.login()
+        return fmg
+
+    async def release(self, key, fmg, idle_ttl: int, discard: bool = False):
+        if discard or idle_ttl <= 0 or fmg.sid is None:
+            await self._close(fmg)
+            return
+        try:
+            for adom in list(fmg.locked_adoms):
+                await fmg.unlock_adom(adom)
+        except Exception as e:
+            logger.debug("Failed to unlock ADOMs before pooling session, discarding it: {}".format(e))
+            await self._close(fmg)
+            return
+        sessions = (await self._state()).idle.setdefault(key, [])
+        sessions.append((fmg, time.monotonic()))
+        while len(sessions) > self.max_idle_per_key:
+            await self._close(sessions.pop(0)[0])
+
+    async def close_all(self):
+        """
+        Log out every idle session of the running event loop and forget its ADOM locks. Called by asyncio.run when the
+        loop shuts down, call it before closing loops that are not run by asyncio.run.
+        """
+        state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is None:
+            return
+        for sessions in state.idle.values():
+            for fmg, _ in sessions:
+                await self._close(fmg)
+
+    def __len__(self):
+        return len(self._loops)
+
+    @staticmethod
+    async def _close(fmg):
+        try:
+            await fmg.logout()
+        except Exception as e:
+            logger.debug("Failed to logout FortiManager session: {}".format(e))
+
+
+async_session_pool = AsyncSessionPool()
+
+
+def create_async_session(config: dict) -> AsyncFortiManager:
+    server_host, username, password, api_key, verify_ssl = get_config(config)
+    return AsyncFortiManager(server_host, username, password, apikey=api_key, verify_ssl=verify_ssl,
+                             verbose=config.get("verbose_json", True), use_ssl=uses_ssl(config))
+
+
+@asynccontextmanager
+async def async_fmg_session(config: dict):
+    key = get_session_key(config)
+    idle_ttl = parse_idle_ttl(config)
+    fmg = await async_session_pool.acquire(key, lambda: create_async_session(config), idle_ttl)
+    try:
+        yield fmg
+    except ConnectorError:
+        await async_session_pool.release(key, fmg, idle_ttl)
+        raise
+    except BaseException:
+        await async_session_pool.release(key, fmg, idle_ttl, discard=True)
+        raise
+    else:
+        await async_session_pool.release(key, fmg, idle_ttl)
+
+
+async def async_call_with_relogin(fmg: AsyncFortiManager, action_func, *args, **kwargs):
+    status, action_response = await action_func(*args, **kwargs)
+    if session_expired(status, action_response) and not fmg.api_key_used:
+        logger.debug("FortiManager session expired, logging in again")
+        await fmg.close()
+        await fmg.login()
+        status, action_response = await action_func(*args, **kwargs)
+    return status, action_response
+
+
+async def async_lock_adom(fmg: AsyncFortiManager, adom: str, strategy: BackoffStrategy) -> tuple:
+    """
+    Acquire the workspace lock for adom with the same backoff and deadline rules as the sync lock_adom.
+
+    :return: Tuple of (acquired, locked on the server, wait time in seconds)
+    """
+    start = time.monotonic()
+    deadline = start + strategy.timeout
+    delays = strategy.delays()
+    while True:
+        status, _ = await fmg.lock_adom(adom)
+        if status == 0:
+            return True, True, time.monotonic() - start
+        if status == -9:
+            logger.debug(f"Workspaces not enabled. Locking ADOM: {adom} not required.")
+            return True, False, time.monotonic() - start
+        if status == -6:
+            logger.error(f"URL is invalid. ADOM: {adom} does not exist.")
+            return False, False, time.monotonic() - start
+        sleep_time = min(next(delays), deadline - time.monotonic())
+        if sleep_time <= 0:
+            logger.error(f"Lock timeout of {strategy.timeout} seconds reached. Could not acquire lock for ADOM: {adom}")
+            return False, False, time.monotonic() - start
+        await asyncio.sleep(sleep_time)
+
+
+async def async_perform_rpc_action(action: str, config: dict, params: dict) -> dict:
+    """
+    asyncio counterpart of perform_rpc_action. Lock waits and task tracking yield to the event loop, so one worker
+    can keep many FortiManager calls in flight. Workspace transactions are only supported by the sync operations.
+    """
+    if params.get("transaction_id"):
+        raise ConnectorError("Transactions are not supported by the asyncio operations, use the sync operations")
+    try:
+        async with async_fmg_session(config) as fmg:
+            action_func = getattr(fmg, action)
+            data = parse_data(params.get("data", {}))
+            url = params.get("url")
+            if action == "free_form":
+                if not isinstance(data.get("data", None), list):
+                    raise ConnectorError("Payload must be a list")
+                url = data["data"][0].get("url", url)
+            adoms = parse_adoms_from_input(None if action == "free_form" else url, data)
+            response = {}
+            scopes = [(get_config(config)[0], adom) for adom in adoms] if action != "get" else []
+            cache = get_response_cache(config) if config.get("cache_enabled", False) and action != "get" else None
+            # Invalidate before the write as well as after it, so a concurrent get can not cache the old state
+            if cache is not None:
+                invalidate_cached_responses(cache, config, action, url, data, adoms)
+            record_writes(scopes)
+
+            # (ADOM, asyncio lock, locked on the server) of every ADOM held by this call
+            held = []
+            try:
+                if action != "get" and fmg.uses_workspace:
+                    strategy = BackoffStrategy(parse_lock_timeout(config))
+                    start = time.monotonic()
+                    deadline = start + strategy.timeout
+                    # Locks are always taken in sorted ADOM order so two multi ADOM requests can not deadlock
+                    for adom in sorted(adoms):
+                        adom_lock = await async_session_pool.adom_lock(fmg._host, adom)
+                        try:
+                            await asyncio.wait_for(adom_lock.acquire(), max(deadline - time.monotonic(), 0))
+                        except asyncio.TimeoutError:
+                            raise ConnectorError(f"Failed to lock ADOM: {adom}")
+                        held.append([adom, adom_lock, False])
+                        strategy.timeout = deadline - time.monotonic()
+                        acquired, held[-1][2], _ = await async_lock_adom(fmg, adom, strategy)
+                        if not acquired:
+                            raise ConnectorError(f"Failed to lock ADOM: {adom}")
+                    response["lock_wait_time"] = round(time.monotonic() - start, 3)
+
+                if action == "free_form":
+                    status, action_response = await async_call_with_relogin(fmg, action_func, params.get("method"),
+                                                                            **data)
+                else:
+                    status, action_response = await async_call_with_relogin(fmg, action_func, url=url, **data)
+
+                if fmg.uses_workspace and action != "get":
+                    for adom in sorted(adoms):
+                        await fmg.commit_changes(adom)
+
+                response[f"{action}_response"] = action_response
+                if action == 'execute' and params.get("track_task", False) and isinstance(action_response, dict):
+                    task = action_response.get('task') or action_response.get('taskid')
+                    status, task_response = await fmg.track_task(task, **parse_track_task_params(params))
+                    response["task_response"] = task_response
+                    case = SPECIAL_CASES.get(url)
+                    if case:
+                        _, special_case_result = await getattr(fmg, case["action"])(url=case["extra_url"], **data)
+                        if special_case_result:
+                            response["special_case_response"] = special_case_result
+                    if fmg.uses_workspace:
+                        for adom in sorted(adoms):
+                            await fmg.commit_changes(adom)
+            finally:
+                record_writes(scopes)
+                if cache is not None:
+                    invalidate_cached_responses(cache, config, action, url, data, adoms)
+                for adom, adom_lock, locked in held:
+                    try:
+                        if locked:
+                            await fmg.unlock_adom(adom)
+                    finally:
+                        adom_lock.release()
+
+            response["status"] = status
+            logger.debug("%s action response: %s", action, summarize(response, config))
+            return response
+    except ConnectorError:
+        raise
+    except Exception as e:
+        raise ConnectorError(e)
@@ -0,0 +1,194 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .adom_lock import BackoffStrategy, lock_adom, unlock_adom, parse_lock_timeout
+from .generic_json_rpc import (fmg_session, call_with_relogin, parse_data, parse_adoms_from_input, get_config,
+                               record_writes)
+from .response_cache import get_response_cache
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Number of items packed into a single free form request when no chunk size is given
+DEFAULT_CHUNK_SIZE = 100
+# JSON-RPC method names accepted in bulk items, mapped from the connector action names
+BULK_METHODS = {
+    "add": "add",
+    "set": "set",
+    "update": "update",
+    "delete": "delete",
+    "replace": "replace",
+    "clone": "clone",
+    "move": "move",
+    "unset": "unset",
+    "execute": "exec",
+    "exec": "exec",
+    "get": "get"
+}
+
+
+def parse_chunk_size(chunk_size, default=DEFAULT_CHUNK_SIZE) -> int:
+    try:
+        chunk_size = int(chunk_size)
+    except (TypeError, ValueError):
+        return default
+    return chunk_size if chunk_size > 0 else default
+
+
+def parse_bulk_items(items: Union[list, str]) -> list:
+    """
+    Normalize bulk items to a list of (method, url, data) tuples.
+
+    Each item is either a dict with method, url and optional data keys, or a [method, url, data] list.
+    """
+    if isinstance(items, str):
+        items = parse_data(items)
+        items = items.get("data", items) if isinstance(items, dict) else items
+    if not isinstance(items, list) or not items:
+        raise ConnectorError("Items must be a non empty list of method, url and data entries")
+    parsed = []
+    for index, item in enumerate(items):
+        if isinstance(item, dict):
+            method, url, data = item.get("method"), item.get("url"), item.get("data")
+        elif isinstance(item, (list, tuple)) and len(item) in (2, 3):
+            method, url, data = item[0], item[1], item[2] if len(item) == 3 else None
+        else:
+            raise ConnectorError(f"Item {index} must be a dict or a [method, url, data] list")
+        if method not in BULK_METHODS:
+            raise ConnectorError(f"Item {index} has unsupported method: {method}")
+        if not url:
+            raise ConnectorError(f"Item {index} is missing a url")
+        parsed.append((BULK_METHODS[method], url, data))
+    return parsed
+
+
+def build_chunks(items: list, chunk_size: int) -> list:
+    """
+    Split items into free form requests. Consecutive items sharing a method are packed together, up to chunk_size
+    items per request, so the order in which items are applied is preserved.
+
+    :return: List of (method, [item indexes]) tuples
+    """
+    chunks = []
+    for index, (method, url, data) in enumerate(items):
+        if chunks and chunks[-1][0] == method and len(chunks[-1][1]) < chunk_size:
+            chunks[-1][1].append(index)
+        else:
+            chunks.append((method, [index]))
+    return chunks
+
+
+def build_item_params(url: str, data) -> dict:
+    item_params = {"url": url}
+    if data not in (None, "", {}):
+        item_params["data"] = data
+    return item_params
+
+
+def item_result(index: int, method: str, url: str, code: int, message: str, data=None) -> dict:
+    return {
+        "index": index,
+        "method": method,
+        "url": url,
+        "status": code,
+        "message": message,
+        "data": data
+    }
+
+
+def run_bulk_chunks(fmg, items: list, chunks: list) -> list:
+    """
+    Send every chunk as one free form request and map each result back to the item it belongs to.
+    """
+    results = [None] * len(items)
+    for method, indexes in chunks:
+        payload = [build_item_params(items[i][1], items[i][2]) for i in indexes]
+        try:
+            status, chunk_response = call_with_relogin(fmg, fmg.free_form, method, data=payload)
+        except Exception as e:
+            logger.error(f"Bulk {method} request of {len(indexes)} items failed: {e}")
+            for i in indexes:
+                results[i] = item_result(i, method, items[i][1], -1, str(e))
+            continue
+        if not isinstance(chunk_response, list):
+            chunk_response = []
+        for position, i in enumerate(indexes):
+            entry = chunk_response[position] if position < len(chunk_response) else None
+            if not isinstance(entry, dict):
+                results[i] = item_result(i, method, items[i][1], -1, "No result returned for item")
+                continue
+            entry_status = entry.get("status", {})
+            results[i] = item_result(i, method, items[i][1], entry_status.get("code", -1),
+                                     entry_status.get("message", ""), entry.get("data"))
+    return results
+
+
+def invalidate_cached_responses(config: dict, items: list, adoms: list):
+    if not config.get("cache_enabled", False):
+        return
+    cache = get_response_cache(config)
+    server = get_config(config)[0]
+    urls = [url for method, url, data in items if method != "get"]
+    for adom in adoms:
+        cache.invalidate(server, adom, urls)
+
+
+def perform_bulk_action(config: dict, params: dict) -> dict:
+    items = parse_bulk_items(params.get("items"))
+    chunks = build_chunks(items, parse_chunk_size(params.get("chunk_size")))
+    adoms = sorted({adom for method, url, data in items for adom in parse_adoms_from_input(url, data)})
+    response = {}
+    writes = any(method != "get" for method, url, data in items)
+    scopes = [(get_config(config)[0], adom) for adom in adoms] if writes else []
+    invalidate_cached_responses(config, items, adoms)
+    record_writes(scopes)
+    try:
+        with fmg_session(config) as fmg:
+            locks = []
+            try:
+                if fmg._lock_ctx.uses_workspace and any(method != "get" for method, url, data in items):
+                    # Locks are always taken in sorted ADOM order so two batches can not deadlock each other
+                    response["lock_wait_time"] = {}
+                    for adom in adoms:
+                        lock = lock_adom(fmg, adom, items[0][1], f"bulk of {len(items)} items",
+                                         BackoffStrategy(parse_lock_timeout(config)))
+                        locks.append(lock)
+                        response["lock_wait_time"][adom] = round(lock.wait_time, 3)
+                        if not lock:
+                            raise ConnectorError(f"Failed to lock ADOM: {adom}")
+
+                results = run_bulk_chunks(fmg, items, chunks)
+
+                # Commit once per ADOM for the whole batch
+                for lock in locks:
+                    if lock.locked:
+                        fmg.commit_changes(lock.adom)
+            finally:
+                for lock in locks:
+                    unlock_adom(fmg, lock)
+    except ConnectorError:
+        raise
+    except Exception as e:
+        raise ConnectorError(e)
+    finally:
+        invalidate_cached_responses(config, items, adoms)
+        record_writes(scopes)
+
+    failed = sum(1 for result in results if result["status"] != 0)
+    response.update({
+        "bulk_response": results,
+        "total": len(results),
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "requests": len(chunks),
+        "status": 0 if failed == 0 else 1
+    })
+    logger.debug(f"Bulk action completed: {len(results) - failed} succeeded, {failed} failed")
+    return response
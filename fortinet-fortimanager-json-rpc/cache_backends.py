@@ -0,0 +1,327 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import abc
+import os
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Owner of the connector process, None where the platform has no user ids
+PROCESS_UID = os.getuid() if hasattr(os, "getuid") else None
+# Per-user directory of the on-disk stores shared by the worker processes of a node
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), f"fortinet_fortimanager_json_rpc-{PROCESS_UID}")
+# Default location of the on-disk cache shared by the worker processes of a node
+DEFAULT_CACHE_PATH = os.path.join(DEFAULT_DATA_DIR, "cache.sqlite3")
+# Default size cap of a backend in megabytes of stored values
+DEFAULT_CACHE_MAX_SIZE = 32
+DEFAULT_MAX_BYTES = DEFAULT_CACHE_MAX_SIZE * 1024 * 1024
+
+
+def check_private(path: str, st: os.stat_result):
+    """
+    Raise if path is owned by another user or writable by its group or others, as anyone who can write it can feed
+    forged responses or session ids to the connector.
+    """
+    if PROCESS_UID is not None and st.st_uid != PROCESS_UID:
+        raise ConnectorError(f"Refusing to use {path}: it is owned by uid {st.st_uid}, not by uid {PROCESS_UID}")
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise ConnectorError(f"Refusing to use {path}: it is writable by its group or others "
+                             f"(mode {stat.S_IMODE(st.st_mode):o})")
+
+
+def ensure_private_directory(directory: str):
+    """
+    Create directory with mode 0700 if it does not exist, and refuse it if it is not a directory private to the user.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_mode & 0o077:
+        raise ConnectorError(f"Refusing to use {directory}: it is not a directory private to its owner")
+    check_private(directory, st)
+
+
+def open_private_file(path: str, flags: int = os.O_RDWR) -> int:
+    """
+    File descriptor of path, created readable by the owner only. The file is checked through the descriptor that
+    opened it, so it can not be swapped between the check and its use.
+    """
+    fd = os.open(path, flags | os.O_CREAT, 0o600)
+    try:
+        check_private(path, os.fstat(fd))
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def open_private_database(path: str) -> sqlite3.Connection:
+    """
+    sqlite connection to path, created readable by the owner only. The default directory is created with mode 0700,
+    and an existing directory or file that other users could tamper with is refused.
+    """
+    directory = os.path.dirname(path)
+    if directory == DEFAULT_DATA_DIR:
+        ensure_private_directory(directory)
+    os.close(open_private_file(path))
+    return sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+
+
+def url_related(entry_url: str, prefixes: list) -> bool:
+    return any(entry_url.startswith(prefix) or prefix.startswith(entry_url) for prefix in prefixes)
+
+
+class CacheBackend(abc.ABC):
+    """
+    Storage interface of the response cache. Values are serialized strings, each stored with the server, ADOM and
+    normalized URL it was read from so writes can invalidate it. Entries stored with an empty URL, such as shared
+    session ids, are never invalidated by writes. The size cap of a backend is fixed when it is created.
+    """
+
+    max_bytes = DEFAULT_MAX_BYTES
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Union[str, None]:
+        pass
+
+    @abc.abstractmethod
+    def set(self, key: str, value: str, ttl: float, server: str = "", adom: str = "", url: str = ""):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abc.abstractmethod
+    def invalidate(self, server: str, adom: str, prefixes: list) -> int:
+        """
+        Drop the entries of server that read from adom, or whose URL is a prefix of, or prefixed by, one of prefixes.
+
+        :return: Number of entries dropped
+        """
+
+    @abc.abstractmethod
+    def clear(self):
+        pass
+
+    @abc.abstractmethod
+    def __len__(self):
+        pass
+
+
+class MemoryCacheEntry:
+    __slots__ = ("value", "expires", "server", "adom", "url", "size")
+
+    def __init__(self, value: str, expires: float, server: str, adom: str, url: str):
+        self.value = value
+        self.expires = expires
+        self.server = server
+        self.adom = adom
+        self.url = url
+        self.size = len(value)
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    In-process LRU backend, bounded by the total size of the stored values.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Union[str, None]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def set(self, key: str, value: str, ttl: float, server: str = "", adom: str = "", url: str = ""):
+        entry = MemoryCacheEntry(value, time.monotonic() + ttl, server, adom, url)
+        if ttl <= 0 or entry.size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate(self, server: str, adom: str, prefixes: list) -> int:
+        with self._lock:
+            stale = [key for key, entry in self._entries.items()
+                     if entry.url and entry.server == server and (entry.adom == adom or url_related(entry.url,
+                                                                                                    prefixes))]
+            for key in stale:
+                self._remove(key)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+
+class SqliteCacheBackend(CacheBackend):
+    """
+    On-disk backend in a local sqlite database, shared by every worker process of the node that uses the same path.
+    Least recently used entries are evicted once the stored values exceed max_bytes.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not be shared with forked children, open a new one per process
+        if self._conn is None or self._pid != os.getpid():
+            # The cache holds responses and session ids, keep it private to the owner
+            conn = open_private_database(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                         "expires REAL NOT NULL, server TEXT NOT NULL, adom TEXT NOT NULL, url TEXT NOT NULL, "
+                         "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_server ON cache_entries (server)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_last_access ON cache_entries (last_access)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get(self, key: str) -> Union[str, None]:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT value, expires FROM cache_entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE cache_entries SET last_access = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: str, ttl: float, server: str = "", adom: str = "", url: str = ""):
+        if ttl <= 0 or len(value) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (key, value, now + ttl, server, adom, url, len(value), now))
+                conn.execute("DELETE FROM cache_entries WHERE expires <= ?", (now,))
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+                if total > self.max_bytes:
+                    self._evict(conn, total - self.max_bytes)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _evict(conn: sqlite3.Connection, excess: int):
+        freed = 0
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM cache_entries ORDER BY last_access"):
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM cache_entries WHERE key = ?", stale)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._connection().execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+
+    def invalidate(self, server: str, adom: str, prefixes: list) -> int:
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute("SELECT key, adom, url FROM cache_entries WHERE server = ? AND url != ''",
+                                (server,)).fetchall()
+            stale = [(key,) for key, entry_adom, entry_url in rows
+                     if entry_adom == adom or url_related(entry_url, prefixes)]
+            conn.executemany("DELETE FROM cache_entries WHERE key = ?", stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._connection().execute("DELETE FROM cache_entries")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+
+
+_sqlite_backends = {}
+_memory_backends = {DEFAULT_MAX_BYTES: MemoryCacheBackend()}
+CACHE_BACKEND_MEMORY = "Memory"
+CACHE_BACKEND_DISK = "Local Disk"
+
+
+def parse_max_bytes(config: dict) -> int:
+    """
+    Size cap in bytes of the backend of the config, from its budget in megabytes.
+    """
+    try:
+        max_size = float(config.get("cache_max_size") or DEFAULT_CACHE_MAX_SIZE)
+    except (TypeError, ValueError):
+        max_size = DEFAULT_CACHE_MAX_SIZE
+    return int(max_size * 1024 * 1024)
+
+
+def get_cache_backend(config: dict) -> CacheBackend:
+    """
+    Backend selected by the config. Backends are shared by every config pointing at the same storage with the same
+    size cap, so one config can not change the cap of a backend used by another.
+    """
+    max_bytes = parse_max_bytes(config)
+    if config.get("cache_backend") == CACHE_BACKEND_DISK:
+        key = (config.get("cache_path") or DEFAULT_CACHE_PATH, max_bytes)
+        backend = _sqlite_backends.get(key)
+        if backend is None:
+            backend = _sqlite_backends.setdefault(key, SqliteCacheBackend(key[0], max_bytes))
+        return backend
+    backend = _memory_backends.get(max_bytes)
+    if backend is None:
+        backend = _memory_backends.setdefault(max_bytes, MemoryCacheBackend(max_bytes))
+    return backend
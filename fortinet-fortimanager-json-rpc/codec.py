@@ -0,0 +1,180 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import json
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+from pyFMG.fortimgr import FortiManager, FMGBaseException, FMGConnectionError, FMGResponseNotFormedCorrect, \
+    FMGValidSessionException, FMGValueError
+from requests.exceptions import ConnectionError as ReqConnError
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# JSON libraries tried in order when no codec is selected, the first importable one is used
+CODEC_PREFERENCE = ("orjson", "ujson", "json")
+
+
+class JSONCodec:
+    """
+    Encoder and decoder of one JSON library. loads accepts str, bytes or bytearray, so response bodies are decoded
+    straight from the byte buffer, and raises json.JSONDecodeError whatever the library.
+    """
+
+    name = "json"
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj)
+
+    def loads(self, data: Union[str, bytes, bytearray]):
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj) -> str:
+        try:
+            return self._orjson.dumps(obj).decode()
+        except TypeError:
+            # orjson rejects non str keys and integers wider than 64 bits, which json still encodes
+            return json.dumps(obj)
+
+    def loads(self, data: Union[str, bytes, bytearray]):
+        try:
+            return self._orjson.loads(data)
+        except self._orjson.JSONDecodeError:
+            # Either invalid JSON, re-raised by json with its usual error, or an integer wider than 64 bits
+            return json.loads(data)
+
+
+class UjsonCodec(JSONCodec):
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj) -> str:
+        try:
+            return self._ujson.dumps(obj, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return json.dumps(obj)
+
+    def loads(self, data: Union[str, bytes, bytearray]):
+        try:
+            return self._ujson.loads(data)
+        except ValueError:
+            return json.loads(data)
+
+
+CODECS = {
+    "orjson": OrjsonCodec,
+    "ujson": UjsonCodec,
+    "json": JSONCodec
+}
+
+_codec = None
+
+
+def set_codec(name: Union[str, None] = None) -> JSONCodec:
+    """
+    Select the codec used by the connector, by library name, or the fastest importable one when name is None.
+    """
+    global _codec
+    if name:
+        if name not in CODECS:
+            raise ConnectorError(f"Unknown JSON codec: {name}. Expected one of {', '.join(CODECS)}")
+        try:
+            _codec = CODECS[name]()
+        except ImportError as e:
+            raise ConnectorError(f"JSON codec {name} is not available: {e}")
+        return _codec
+    for candidate in CODEC_PREFERENCE:
+        try:
+            _codec = CODECS[candidate]()
+            break
+        except ImportError:
+            continue
+    logger.debug(f"Using JSON codec: {_codec.name}")
+    return _codec
+
+
+def get_codec() -> JSONCodec:
+    return _codec if _codec is not None else set_codec()
+
+
+def dumps(obj) -> str:
+    return get_codec().dumps(obj)
+
+
+def loads(data: Union[str, bytes, bytearray]):
+    return get_codec().loads(data)
+
+
+class CodecFortiManager(FortiManager):
+    """
+    pyFMG FortiManager encoding its requests and decoding its responses with the selected codec. Only the sessions
+    created by the connector use it, pyFMG's json module and other FortiManager instances are left alone.
+    """
+
+    # _post_request and _request_error follow the private FortiManager._post_request of pyFMG 0.8.6.3, which has no
+    # hook for the request encoding. pyFMG is pinned to that version in requirements.txt, so check both methods against
+    # the new _post_request whenever the pin is raised
+    def _post_request(self, method, params, free_form=False, create_task=None):
+        headers = {"content-type": "application/json"}
+        if self.api_key_used:
+            headers["Authorization"] = "Bearer {apikey}".format(apikey=self._passwd)
+        self.req_resp_object.reset()
+        if self.sid is None:
+            raise FMGValidSessionException(method, params)
+        self._update_request_id()
+        json_request = {"method": method, "params": params}
+        if create_task:
+            json_request["create task"] = create_task
+        elif method == "get" and self._verbose is True:
+            json_request["verbose"] = 1
+        json_request["session"] = self.sid
+        json_request["id"] = self.req_id
+        self.req_resp_object.request_json = json_request
+        try:
+            # Sent as UTF-8 bytes, the codecs other than json leave non-ASCII characters unescaped and older urllib3
+            # versions would encode a str body as latin-1
+            response = self.sess.post(self._url, data=dumps(json_request).encode("utf-8"), verify=self.verify_ssl,
+                                      timeout=self.timeout, headers=headers)
+            # Decode the raw body, requests would otherwise detect the encoding and build a str copy of it first
+            response.json = lambda **kwargs: loads(response.content)
+            if free_form:
+                return self._freeform_response(response)
+            return self._handle_response(response)
+        except Exception as err:
+            raise self._request_error(err)
+
+    def _request_error(self, err: Exception) -> Exception:
+        """
+        pyFMG exception matching err, as raised by FortiManager._post_request.
+        """
+        if isinstance(err, ReqConnError):
+            msg = "Connection error: {err_type} {err}\n\n".format(err_type=type(err), err=err)
+            error = FMGConnectionError(msg)
+        elif isinstance(err, ValueError):
+            msg = "Value error: {err_type} {err}\n\n".format(err_type=type(err), err=err)
+            error = FMGValueError(msg)
+        elif isinstance(err, (KeyError, IndexError)):
+            name = "Key" if isinstance(err, KeyError) else "Index"
+            msg = "{name} error in response: {err_type} {err}\n\n".format(name=name, err_type=type(err), err=err)
+            error = FMGResponseNotFormedCorrect(msg)
+        else:
+            msg = "Response parser error: {err_type} {err}".format(err_type=type(err), err=err)
+            error = FMGBaseException(msg)
+        self.req_resp_object.error_msg = msg
+        self.dprint()
+        return error
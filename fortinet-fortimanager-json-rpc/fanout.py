@@ -0,0 +1,142 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .generic_json_rpc import fmg_session, call_with_relogin, parse_data, perform_rpc_action
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Number of ADOMs written to at the same time when no concurrency is given
+DEFAULT_FANOUT_CONCURRENCY = 8
+# Upper bound on the number of ADOMs written to at the same time
+MAX_FANOUT_CONCURRENCY = 32
+ADOM_PLACEHOLDER = "{adom}"
+# Actions a fan-out may run in every ADOM, mapped to the pyFMG method names
+FANOUT_ACTIONS = {
+    "add": "add",
+    "set": "set",
+    "update": "update",
+    "delete": "delete",
+    "replace": "replace",
+    "exec": "execute",
+    "execute": "execute"
+}
+# ADOMs FortiManager creates for other products, unmanaged devices and logs, never targeted by all. root is the
+# default FortiGate ADOM and is kept
+BUILTIN_ADOMS = frozenset([
+    "FortiAnalyzer", "FortiAuthenticator", "FortiCache", "FortiCarrier", "FortiClient", "FortiDDoS", "FortiDeceptor",
+    "FortiFirewall", "FortiFirewallCarrier", "FortiMail", "FortiManager", "FortiNAC", "FortiProxy", "FortiSandbox",
+    "FortiSwitch", "FortiWeb", "Syslog", "Unmanaged_Devices", "others"
+])
+
+
+def parse_fanout_concurrency(concurrency, default=DEFAULT_FANOUT_CONCURRENCY) -> int:
+    try:
+        concurrency = int(concurrency)
+    except (TypeError, ValueError):
+        return default
+    return min(max(concurrency, 1), MAX_FANOUT_CONCURRENCY)
+
+
+def parse_adom_list(adoms: Union[list, str, None]) -> Union[list, None]:
+    """
+    Parse the target ADOMs, either a list or a comma separated string of ADOM names.
+
+    :return: List of distinct ADOM names, or None when every ADOM is targeted
+    """
+    if isinstance(adoms, str):
+        if adoms.strip().lower() == "all":
+            return None
+        adoms = adoms.split(",")
+    if not isinstance(adoms, list):
+        raise ConnectorError(f"Unexpected ADOMs type: {type(adoms)}. Please pass a list, a comma separated string "
+                             f"or all.")
+    adoms = list(dict.fromkeys(str(adom).strip() for adom in adoms if str(adom).strip()))
+    if not adoms:
+        raise ConnectorError("At least one ADOM is required")
+    return adoms
+
+
+def list_adoms(config: dict) -> list:
+    """
+    Names of the enabled ADOMs of the server, without the built-in ADOMs of BUILTIN_ADOMS.
+    """
+    with fmg_session(config) as fmg:
+        status, adoms = call_with_relogin(fmg, fmg.get, "/dvmdb/adom", fields=["name", "state"])
+    if status != 0 or not isinstance(adoms, list):
+        raise ConnectorError(f"Failed to list ADOMs: {adoms}")
+    # Verbose responses return the state as a string
+    return [adom["name"] for adom in adoms if adom.get("name") and adom["name"] not in BUILTIN_ADOMS and
+            adom.get("state") not in (0, "disable")]
+
+
+def substitute_adom(value, adom: str):
+    """
+    Replace every {adom} placeholder in the strings of value.
+    """
+    if isinstance(value, str):
+        return value.replace(ADOM_PLACEHOLDER, adom)
+    if isinstance(value, list):
+        return [substitute_adom(item, adom) for item in value]
+    if isinstance(value, dict):
+        return {key: substitute_adom(item, adom) for key, item in value.items()}
+    return value
+
+
+def run_in_adom(action: str, config: dict, url_template: str, data_template: dict, adom: str) -> dict:
+    """
+    Run action against one ADOM. Locking and committing are done by perform_rpc_action for that ADOM only, so a
+    failure in one ADOM does not affect the others.
+    """
+    start = time.monotonic()
+    result = {"adom": adom}
+    try:
+        response = perform_rpc_action(action, config, {"url": substitute_adom(url_template, adom),
+                                                       "data": substitute_adom(data_template, adom)})
+        result.update({"status": response.get("status"), "response": response})
+    except Exception as e:
+        logger.error(f"Fan-out {action} failed in ADOM: {adom}: {e}")
+        result.update({"status": -1, "error": str(e)})
+    result["elapsed"] = round(time.monotonic() - start, 3)
+    return result
+
+
+def perform_fanout_action(config: dict, params: dict) -> dict:
+    method = params.get("method")
+    if method not in FANOUT_ACTIONS:
+        raise ConnectorError(f"Unsupported fan-out method: {method}")
+    url_template = params.get("url") or ""
+    if ADOM_PLACEHOLDER not in url_template:
+        raise ConnectorError(f"URL must contain the {ADOM_PLACEHOLDER} placeholder")
+    data_template = parse_data(params.get("data", {}))
+    adoms = parse_adom_list(params.get("adoms"))
+    if adoms is None:
+        adoms = list_adoms(config)
+    concurrency = min(parse_fanout_concurrency(params.get("concurrency")), len(adoms)) or 1
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fmg-fanout") as executor:
+        results = list(executor.map(
+            lambda adom: run_in_adom(FANOUT_ACTIONS[method], config, url_template, data_template, adom), adoms))
+
+    failed = sum(1 for result in results if result["status"] != 0)
+    logger.debug(f"Fan-out {method} completed in {len(adoms)} ADOMs: {len(adoms) - failed} succeeded, "
+                 f"{failed} failed")
+    return {
+        "fanout_response": results,
+        "total": len(results),
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "concurrency": concurrency,
+        "elapsed": round(time.monotonic() - start, 3),
+        "status": 0 if failed == 0 else 1
+    }
@@ -5,19 +5,33 @@ Copyright (c) 2024 Fortinet Inc
 Copyright end
 """
 
+import hashlib
 import json
-import random
 import re
 import time
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import Union
 
 from connectors.core.connector import get_logger, ConnectorError
 from pyFMG.fortimgr import FortiManager
 
+from .adom_lock import BackoffStrategy, lock_adom, unlock_adom, parse_lock_timeout
+from .cache_backends import get_cache_backend
+from .codec import CodecFortiManager, loads
+from .log_utils import summarize
+from .metrics import RequestMetrics, instrument_session
+from .response_cache import make_cache_key, get_cache_ttl, get_response_cache
+from .session_pool import session_pool, session_expired, DEFAULT_IDLE_TTL
+from .single_flight import single_flight
+from .task_tracker import task_tracker
+from .workspace_txn import transaction_manager, parse_transaction_params
+
 logger = get_logger('fortinet-fortimanager-json-rpc')
 
-# Set the maximum number of retries to acquire a lock on an ADOM
-MAX_RETRY_LIMIT = 1500
+ADOM_URL_PATTERN = re.compile(r'/adom/([^/]+)/')
+# Nesting levels of a payload searched for ADOMs
+MAX_ADOM_SEARCH_DEPTH = 32
 
 
 def get_config(config: dict) -> tuple:
@@ -33,6 +47,118 @@ def get_config(config: dict) -> tuple:
         return server_url, username, password, None, verify_ssl
 
 
+def get_session_key(config: dict) -> tuple:
+    """
+    Key used to share pooled sessions between operations using the same server, credentials and request flags.
+    """
+    return get_config(config) + (config.get("debug_connection", False), config.get("verbose_json", True),
+                                 uses_ssl(config))
+
+
+def uses_ssl(config: dict) -> bool:
+    """
+    HTTPS is used unless the address explicitly starts with http://, e.g. for a local simulator.
+    """
+    return not config.get("address", "").strip().lower().startswith("http://")
+
+
+def parse_idle_ttl(config: dict) -> int:
+    """
+    Parse the session idle TTL from the config. A value of 0 disables session pooling.
+    """
+    idle_ttl = config.get("session_idle_ttl")
+    if idle_ttl in (None, ""):
+        return DEFAULT_IDLE_TTL
+    try:
+        return max(int(idle_ttl), 0)
+    except (TypeError, ValueError):
+        return DEFAULT_IDLE_TTL
+
+
+def create_session(config: dict) -> FortiManager:
+    server_host, username, password, api_key, verify_ssl = get_config(config)
+    fmg = CodecFortiManager(server_host, username, password, apikey=api_key, verify_ssl=verify_ssl,
+                            debug=config.get("debug_connection", False), verbose=config.get("verbose_json", True),
+                            disable_request_warnings=True, use_ssl=uses_ssl(config))
+    return instrument_session(fmg)
+
+
+def get_shared_session_key(config: dict) -> str:
+    """
+    Cache key of the session id shared between workers. Hashing keeps credentials out of the key.
+    """
+    normalized = json.dumps(["session"] + list(get_session_key(config)), default=str)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def adopt_shared_session(config: dict, fmg: FortiManager) -> bool:
+    """
+    Reuse the session id another worker published for the same server and credentials, when it is still valid.
+    """
+    backend = get_cache_backend(config)
+    shared_key = get_shared_session_key(config)
+    sid = backend.get(shared_key)
+    if not sid:
+        return False
+    fmg._url = "{proto}://{host}/jsonrpc".format(proto="https" if fmg._use_ssl else "http", host=fmg._host)
+    fmg.sid = sid
+    try:
+        status, _ = fmg.get("/sys/status")
+        if status == 0:
+            fmg._lock_ctx.check_mode()
+    except Exception as e:
+        logger.debug(f"Failed to reuse shared FortiManager session: {e}")
+        status = -1
+    if status != 0 or fmg._lock_ctx.uses_workspace:
+        backend.delete(shared_key)
+        fmg.sid = None
+        return False
+    fmg.shared_session = True
+    return True
+
+
+def open_session(config: dict) -> FortiManager:
+    """
+    Create a session for the session pool. With share_sessions enabled, a password session id is published to the
+    cache backend and reused by the other workers instead of logging in again. ADOM locks belong to a session id, so
+    sessions are never shared when workspace mode is enabled.
+    """
+    fmg = create_session(config)
+    if not config.get("share_sessions", False) or fmg.api_key_used:
+        return fmg
+    if adopt_shared_session(config, fmg):
+        logger.debug("Reusing FortiManager session shared by another worker")
+        return fmg
+    fmg.login()
+    idle_ttl = parse_idle_ttl(config)
+    if fmg.sid is not None and idle_ttl > 0 and not fmg._lock_ctx.uses_workspace:
+        get_cache_backend(config).set(get_shared_session_key(config), fmg.sid, idle_ttl)
+        fmg.shared_session = True
+    return fmg
+
+
+@contextmanager
+def fmg_session(config: dict):
+    """
+    Context manager yielding a logged in FortiManager session from the session pool.
+    """
+    with session_pool.session(get_session_key(config), lambda: open_session(config),
+                              parse_idle_ttl(config)) as fmg:
+        yield fmg
+
+
+def call_with_relogin(fmg, action_func, *args, **kwargs):
+    """
+    Call action_func, logging in again and retrying once if the pooled session has expired on the server. A free form
+    request is retried whole when any of its items reports the expired session.
+    """
+    status, action_response = action_func(*args, **kwargs)
+    if session_expired(status, action_response) and not fmg.api_key_used:
+        session_pool.relogin(fmg)
+        status, action_response = action_func(*args, **kwargs)
+    return status, action_response
+
+
 def clean_server_url(server_url: str, port: Union[str, None]) -> str:
     server_host = server_url.strip('/').replace("http://", "").replace("https://", "")
 
@@ -43,11 +169,12 @@ def clean_server_url(server_url: str, port: Union[str, None]) -> str:
     return server_host
 
 
-def parse_data(data: Union[list, bool, str, dict]):
-    if isinstance(data, str):
+def parse_data(data: Union[list, bool, str, bytes, dict]):
+    # Payloads that already arrive as a dict or list are used as they are, only text is decoded
+    if isinstance(data, (str, bytes, bytearray)):
         try:
-            return json.loads(data) if data else {}
-        except json.JSONDecodeError as e:
+            return loads(data) if data else {}
+        except ValueError as e:
             raise ConnectorError(f"Could not parse JSON: {e}")
     if isinstance(data, list):
         return {"data": data}
@@ -72,33 +199,54 @@ def parse_task_timeout(task_timeout, default=120):
     return task_timeout
 
 
-def parse_adom_from_input(url: str, data: Union[list, dict]) -> str:
-    match = re.search(r'/adom/([^/]+)/', url)
-    if match:
-        return match.group(1)
+@lru_cache(maxsize=4096)
+def parse_adom_from_url(url: str) -> Union[str, None]:
+    match = ADOM_URL_PATTERN.search(url)
+    return match.group(1) if match else None
+
+
+def parse_adoms_from_input(url: Union[str, None], data: Union[list, dict],
+                           max_depth: int = MAX_ADOM_SEARCH_DEPTH) -> list:
+    """
+    Every ADOM touched by a request, in the order found.
+
+    An ADOM in url wins. Otherwise data is walked once, depth first: a dict whose url names an ADOM, or that has an
+    adom key, resolves to that ADOM and is not searched further. Levels deeper than max_depth are not searched.
 
-    # If the adom is not found in the URL, check the data
-    def extract_adom(nested_data):
+    :return: List of ADOM names, ["global"] when none is found
+    """
+    adom = parse_adom_from_url(url) if isinstance(url, str) else None
+    if adom:
+        return [adom]
+
+    adoms = {}
+    stack = [(data, 0)]
+    while stack:
+        nested_data, depth = stack.pop()
         if isinstance(nested_data, dict):
-            if 'url' in nested_data:
-                nested_match = re.search(r'/adom/([^/]+)/', nested_data['url'])
-                if nested_match:
-                    return nested_match.group(1)
-            if 'adom' in nested_data:
-                return nested_data['adom']
-            for key, value in nested_data.items():
-                result = extract_adom(value)
-                if result:
-                    return result
+            nested_url = nested_data.get("url")
+            adom = parse_adom_from_url(nested_url) if isinstance(nested_url, str) else None
+            adom = adom or nested_data.get("adom")
+            if adom and isinstance(adom, str):
+                adoms[adom] = None
+                continue
+            children = nested_data.values()
         elif isinstance(nested_data, list):
-            for item in nested_data:
-                result = extract_adom(item)
-                if result:
-                    return result
-        return None
+            children = nested_data
+        else:
+            continue
+        if depth < max_depth:
+            # Pushed in reverse so items are visited in payload order
+            stack.extend((child, depth + 1) for child in reversed(list(children))
+                         if isinstance(child, (dict, list)))
+    return list(adoms) or ["global"]
+
 
-    adom = extract_adom(data)
-    return adom if adom else "global"
+def parse_adom_from_input(url: str, data: Union[list, dict]) -> str:
+    """
+    First ADOM touched by a request, see parse_adoms_from_input.
+    """
+    return parse_adoms_from_input(url, data)[0]
 
 
 def parse_track_task_params(params):
@@ -121,60 +269,50 @@ def parse_track_task_params(params):
     return track_task_params
 
 
-def lock_adom(fmg, adom, url, data):
-    for attempt in range(MAX_RETRY_LIMIT):
-        status, _ = fmg.lock_adom(adom)
-        # If the lock was acquired, break the loop
-        if status == 0:
-            logger.debug(f"Acquired lock for ADOM: {adom} using URL: {url} with PAYLOAD: {data}.")
-            return True
-        # status == -9 means that the command for the url is invalid. This happens when an adom is attempted to be
-        # locked when workspaces isn't enabled. This is a workaround for a pyFMG bug where uses_workspace is True when
-        # it should be False. That happens because pyFMG checks a 0 or 1 int, but verbose mode returns a string.
-        if status == -9:
-            logger.debug(f"Workspaces not enabled. Locking ADOM: {adom} not required.")
-            return True
-        # status == -6 when URL is invalid. This could occur when a nonexistent adom is attempted to be locked.
-        if status == -6:
-            logger.error(f"URL is invalid. ADOM: {adom} does not exist.")
-            return False
-        if attempt < MAX_RETRY_LIMIT - 1:
-            # Sleep for a random amount of time between 1 and 10 seconds
-            sleep_time = random.randint(1, 10)
-            logger.debug(
-                f"Failed to acquire lock for ADOM: {adom} using URL: {url} with PAYLOAD: {data}. Sleeping {sleep_time} seconds and retrying...")
-            time.sleep(sleep_time)
-        else:
-            logger.error(
-                f"Max retry limit reached. Could not acquire lock for ADOM: {adom} using URL: {url} with PAYLOAD: {data}.")
-            return False
-    return False
+# Actions that always need a follow up call once their task is complete, keyed on the URL of the first call
+SPECIAL_CASES = {
+    "/securityconsole/install/preview": {
+        "extra_url": "/securityconsole/preview/result",
+        "action": "execute"
+    },
+    # Add more special cases here as needed
+}
 
 
 def handle_special_cases(fmg, url, data, action_response, task_response=None):
-    special_cases = {
-        "/securityconsole/install/preview": {
-            "extra_url": "/securityconsole/preview/result",
-            "action": "execute"
-        },
-        # Add more special cases here as needed
-    }
-
-    if url in special_cases:
-        case = special_cases[url]
+    if url in SPECIAL_CASES:
+        case = SPECIAL_CASES[url]
         action_func = getattr(fmg, case["action"])
         status, extra_response = action_func(url=case["extra_url"], **data)
         return extra_response
     return None
 
 
+def handle_background_task_done(config: dict, url: str, data: dict, tracked, result: tuple):
+    """
+    Completion callback of tasks tracked in the background, runs the special case follow up call if there is one.
+    """
+    if url not in SPECIAL_CASES or result[0] != 0:
+        return
+    with fmg_session(config) as fmg:
+        special_case_result = handle_special_cases(fmg, url, data, None, tracked.task_info)
+    if special_case_result:
+        tracked.extra["special_case_response"] = special_case_result
+
+
+def get_touched_urls(action: str, url: str, data: dict) -> list:
+    """
+    URLs written to by an action, used to invalidate cached get responses.
+    """
+    if action == "free_form":
+        return [item.get("url") for item in data.get("data", []) if isinstance(item, dict) and item.get("url")]
+    return [url] if url else []
+
+
 def perform_rpc_action(action: str, config: dict, params: dict) -> dict:
-    server_host, username, password, api_key, verify_ssl = get_config(config)
+    metrics = RequestMetrics(action)
     try:
-        with FortiManager(server_host, username, password, apikey=api_key, verify_ssl=verify_ssl,
-                          debug=config.get("debug_connection", False),
-                          verbose=config.get("verbose_json", True), disable_request_warnings=True) as fmg:
-            action_func = getattr(fmg, action)
+        with metrics.phase("parse"):
             data = parse_data(params.get("data", {}))
             url = params.get("url")
             # To handle locking ADOM's when freeform action is used, I will pick the first url found and lock that adom.
@@ -183,30 +321,138 @@ def perform_rpc_action(action: str, config: dict, params: dict) -> dict:
                 if not isinstance(data.get("data", None), list):
                     raise ConnectorError("Payload must be a list")
                 url = data["data"][0].get("url", url)
-            adom = parse_adom_from_input(url, data)
-            response = {}
+            # Every item of a freeform payload may name its own ADOM
+            adoms = parse_adoms_from_input(None if action == "free_form" else url, data)
+
+        cache = get_response_cache(config) if config.get("cache_enabled", False) else None
+        cache_key = None
+        if cache is not None:
+            with metrics.phase("cache"):
+                # Gets inside a transaction can see uncommitted workspace changes, so they are never cached
+                if action == "get" and url and not params.get("bypass_cache", False) and \
+                        not params.get("transaction_id"):
+                    cache_key = make_cache_key(get_session_key(config), url, data)
+                    cached_response = cache.get(cache_key)
+                elif action != "get":
+                    # Invalidate before the write as well as after it, so a concurrent get can not cache the old state
+                    invalidate_cached_responses(cache, config, action, url, data, adoms)
+            if cache_key is not None and cached_response is not None:
+                cached_response["cached"] = True
+                return finish_metrics(config, metrics, cached_response)
+
+        coalesced = False
+        scopes = [(get_config(config)[0], adom) for adom in adoms]
+        if should_coalesce(action, config, params, url):
+            start = time.monotonic()
+            generation, not_before = single_flight.generation(scopes)
+            response, coalesced = single_flight.do(
+                make_cache_key(get_session_key(config), url, data),
+                lambda: run_rpc_action(action, config, params, data, url, adoms, metrics),
+                config.get("coalesce_dir") or None, generation, not_before)
+            if coalesced:
+                metrics.add_phase("coalesce", start)
+                response["coalesced"] = True
+        elif action != "get":
+            # Before the write, so gets started during it do not join older flights, and after it, so gets started
+            # after it do not join flights started during it
+            record_writes(scopes)
+            try:
+                response = run_rpc_action(action, config, params, data, url, adoms, metrics)
+            finally:
+                record_writes(scopes)
+        else:
+            response = run_rpc_action(action, config, params, data, url, adoms, metrics)
+        if cache is not None:
+            with metrics.phase("cache"):
+                # The caller that ran a coalesced get already cached its response
+                if cache_key is not None and response.get("status") == 0 and not coalesced:
+                    cache.put(cache_key, response, get_cache_ttl(config, url), get_config(config)[0], adoms[0], url)
+                elif action != "get":
+                    invalidate_cached_responses(cache, config, action, url, data, adoms)
+        return finish_metrics(config, metrics, response)
+    except Exception as e:
+        metrics.record(-1)
+        raise ConnectorError(e)
 
-            # Lock the ADOM if the action is not a get or execute and the lock context uses the workspace
-            if action not in ["get"] and fmg._lock_ctx.uses_workspace:
-                if not lock_adom(fmg, adom, url, data):
-                    raise ConnectorError(f"Failed to lock ADOM: {adom}")
 
+def should_coalesce(action: str, config: dict, params: dict, url: str) -> bool:
+    """
+    Only plain gets are coalesced, when coalesce_reads is enabled. Gets inside a transaction can see its uncommitted
+    changes, and bypass_cache asks for a fresh read.
+    """
+    return action == "get" and bool(url) and config.get("coalesce_reads", False) and \
+        not params.get("transaction_id") and not params.get("bypass_cache", False)
+
+
+def record_writes(scopes: list):
+    """
+    Start a new write generation for every (server, ADOM) in scopes, see SingleFlight.
+    """
+    for scope in scopes:
+        single_flight.record_write(scope)
+
+
+def finish_metrics(config: dict, metrics: RequestMetrics, response: dict) -> dict:
+    """
+    Record the metrics of an action, and attach them to its response when include_metrics is set in the config.
+    """
+    metrics.record(response.get("status"))
+    if config.get("include_metrics", False):
+        response["metrics"] = metrics.as_dict()
+    return response
+
+
+def invalidate_cached_responses(cache, config: dict, action: str, url: str, data: dict, adoms: list):
+    server = get_config(config)[0]
+    urls = get_touched_urls(action, url, data)
+    for adom in adoms:
+        cache.invalidate(server, adom, urls)
+
+
+def run_rpc_action(action: str, config: dict, params: dict, data: dict, url: str, adoms: list,
+                   metrics: Union[RequestMetrics, None] = None) -> dict:
+    """
+    Run action on a pooled session, locking and committing every ADOM it touches around writes. Inside a workspace
+    transaction, the transaction session and its ADOM locks are used, and the commit is left to the transaction.
+    """
+    metrics = metrics or RequestMetrics(action)
+    transaction = transaction_manager.get(params["transaction_id"]) if params.get("transaction_id") else None
+    session_start = time.monotonic()
+    with (transaction.session() if transaction else fmg_session(config)) as fmg:
+        metrics.add_phase("session", session_start)
+        metrics.track_session(fmg)
+        action_func = getattr(fmg, action)
+        response = {}
+
+        # Lock the ADOMs if the action is not a get and the lock context uses the workspace
+        locks = []
+        try:
+            if action not in ["get"] and fmg._lock_ctx.uses_workspace:
+                response["lock_wait_time"] = 0
+                # Locks are always taken in sorted ADOM order so two multi ADOM requests can not deadlock each other
+                payload = summarize(data, config)
+                with metrics.phase("lock"):
+                    for adom in sorted(adoms):
+                        if transaction:
+                            lock = transaction.lock(adom, url, payload)
+                        else:
+                            lock = lock_adom(fmg, adom, url, payload, BackoffStrategy(parse_lock_timeout(config)))
+                            locks.append(lock)
+                        metrics.lock_attempts += lock.attempts
+                        response["lock_wait_time"] = round(response["lock_wait_time"] + lock.wait_time, 3)
+                        if not lock:
+                            raise ConnectorError(f"Failed to lock ADOM: {adom}")
+
+            with metrics.phase("rpc"):
                 if action == "free_form":
                     method = params.get("method")
-                    status, action_response = action_func(method, **data)
-                else:
-                    status, action_response = action_func(url=url, **data)
-            else:
-                if action == "free_form":
-                    method = params.get("method")
-                    status, action_response = action_func(method, **data)
+                    status, action_response = call_with_relogin(fmg, action_func, method, **data)
                 else:
-                    status, action_response = action_func(url=url, **data)
+                    status, action_response = call_with_relogin(fmg, action_func, url=url, **data)
 
             if fmg._lock_ctx.uses_workspace and action != "get":
-                fmg.commit_changes(adom)
-                # Consider unlocking the adom here, but not sure if it's safe to do so if there is a task to track
-                # Not unlocking here could potentially cause delays in other workers that need to lock the same adom
+                with metrics.phase("commit"):
+                    commit_or_defer(fmg, adoms, transaction)
 
             response[f"{action}_response"] = action_response
             # If the action is execute and track_task is set to True, track the task
@@ -214,21 +460,69 @@ def perform_rpc_action(action: str, config: dict, params: dict) -> dict:
             if action == 'execute' and params.get("track_task", False) and isinstance(action_response, dict):
                 task = action_response.get('task') or action_response.get('taskid')
                 track_task_params = parse_track_task_params(params)
-                status, task_response = fmg.track_task(task, **track_task_params)
+                if params.get("track_task_in_background", False):
+                    # Hand the task to the shared poller and return right away with a handle to query it
+                    tracked = task_tracker.watch(
+                        task, get_session_key(config), lambda: fmg_session(config),
+                        callback=lambda t, result: handle_background_task_done(config, url, data, t, result),
+                        **track_task_params)
+                    response["task_handle"] = {"handle": tracked.handle, "task": task}
+                    response["status"] = status
+                    logger.debug("%s action response: %s", action, summarize(response, config))
+                    return response
+                with metrics.phase("track_task"):
+                    status, task_response = fmg.track_task(task, **track_task_params)
                 response["task_response"] = task_response
 
                 # Handle special cases. Putting this here because the task needs to be tracked first for exec actions
-                special_case_result = handle_special_cases(fmg, url, data, action_response, task_response)
+                with metrics.phase("special_case"):
+                    special_case_result = handle_special_cases(fmg, url, data, action_response, task_response)
                 if special_case_result:
                     response["special_case_response"] = special_case_result
 
                 # I'm not sure if we need to commit changes here after the task is tracked, but leaving it here for now
                 if fmg._lock_ctx.uses_workspace:
-                    fmg.commit_changes(adom)
-                    fmg.unlock_adom(adom)
+                    with metrics.phase("commit"):
+                        commit_or_defer(fmg, adoms, transaction)
+        finally:
+            # Release the ADOMs as soon as the action is done so workers queued on them are not delayed. Transactions
+            # keep their locks until they end
+            if locks:
+                with metrics.phase("unlock"):
+                    for lock in locks:
+                        unlock_adom(fmg, lock)
+            metrics.collect_session(fmg)
+
+        response["status"] = status
+        logger.debug("%s action response: %s", action, summarize(response, config))
+        return response
+
+
+def commit_or_defer(fmg, adoms: list, transaction=None):
+    for adom in sorted(adoms):
+        if transaction is not None:
+            transaction.record_write(adom)
+        else:
+            fmg.commit_changes(adom)
 
-            response["status"] = status
-            logger.debug(response)
-            return response
-    except Exception as e:
-        raise ConnectorError(e)
+
+def begin_transaction(config: dict, params: dict) -> dict:
+    """
+    Open a workspace transaction. Writes passing the returned transaction_id share one session and its ADOM locks,
+    and are committed together.
+    """
+    transaction = transaction_manager.begin(get_session_key(config), lambda: open_session(config),
+                                            parse_idle_ttl(config), parse_lock_timeout(config),
+                                            **parse_transaction_params(params))
+    logger.debug(f"Opened transaction {transaction.transaction_id}")
+    return {"transaction_id": transaction.transaction_id, "status": 0}
+
+
+def end_transaction(params: dict) -> dict:
+    """
+    Commit, or discard when commit is False, the pending writes of a transaction and unlock its ADOMs.
+    """
+    transaction_id = params.get("transaction_id")
+    if isinstance(transaction_id, dict):
+        transaction_id = transaction_id.get("transaction_id")
+    return transaction_manager.end(transaction_id, params.get("commit", True))
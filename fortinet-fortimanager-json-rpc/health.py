@@ -0,0 +1,128 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import threading
+import time
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .generic_json_rpc import fmg_session, call_with_relogin, get_session_key
+from .metrics import metrics_registry
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Seconds a successful probe is reused for before the server is probed again
+DEFAULT_HEALTH_CACHE_WINDOW = 30
+# Seconds before the first retry of an unreachable server, doubled after every failed probe
+HEALTH_BACKOFF_BASE = 5
+# Upper bound in seconds of the wait between two probes of an unreachable server
+MAX_HEALTH_BACKOFF = 300
+
+
+class HealthState:
+    __slots__ = ("result", "checked_at", "failures", "next_probe", "error", "lock")
+
+    def __init__(self):
+        self.result = None
+        self.checked_at = 0.0
+        self.failures = 0
+        self.next_probe = 0.0
+        self.error = None
+        self.lock = threading.Lock()
+
+
+class HealthChecker:
+    """
+    Health probes that reuse a pooled session, serve the last successful probe for a short window, and back off
+    exponentially from servers that keep failing, so platform health polling does not turn into a login storm.
+    """
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _state(self, key) -> HealthState:
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = HealthState()
+            return state
+
+    def check(self, config: dict) -> dict:
+        state = self._state(get_session_key(config))
+        window = parse_health_cache_window(config)
+        # One probe per server at a time, concurrent checks wait for it and share its result
+        with state.lock:
+            now = time.monotonic()
+            if state.result is not None and now - state.checked_at < window:
+                return dict(state.result, cached=True, age=round(now - state.checked_at, 3))
+            if state.failures and now < state.next_probe:
+                raise ConnectorError(f"{state.error} - Last {state.failures} health probes failed, next probe in "
+                                     f"{state.next_probe - now:.0f}s")
+            try:
+                result = probe(config)
+            except Exception as e:
+                state.result = None
+                state.failures += 1
+                state.error = str(e)
+                backoff = min(HEALTH_BACKOFF_BASE * 2 ** (state.failures - 1), MAX_HEALTH_BACKOFF)
+                state.next_probe = time.monotonic() + backoff
+                logger.warning(f"Health probe failed {state.failures} times, next probe in {backoff}s: {e}")
+                raise
+            state.result = result
+            state.checked_at = time.monotonic()
+            state.failures = 0
+            state.error = None
+            return dict(result, cached=False, age=0)
+
+    def reset(self, config: Union[dict, None] = None):
+        """
+        Forget the cached probes and backoff of config's server, or of every server.
+        """
+        with self._lock:
+            if config is None:
+                self._states.clear()
+            else:
+                self._states.pop(get_session_key(config), None)
+
+
+health_checker = HealthChecker()
+
+
+def parse_health_cache_window(config: dict) -> float:
+    window = config.get("health_cache_window")
+    if window in (None, ""):
+        return DEFAULT_HEALTH_CACHE_WINDOW
+    try:
+        return max(float(window), 0)
+    except (TypeError, ValueError):
+        return DEFAULT_HEALTH_CACHE_WINDOW
+
+
+def probe(config: dict) -> dict:
+    """
+    Read /sys/status with a pooled session, timing the round trip of the request itself.
+    """
+    with fmg_session(config) as fmg:
+        start = time.monotonic()
+        status, response = call_with_relogin(fmg, fmg.get, "/sys/status")
+        latency = time.monotonic() - start
+    if status != 0 or not response:
+        raise ConnectorError(f"Unexpected response from /sys/status: {status} {response}")
+    metrics_registry.observe("health_probe_seconds", latency, "Round trip time of health probes")
+    logger.info(f"Health probe succeeded in {latency:.3f}s")
+    return {
+        "status": 0,
+        "latency": round(latency, 6),
+        "hostname": response.get("Hostname"),
+        "version": response.get("Version")
+    }
+
+
+def check_health(config: dict) -> dict:
+    return health_checker.check(config)
@@ -0,0 +1,203 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from typing import Callable, Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .generic_json_rpc import (fmg_session, call_with_relogin, get_session_key, parse_data, parse_task_timeout,
+                               perform_rpc_action)
+from .task_tracker import task_tracker
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+INSTALL_URL = "/securityconsole/install/package"
+PREVIEW_URL = "/securityconsole/install/preview"
+PREVIEW_RESULT_URL = "/securityconsole/preview/result"
+# Whether each mode runs the preview and the install stage
+INSTALL_MODES = {
+    "Preview and Install": (True, True),
+    "Preview Only": (True, False),
+    "Install Only": (False, True)
+}
+# Seconds between two progress reads of the running install tasks
+PROGRESS_INTERVAL = 2
+DEFAULT_INSTALL_TIMEOUT = 3600
+
+
+class InstallJob:
+    """
+    Preview and install of one policy package on its scope. steps() yields the id of every task the job waits on, and
+    receives back the (code, task_info) result of that task.
+    """
+
+    def __init__(self, config: dict, adom: str, package: dict, preview: bool, install: bool):
+        self.config = config
+        self.adom = adom
+        self.pkg = package.get("pkg")
+        self.scope = package.get("scope") or []
+        self.flags = package.get("flags") or ["none"]
+        self.preview = preview
+        self.install = install
+        self.result = {"pkg": self.pkg, "adom": adom, "scope": self.scope, "status": "pending"}
+        self.stage = None
+        self.tracked = None
+        self.devices = {}
+
+    def submit(self, url: str, data: dict):
+        response = perform_rpc_action("execute", self.config, {"url": url, "data": data})
+        task = response.get("execute_response")
+        task = (task.get("task") or task.get("taskid")) if isinstance(task, dict) else None
+        if response.get("status") != 0 or task is None:
+            raise ConnectorError(f"{url} did not start a task: {response.get('execute_response')}")
+        return task
+
+    def steps(self):
+        devices = [{"name": device.get("name"), "vdom": device.get("vdom", "root")} for device in self.scope]
+        if self.preview:
+            self.stage = "preview"
+            code, task_info = yield self.submit(INSTALL_URL, {"adom": self.adom, "pkg": self.pkg, "scope": self.scope,
+                                                              "flags": ["preview"]})
+            if code == 0 and not task_failed(task_info):
+                code, task_info = yield self.submit(PREVIEW_URL, {"adom": self.adom, "device": devices,
+                                                                  "flags": ["json"]})
+            preview = {"task": task_summary(task_info)}
+            if code == 0 and not task_failed(task_info):
+                with fmg_session(self.config) as fmg:
+                    status, preview["result"] = call_with_relogin(fmg, fmg.execute, PREVIEW_RESULT_URL,
+                                                                  adom=self.adom, device=devices)
+            self.result["preview"] = preview
+            if code != 0 or task_failed(task_info) or "result" not in preview:
+                raise ConnectorError("Install preview failed")
+        if self.install:
+            self.stage = "install"
+            code, task_info = yield self.submit(INSTALL_URL, {"adom": self.adom, "pkg": self.pkg, "scope": self.scope,
+                                                              "flags": self.flags})
+            self.result["install"] = {"task": task_summary(task_info)}
+            if code != 0 or task_failed(task_info):
+                raise ConnectorError("Install failed")
+        self.result["status"] = "installed" if self.install else "previewed"
+
+
+def task_failed(task_info) -> bool:
+    return not isinstance(task_info, dict) or bool(task_info.get("num_err"))
+
+
+def task_summary(task_info) -> dict:
+    """
+    Task result without the per line history, which is already reported as progress.
+    """
+    if not isinstance(task_info, dict):
+        return {"msg": str(task_info)}
+    summary = {key: value for key, value in task_info.items() if key not in ("line", "history")}
+    summary["devices"] = [device_line(line) for line in task_info.get("line") or [] if isinstance(line, dict)]
+    return summary
+
+
+def device_line(line: dict) -> dict:
+    return {key: line.get(key) for key in ("name", "vdom", "state", "percent", "err", "detail")}
+
+
+def parse_packages(packages: Union[list, str, dict, None]) -> list:
+    packages = parse_data(packages) if isinstance(packages, str) else packages
+    if isinstance(packages, dict):
+        packages = packages.get("data", [packages])
+    if not isinstance(packages, list) or not packages:
+        raise ConnectorError("Packages must be a non empty list of objects with pkg and scope")
+    for package in packages:
+        if not isinstance(package, dict) or not package.get("pkg") or not isinstance(package.get("scope"), list):
+            raise ConnectorError(f"Invalid package, expected an object with pkg and a scope list: {package}")
+    return packages
+
+
+def report_progress(jobs: list, started: float, progress: list, on_progress: Union[Callable, None] = None):
+    """
+    Log every device whose install state or percent changed since the last read, pass it to on_progress and record
+    it in progress.
+    """
+    for job in jobs:
+        task_info = job.tracked.task_info if job.tracked is not None else None
+        if not isinstance(task_info, dict):
+            continue
+        for line in task_info.get("line") or []:
+            if not isinstance(line, dict):
+                continue
+            device = f"{line.get('name')}/{line.get('vdom')}"
+            state = (line.get("state"), line.get("percent"))
+            if job.devices.get((job.tracked.task_id, device)) == state:
+                continue
+            job.devices[(job.tracked.task_id, device)] = state
+            event = {"time": round(time.monotonic() - started, 3), "pkg": job.pkg, "stage": job.stage,
+                     "device": device, "state": state[0], "percent": state[1]}
+            progress.append(event)
+            logger.info(f"Install pipeline {job.pkg} {job.stage} {device}: {state[0]} {state[1]}%")
+            if on_progress is not None:
+                on_progress(event)
+
+
+def perform_install_pipeline(config: dict, params: dict, on_progress: Union[Callable, None] = None) -> dict:
+    """
+    Preview and install many policy packages at once. Every package moves to its next stage as soon as its current
+    task is done, while the tasks of all packages are tracked together by the task tracker.
+
+    Progress events are logged and passed to on_progress as they are read. The progress list of the result is a log
+    of the same events, only available once every package is done.
+    """
+    adom = params.get("adom") or "root"
+    packages = parse_packages(params.get("packages"))
+    mode = params.get("mode") or "Preview and Install"
+    if mode not in INSTALL_MODES:
+        raise ConnectorError(f"Unknown install mode: {mode}. Expected one of {', '.join(INSTALL_MODES)}")
+    preview, install = INSTALL_MODES[mode]
+    timeout = parse_task_timeout(params.get("task_timeout"), DEFAULT_INSTALL_TIMEOUT)
+    key = get_session_key(config)
+
+    started = time.monotonic()
+    jobs = [InstallJob(config, package.get("adom") or adom, package, preview, install) for package in packages]
+    running = {}
+    progress = []
+
+    def advance(job: InstallJob, steps, result=None):
+        try:
+            task = steps.send(result)
+        except StopIteration:
+            return
+        except Exception as e:
+            job.result["status"] = "failed"
+            job.result["error"] = f"{job.stage}: {e}"
+            logger.error(f"Install pipeline {job.pkg} failed in {job.stage}: {e}")
+            return
+        job.tracked = task_tracker.watch(task, key, lambda: fmg_session(config), timeout=timeout)
+        running[job.tracked.future] = (job, steps)
+
+    for job in jobs:
+        steps = job.steps()
+        advance(job, steps)
+    while running:
+        done, _ = wait(list(running), timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+        report_progress([job for job, _ in running.values()], started, progress, on_progress)
+        for future in done:
+            job, steps = running.pop(future)
+            advance(job, steps, future.result())
+
+    results = [job.result for job in jobs]
+    devices = {}
+    for job in jobs:
+        for line in job.result.get("install", job.result.get("preview", {})).get("task", {}).get("devices", []):
+            devices[f"{line['name']}/{line['vdom']}"] = dict(line, pkg=job.pkg)
+    failed = [result["pkg"] for result in results if result["status"] == "failed"]
+    return {
+        "status": 0 if not failed else 1,
+        "mode": mode,
+        "packages": results,
+        "devices": devices,
+        "failed": failed,
+        "progress": progress,
+        "elapsed": round(time.monotonic() - started, 3)
+    }
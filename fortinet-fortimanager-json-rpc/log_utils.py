@@ -0,0 +1,71 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import hashlib
+import json
+from typing import Union
+
+# Default number of characters of a payload preview included in a log message
+DEFAULT_MAX_LOG_SIZE = 512
+# Number of characters of a serialized payload fed to the hash, so large payloads are not hashed whole
+MAX_HASHED_SIZE = 64 * 1024
+
+
+class PayloadSummary:
+    """
+    Log argument rendering a bounded summary of a payload: its type, item count, serialized size, a short hash of at
+    most MAX_HASHED_SIZE characters and a truncated preview. Nothing is serialized until the logging module formats
+    the record, so disabled log levels cost nothing, and the rendering is kept so a summary logged several times is
+    only serialized once. With trace set, the full payload is rendered instead.
+    """
+
+    __slots__ = ("payload", "max_size", "trace", "_rendered")
+
+    def __init__(self, payload, max_size: int = DEFAULT_MAX_LOG_SIZE, trace: bool = False):
+        self.payload = payload
+        self.max_size = max_size
+        self.trace = trace
+        self._rendered = None
+
+    def __str__(self):
+        if self._rendered is None:
+            self._rendered = self._render()
+        return self._rendered
+
+    def _render(self) -> str:
+        try:
+            text = self.payload if isinstance(self.payload, str) else json.dumps(self.payload, default=str)
+        except (TypeError, ValueError):
+            text = str(self.payload)
+        if self.trace:
+            return text
+        parts = [type(self.payload).__name__]
+        if isinstance(self.payload, (list, dict)):
+            parts.append(f"items={len(self.payload)}")
+        parts.append(f"size={len(text)}")
+        parts.append(f"sha256={hashlib.sha256(text[:MAX_HASHED_SIZE].encode()).hexdigest()[:12]}")
+        preview = text if len(text) <= self.max_size else text[:self.max_size] + "..."
+        return f"<{' '.join(parts)}> {preview}"
+
+    __repr__ = __str__
+
+
+def parse_max_log_size(config: Union[dict, None]) -> int:
+    try:
+        max_size = int((config or {}).get("log_max_size"))
+    except (TypeError, ValueError):
+        return DEFAULT_MAX_LOG_SIZE
+    return max(max_size, 0)
+
+
+def summarize(payload, config: Union[dict, None] = None) -> PayloadSummary:
+    """
+    Wrap payload for logging with the log_max_size and trace_payloads settings of config.
+    """
+    if isinstance(payload, PayloadSummary):
+        return payload
+    return PayloadSummary(payload, parse_max_log_size(config), bool((config or {}).get("trace_payloads", False)))
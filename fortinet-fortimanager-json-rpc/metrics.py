@@ -0,0 +1,208 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from connectors.core.connector import get_logger
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Upper bounds in seconds of the latency histogram buckets, from a fast cached get to a slow install task
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+METRIC_PREFIX = "fmg_rpc"
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    In-process registry of latency histograms and counters, labelled by action and phase, dumped in the Prometheus
+    text exposition format.
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, help_text: str = "", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+                self._help.setdefault(name, help_text)
+            histogram.observe(value)
+
+    def increment(self, name: str, value: float = 1, help_text: str = "", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._help.setdefault(name, help_text)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self) -> str:
+        """
+        Dump every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            described = set()
+            for (name, labels), histogram in histograms:
+                full_name = f"{METRIC_PREFIX}_{name}"
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {full_name} {self._help.get(name, '')}")
+                    lines.append(f"# TYPE {full_name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f"{full_name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{full_name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{full_name}_count{format_labels(labels)} {histogram.count}")
+            for (name, labels), value in counters:
+                full_name = f"{METRIC_PREFIX}_{name}"
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {full_name} {self._help.get(name, '')}")
+                    lines.append(f"# TYPE {full_name} counter")
+                lines.append(f"{full_name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+metrics_registry = MetricsRegistry()
+
+
+def instrument_session(fmg):
+    """
+    Count the bytes sent and received by a pyFMG session, read back by RequestMetrics.
+    """
+    fmg.bytes_sent = 0
+    fmg.bytes_received = 0
+    fmg.relogins = getattr(fmg, "relogins", 0)
+
+    def count_bytes(response, *args, **kwargs):
+        body = response.request.body or b""
+        # requests keeps str bodies as given, count their encoded size like the bytes on the wire
+        fmg.bytes_sent += len(body.encode("utf-8")) if isinstance(body, str) else len(body)
+        fmg.bytes_received += len(response.content or b"")
+
+    fmg.sess.hooks["response"].append(count_bytes)
+    return fmg
+
+
+class RequestMetrics:
+    """
+    Phase timings and counters of a single operation. Phases entered more than once are summed.
+    """
+
+    def __init__(self, action: str):
+        self.action = action
+        self.started = time.monotonic()
+        self.phases = {}
+        self.retries = 0
+        self.lock_attempts = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._session_counters = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, start)
+
+    def add_phase(self, name: str, start: float):
+        self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def track_session(self, fmg):
+        """
+        Start counting the retries and bytes of fmg from its current totals.
+        """
+        self._session_counters[id(fmg)] = session_counters(fmg)
+
+    def collect_session(self, fmg):
+        if id(fmg) not in self._session_counters:
+            return
+        relogins, sent, received = self._session_counters.pop(id(fmg))
+        now_relogins, now_sent, now_received = session_counters(fmg)
+        self.retries += now_relogins - relogins
+        self.bytes_sent += now_sent - sent
+        self.bytes_received += now_received - received
+
+    def as_dict(self) -> dict:
+        return {
+            "total_time": round(time.monotonic() - self.started, 6),
+            "phases": {name: round(duration, 6) for name, duration in self.phases.items()},
+            "retries": self.retries,
+            "lock_attempts": self.lock_attempts,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received
+        }
+
+    def record(self, status):
+        """
+        Add the timings and counters of this operation to the process wide registry.
+        """
+        try:
+            outcome = "success" if status == 0 else "error"
+            for name, duration in self.phases.items():
+                metrics_registry.observe("phase_duration_seconds", duration, "Time spent in each phase of an action",
+                                         action=self.action, phase=name)
+            metrics_registry.observe("request_duration_seconds", time.monotonic() - self.started,
+                                     "Total time of an action", action=self.action, outcome=outcome)
+            metrics_registry.increment("requests_total", 1, "Actions run", action=self.action, outcome=outcome)
+            metrics_registry.increment("retries_total", self.retries, "Requests retried after an expired session",
+                                       action=self.action)
+            metrics_registry.increment("lock_attempts_total", self.lock_attempts, "ADOM lock requests sent",
+                                       action=self.action)
+            metrics_registry.increment("bytes_sent_total", self.bytes_sent, "Request bytes sent to FortiManager",
+                                       action=self.action)
+            metrics_registry.increment("bytes_received_total", self.bytes_received,
+                                       "Response bytes received from FortiManager", action=self.action)
+        except Exception as e:
+            logger.debug(f"Failed to record metrics: {e}")
+
+
+def session_counters(fmg) -> tuple:
+    return getattr(fmg, "relogins", 0), getattr(fmg, "bytes_sent", 0), getattr(fmg, "bytes_received", 0)
+
+
+def get_metrics() -> dict:
+    return {"metrics": metrics_registry.render(), "status": 0}
@@ -0,0 +1,270 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .cache_backends import open_private_database, DEFAULT_DATA_DIR
+from .codec import dumps, loads
+from .generic_json_rpc import fmg_session, call_with_relogin, get_config, get_session_key, parse_data
+from .paginated_get import iter_get_pages, DEFAULT_PAGE_SIZE
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Default location of the object mirror shared by the worker processes of a node
+DEFAULT_MIRROR_PATH = os.path.join(DEFAULT_DATA_DIR, "mirror.sqlite3")
+# Seconds a mirrored table is served without asking FortiManager whether it changed
+DEFAULT_MAX_STALENESS = 300
+# Object attributes indexed besides the name, so lookups on them do not scan the table
+INDEXED_ATTRIBUTES = ("subnet", "start-ip", "end-ip", "fqdn", "wildcard", "wildcard-fqdn", "ip6", "member", "type",
+                      "uuid", "macaddr", "country")
+# Only object tables of an ADOM are mirrored
+MIRROR_URL_PATTERN = re.compile(r'^/?pm/config/adom/([^/]+)/obj/[^?]+$')
+
+
+def index_values(obj: dict) -> list:
+    """
+    (attribute, value) pairs indexed for obj, one pair per item of list attributes.
+    """
+    pairs = []
+    for attribute in INDEXED_ATTRIBUTES:
+        value = obj.get(attribute)
+        for item in value if isinstance(value, list) else [value]:
+            if isinstance(item, (str, int, float)) and not isinstance(item, bool):
+                pairs.append((attribute, str(item)))
+    return pairs
+
+
+class ObjectMirror:
+    """
+    Local sqlite copy of FortiManager object tables, indexed by object name and by INDEXED_ATTRIBUTES. Tables are
+    mirrored per server and account, the server column holding the mirror_owner of the config that read them.
+
+    A table older than the staleness bound is only read again when the table checksum FortiManager reports has
+    changed, and then only the objects that differ are rewritten in the mirror.
+    """
+
+    def __init__(self, path: str = DEFAULT_MIRROR_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._refresh_locks = {}
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not be shared with forked children, open a new one per process
+        if self._conn is None or self._pid != os.getpid():
+            conn = open_private_database(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS mirror_tables (server TEXT NOT NULL, url TEXT NOT NULL, "
+                         "adom TEXT NOT NULL, checksum TEXT, refreshed_at REAL NOT NULL, "
+                         "PRIMARY KEY (server, url))")
+            conn.execute("CREATE TABLE IF NOT EXISTS mirror_objects (server TEXT NOT NULL, url TEXT NOT NULL, "
+                         "name TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (server, url, name))")
+            conn.execute("CREATE TABLE IF NOT EXISTS mirror_attributes (server TEXT NOT NULL, url TEXT NOT NULL, "
+                         "name TEXT NOT NULL, attribute TEXT NOT NULL, value TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS mirror_attributes_value ON mirror_attributes "
+                         "(server, url, attribute, value)")
+            conn.execute("CREATE INDEX IF NOT EXISTS mirror_attributes_name ON mirror_attributes (server, url, name)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def table_state(self, server: str, url: str) -> Union[tuple, None]:
+        """
+        :return: Tuple of (checksum, refreshed_at) of a mirrored table, None if it was never mirrored
+        """
+        with self._lock:
+            return self._connection().execute("SELECT checksum, refreshed_at FROM mirror_tables WHERE server = ? AND "
+                                              "url = ?", (server, url)).fetchone()
+
+    def touch(self, server: str, url: str):
+        with self._lock:
+            self._connection().execute("UPDATE mirror_tables SET refreshed_at = ? WHERE server = ? AND url = ?",
+                                       (time.time(), server, url))
+
+    def store(self, server: str, adom: str, url: str, checksum, objects: dict) -> dict:
+        """
+        Make the mirror of a table match objects, a dict of name to object, rewriting only the objects that changed.
+
+        :return: Counts of the objects added, updated and removed
+        """
+        encoded = {name: dumps(obj) for name, obj in objects.items()}
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                stored = dict(conn.execute("SELECT name, data FROM mirror_objects WHERE server = ? AND url = ?",
+                                           (server, url)))
+                changed = [name for name, data in encoded.items() if stored.get(name) != data]
+                removed = [name for name in stored if name not in encoded]
+                stale = [(server, url, name) for name in changed + removed]
+                conn.executemany("DELETE FROM mirror_objects WHERE server = ? AND url = ? AND name = ?", stale)
+                conn.executemany("DELETE FROM mirror_attributes WHERE server = ? AND url = ? AND name = ?", stale)
+                conn.executemany("INSERT INTO mirror_objects VALUES (?, ?, ?, ?)",
+                                 [(server, url, name, encoded[name]) for name in changed])
+                conn.executemany("INSERT INTO mirror_attributes VALUES (?, ?, ?, ?, ?)",
+                                 [(server, url, name, attribute, value) for name in changed
+                                  for attribute, value in index_values(objects[name])])
+                conn.execute("INSERT OR REPLACE INTO mirror_tables VALUES (?, ?, ?, ?, ?)",
+                             (server, url, adom, None if checksum is None else str(checksum), time.time()))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        added = sum(1 for name in changed if name not in stored)
+        return {"added": added, "updated": len(changed) - added, "removed": len(removed)}
+
+    def query(self, server: str, url: str, name: Union[str, None] = None,
+              attributes: Union[dict, None] = None) -> list:
+        """
+        Mirrored objects of a table, optionally restricted to a name and to attribute values, all of which must match.
+        """
+        sql = "SELECT data FROM mirror_objects o WHERE o.server = ? AND o.url = ?"
+        args = [server, url]
+        if name is not None:
+            sql += " AND o.name = ?"
+            args.append(str(name))
+        for attribute, value in (attributes or {}).items():
+            if attribute not in INDEXED_ATTRIBUTES:
+                raise ConnectorError(f"Attribute {attribute} is not indexed. Indexed attributes: "
+                                     f"{', '.join(INDEXED_ATTRIBUTES)}")
+            sql += (" AND EXISTS (SELECT 1 FROM mirror_attributes a WHERE a.server = o.server AND a.url = o.url "
+                    "AND a.name = o.name AND a.attribute = ? AND a.value = ?)")
+            args.extend([attribute, str(value)])
+        with self._lock:
+            rows = self._connection().execute(sql + " ORDER BY o.name", args).fetchall()
+        return [loads(data) for data, in rows]
+
+    def clear(self, server: Union[str, None] = None):
+        with self._lock:
+            conn = self._connection()
+            for table in ("mirror_tables", "mirror_objects", "mirror_attributes"):
+                if server is None:
+                    conn.execute(f"DELETE FROM {table}")
+                else:
+                    conn.execute(f"DELETE FROM {table} WHERE server = ?", (server,))
+
+    def refresh_lock(self, server: str, url: str) -> threading.Lock:
+        with self._lock:
+            return self._refresh_locks.setdefault((server, url), threading.Lock())
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_object_mirror(config: dict) -> ObjectMirror:
+    """
+    Mirror stored at the config's mirror_path. Mirrors are shared by every config pointing at the same file.
+    """
+    path = config.get("mirror_path") or DEFAULT_MIRROR_PATH
+    with _mirrors_lock:
+        mirror = _mirrors.get(path)
+        if mirror is None:
+            mirror = _mirrors[path] = ObjectMirror(path)
+        return mirror
+
+
+def parse_max_staleness(value, default=DEFAULT_MAX_STALENESS) -> float:
+    if value in (None, ""):
+        return default
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+def mirror_owner(config: dict) -> str:
+    """
+    Server of config followed by a hash of its session key, so objects read with one account's ADOM rights are never
+    served to another account. Hashing keeps credentials out of the mirror file.
+    """
+    session_key = hashlib.sha256(dumps([str(part) for part in get_session_key(config)]).encode()).hexdigest()
+    return f"{get_config(config)[0]}#{session_key}"
+
+
+def normalize_mirror_url(url: str) -> tuple:
+    """
+    :return: Tuple of (url, adom) of an ADOM object table URL
+    """
+    match = MIRROR_URL_PATTERN.match(url or "")
+    if not match:
+        raise ConnectorError(f"Only ADOM object tables like /pm/config/adom/<adom>/obj/firewall/address can be "
+                             f"mirrored, got: {url}")
+    return "/" + url.strip("/"), match.group(1)
+
+
+def get_table_checksum(fmg, url: str):
+    status, response = call_with_relogin(fmg, fmg.get, url=url, option="chksum")
+    if status == 0 and isinstance(response, dict):
+        return response.get("chksum")
+    return None
+
+
+def refresh_table(config: dict, url: str, max_staleness: float, force: bool = False) -> dict:
+    """
+    Bring the mirror of the table at url up to date, unless it was checked less than max_staleness seconds ago.
+
+    :return: Dict describing what was done: refreshed, checksum_checked and the counts of the changed objects
+    """
+    url, adom = normalize_mirror_url(url)
+    mirror = get_object_mirror(config)
+    server = mirror_owner(config)
+    # One refresh of a table at a time per process, concurrent callers reuse its result
+    with mirror.refresh_lock(server, url):
+        state = mirror.table_state(server, url)
+        if state is not None and not force and time.time() - state[1] < max_staleness:
+            return {"refreshed": False, "checksum_checked": False, "age": round(time.time() - state[1], 3)}
+        with fmg_session(config) as fmg:
+            checksum = get_table_checksum(fmg, url)
+            if state is not None and not force and checksum is not None and str(checksum) == state[0]:
+                mirror.touch(server, url)
+                return {"refreshed": False, "checksum_checked": True, "age": 0}
+            objects = {}
+            for page in iter_get_pages(fmg, url, {}, DEFAULT_PAGE_SIZE):
+                for obj in page:
+                    if isinstance(obj, dict) and obj.get("name") is not None:
+                        objects[str(obj["name"])] = obj
+        changes = mirror.store(server, adom, url, checksum, objects)
+        logger.info(f"Mirrored {len(objects)} objects of {url}: {changes}")
+        return dict(changes, refreshed=True, checksum_checked=checksum is not None, age=0)
+
+
+def get_mirrored_objects(config: dict, url: str, max_staleness: Union[float, None] = None, name=None,
+                         attributes: Union[dict, None] = None) -> tuple:
+    """
+    Objects of the table at url read from the mirror, refreshed first if it is older than max_staleness seconds.
+
+    :return: Tuple of (objects, refresh result)
+    """
+    if max_staleness is None:
+        max_staleness = parse_max_staleness(config.get("mirror_max_staleness"))
+    refresh = refresh_table(config, url, max_staleness)
+    url, _ = normalize_mirror_url(url)
+    return get_object_mirror(config).query(mirror_owner(config), url, name, attributes), refresh
+
+
+def perform_mirror_query(config: dict, params: dict) -> dict:
+    attributes = parse_data(params.get("attributes") or {})
+    if not isinstance(attributes, dict):
+        raise ConnectorError("Attributes must be an object of attribute name to value")
+    url = params.get("url")
+    if params.get("force_refresh", False):
+        refresh_table(config, url, 0, force=True)
+    max_staleness = params.get("max_staleness")
+    objects, refresh = get_mirrored_objects(config, url, None if max_staleness in (None, "") else
+                                            parse_max_staleness(max_staleness), params.get("name") or None,
+                                            attributes)
+    return {"objects": objects, "count": len(objects), "mirror": refresh, "status": 0}
@@ -0,0 +1,163 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .address_index import parse_ip_pair
+from .bulk_rpc import perform_bulk_action, parse_chunk_size
+from .generic_json_rpc import fmg_session, parse_data
+from .paginated_get import iter_get_pages, parse_page_size
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Field identifying the objects of a table when no key is given
+DEFAULT_SYNC_KEY = "name"
+# Fields holding an IPv4 address and mask, which FortiManager accepts as [ip, mask], "ip mask" or "ip/prefix"
+IP_PAIR_FIELDS = ("subnet", "wildcard")
+
+
+def parse_desired_objects(objects: Union[list, str, dict, None], key: str) -> dict:
+    """
+    :return: Dict of key value to desired object, in the given order
+    """
+    objects = parse_data(objects) if isinstance(objects, str) else objects
+    if isinstance(objects, dict):
+        objects = objects.get("data", [objects])
+    if not isinstance(objects, list):
+        raise ConnectorError("Objects must be a list of objects")
+    desired = {}
+    for index, obj in enumerate(objects):
+        if not isinstance(obj, dict) or obj.get(key) in (None, ""):
+            raise ConnectorError(f"Object {index} must be a dict with a {key} field")
+        if obj[key] in desired:
+            raise ConnectorError(f"Duplicate {key} in objects: {obj[key]}")
+        desired[obj[key]] = obj
+    return desired
+
+
+def normalize_value(value, field: Union[str, None] = None):
+    """
+    Comparable form of a field value. FortiManager returns single members as one item lists and does not keep the
+    order of member lists, so scalars and lists of scalars are compared as sorted lists. Addresses and masks of
+    IP_PAIR_FIELDS are compared as integers, whichever form they are given in.
+    """
+    if field in IP_PAIR_FIELDS:
+        pair = parse_ip_pair(value)
+        if pair is not None:
+            return pair
+    if isinstance(value, dict):
+        return {nested_field: normalize_value(nested, nested_field) for nested_field, nested in value.items()}
+    if isinstance(value, list):
+        normalized = [normalize_value(item) for item in value]
+        if all(not isinstance(item, (dict, list)) for item in normalized):
+            return sorted(normalized, key=str)
+        return normalized
+    return [value]
+
+
+def diff_object(current: dict, desired: dict) -> dict:
+    """
+    Fields of desired whose value differs from current. Fields FortiManager returns but desired does not set are left
+    alone.
+
+    :return: Dict of field to {"current": value, "desired": value}
+    """
+    changes = {}
+    for field, value in desired.items():
+        if normalize_value(current.get(field), field) != normalize_value(value, field):
+            changes[field] = {"current": current.get(field), "desired": value}
+    return changes
+
+
+def diff_objects(current: dict, desired: dict, delete_missing: bool) -> dict:
+    added = [name for name in desired if name not in current]
+    updated = []
+    unchanged = 0
+    for name, obj in desired.items():
+        if name not in current:
+            continue
+        changes = diff_object(current[name], obj)
+        if changes:
+            updated.append({"name": name, "changes": changes})
+        else:
+            unchanged += 1
+    deleted = [name for name in current if name not in desired] if delete_missing else []
+    return {"added": added, "updated": updated, "deleted": deleted, "unchanged": unchanged}
+
+
+def object_url(url: str, name) -> str:
+    # Slashes in object names are escaped in FortiManager URLs
+    escaped = str(name).replace("/", "\\/")
+    return f"{url.rstrip('/')}/{escaped}"
+
+
+def fetch_current_objects(config: dict, url: str, key: str, fields: Union[list, None], page_size: int) -> dict:
+    """
+    Objects of the table at url by key. They are always read with verbose output, whatever the verbose_json setting,
+    so enum fields come back as the names desired objects are written with rather than as integers.
+    """
+    current = {}
+    with fmg_session(config) as fmg:
+        verbose = fmg.verbose
+        fmg.verbose = True
+        try:
+            for page in iter_get_pages(fmg, url, {}, page_size, fields):
+                for obj in page:
+                    if isinstance(obj, dict) and key in obj:
+                        current[obj[key]] = obj
+        finally:
+            fmg.verbose = verbose
+    return current
+
+
+def perform_sync(config: dict, params: dict) -> dict:
+    """
+    Bring the table at url to the desired objects, writing only what differs. The current objects are read in pages,
+    restricted to the fields the desired objects set, and the adds, sets and deletes are sent as one bulk action under
+    a single lock and commit per ADOM.
+    """
+    url = params.get("url")
+    if not url:
+        raise ConnectorError("Missing required parameter: url")
+    key = params.get("key") or DEFAULT_SYNC_KEY
+    desired = parse_desired_objects(params.get("objects"), key)
+    delete_missing = params.get("delete_missing", False)
+    dry_run = params.get("dry_run", False)
+
+    fields = sorted({field for obj in desired.values() for field in obj} | {key})
+    current = fetch_current_objects(config, url, key, fields, parse_page_size(params.get("page_size")))
+    diff = diff_objects(current, desired, delete_missing)
+
+    writes = [("add", name) for name in diff["added"]] + [("set", change["name"]) for change in diff["updated"]] + \
+        [("delete", name) for name in diff["deleted"]]
+    items = [{"method": method, "url": object_url(url, name)} if method == "delete" else
+             {"method": method, "url": url, "data": desired[name]} for method, name in writes]
+    response = {
+        "diff": diff,
+        "summary": {"added": len(diff["added"]), "updated": len(diff["updated"]), "deleted": len(diff["deleted"]),
+                    "unchanged": diff["unchanged"], "current": len(current), "desired": len(desired)},
+        "dry_run": bool(dry_run),
+        "status": 0
+    }
+    logger.info(f"Sync of {url}: {response['summary']}")
+    if dry_run or not items:
+        return response
+
+    bulk_response = perform_bulk_action(config, {"items": items,
+                                                 "chunk_size": parse_chunk_size(params.get("chunk_size"))})
+    failed = [result for result in bulk_response["bulk_response"] if result["status"] != 0]
+    response.update({
+        "failed": [{"method": result["method"], "name": writes[result["index"]][1], "status": result["status"],
+                    "message": result["message"]} for result in failed],
+        "requests": bulk_response["requests"],
+        "status": bulk_response["status"]
+    })
+    if "lock_wait_time" in bulk_response:
+        response["lock_wait_time"] = bulk_response["lock_wait_time"]
+    return response
@@ -6,17 +6,26 @@ Copyright end
 """
 
 from connectors.core.connector import get_logger, ConnectorError
-from .generic_json_rpc import perform_rpc_action
+from .address_index import perform_address_lookup
+from .async_rpc import async_perform_rpc_action
+from .bulk_rpc import perform_bulk_action
+from .fanout import perform_fanout_action
+from .generic_json_rpc import perform_rpc_action, begin_transaction, end_transaction
+from .health import check_health
+from .install_pipeline import perform_install_pipeline
+from .metrics import get_metrics
+from .object_mirror import perform_mirror_query
+from .object_sync import perform_sync
+from .paginated_get import perform_paginated_get
+from .task_tracker import get_task_result
+from .write_queue import perform_write_action
 
 logger = get_logger('fortinet-fortimanager-json-rpc')
 
 
-def _check_health(config: dict) -> bool:
-    params = {"url": "/sys/status", "data": {}}
+def _check_health(config: dict) -> dict:
     try:
-        response = perform_rpc_action("get", config, params)
-        if response['get_response']:
-            return True
+        return check_health(config)
     except Exception as e:
         raise ConnectorError(str(e) + " - Unable to get system status")
 
@@ -24,7 +33,7 @@ def _check_health(config: dict) -> bool:
 def json_rpc_add(config: dict, params: dict) -> dict:
     action = "add"
     try:
-        response = perform_rpc_action(action, config, params)
+        response = perform_write_action(action, config, params)
         return response
     except Exception as e:
         raise ConnectorError(str(e))
@@ -33,7 +42,7 @@ def json_rpc_add(config: dict, params: dict) -> dict:
 def json_rpc_set(config: dict, params: dict) -> dict:
     action = "set"
     try:
-        response = perform_rpc_action(action, config, params)
+        response = perform_write_action(action, config, params)
         return response
     except Exception as e:
         raise ConnectorError(str(e))
@@ -60,7 +69,7 @@ def json_rpc_execute(config: dict, params: dict) -> dict:
 def json_rpc_delete(config: dict, params: dict) -> dict:
     action = "delete"
     try:
-        response = perform_rpc_action(action, config, params)
+        response = perform_write_action(action, config, params)
         return response
     except Exception as e:
         raise ConnectorError(str(e))
@@ -75,6 +84,136 @@ def json_rpc_freeform(config: dict, params: dict) -> dict:
         raise ConnectorError(str(e))
 
 
+def json_rpc_bulk(config: dict, params: dict) -> dict:
+    try:
+        response = perform_bulk_action(config, params)
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+def json_rpc_fanout(config: dict, params: dict) -> dict:
+    try:
+        response = perform_fanout_action(config, params)
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+def json_rpc_get_paginated(config: dict, params: dict) -> dict:
+    try:
+        response = perform_paginated_get(config, params)
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+def json_rpc_sync(config: dict, params: dict) -> dict:
+    try:
+        response = perform_sync(config, params)
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+def json_rpc_mirror_query(config: dict, params: dict) -> dict:
+    try:
+        response = perform_mirror_query(config, params)
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+def json_rpc_address_lookup(config: dict, params: dict) -> dict:
+    try:
+        response = perform_address_lookup(config, params)
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+def json_rpc_install_packages(config: dict, params: dict) -> dict:
+    try:
+        response = perform_install_pipeline(config, params)
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+def json_rpc_get_task_result(config: dict, params: dict) -> dict:
+    try:
+        response = get_task_result(params)
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+def json_rpc_begin_transaction(config: dict, params: dict) -> dict:
+    try:
+        response = begin_transaction(config, params)
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+def json_rpc_end_transaction(config: dict, params: dict) -> dict:
+    try:
+        response = end_transaction(params)
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+def json_rpc_get_metrics(config: dict, params: dict) -> dict:
+    try:
+        response = get_metrics()
+        return response
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+async def async_json_rpc_add(config: dict, params: dict) -> dict:
+    try:
+        return await async_perform_rpc_action("add", config, params)
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+async def async_json_rpc_set(config: dict, params: dict) -> dict:
+    try:
+        return await async_perform_rpc_action("set", config, params)
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+async def async_json_rpc_get(config: dict, params: dict) -> dict:
+    try:
+        return await async_perform_rpc_action("get", config, params)
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+async def async_json_rpc_execute(config: dict, params: dict) -> dict:
+    try:
+        return await async_perform_rpc_action("execute", config, params)
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+async def async_json_rpc_delete(config: dict, params: dict) -> dict:
+    try:
+        return await async_perform_rpc_action("delete", config, params)
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
+async def async_json_rpc_freeform(config: dict, params: dict) -> dict:
+    try:
+        return await async_perform_rpc_action("free_form", config, params)
+    except Exception as e:
+        raise ConnectorError(str(e))
+
+
 operations = {
     'json_rpc_add': json_rpc_add,
     'json_rpc_set': json_rpc_set,
@@ -82,5 +221,26 @@ operations = {
     'json_rpc_execute': json_rpc_execute,
     'json_rpc_delete': json_rpc_delete,
     'json_rpc_freeform': json_rpc_freeform,
+    'json_rpc_bulk': json_rpc_bulk,
+    'json_rpc_fanout': json_rpc_fanout,
+    'json_rpc_get_paginated': json_rpc_get_paginated,
+    'json_rpc_sync': json_rpc_sync,
+    'json_rpc_mirror_query': json_rpc_mirror_query,
+    'json_rpc_address_lookup': json_rpc_address_lookup,
+    'json_rpc_install_packages': json_rpc_install_packages,
+    'json_rpc_get_task_result': json_rpc_get_task_result,
+    'json_rpc_begin_transaction': json_rpc_begin_transaction,
+    'json_rpc_end_transaction': json_rpc_end_transaction,
+    'json_rpc_get_metrics': json_rpc_get_metrics,
     'check_health': _check_health
 }
+
+# asyncio entry points for callers that run their own event loop, e.g. to keep many calls and lock waits in flight
+async_operations = {
+    'json_rpc_add': async_json_rpc_add,
+    'json_rpc_set': async_json_rpc_set,
+    'json_rpc_get': async_json_rpc_get,
+    'json_rpc_execute': async_json_rpc_execute,
+    'json_rpc_delete': async_json_rpc_delete,
+    'json_rpc_freeform': async_json_rpc_freeform
+}
@@ -0,0 +1,250 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import json
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .codec import dumps
+from .generic_json_rpc import fmg_session, call_with_relogin, parse_data
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Number of rows requested per page when no page size is given
+DEFAULT_PAGE_SIZE = 1000
+# Upper bound on the number of pages fetched at the same time
+MAX_CONCURRENCY = 16
+OUTPUT_MODE_INLINE = "Inline"
+OUTPUT_MODE_JSONL = "JSONL File"
+
+
+def parse_page_size(page_size, default=DEFAULT_PAGE_SIZE) -> int:
+    try:
+        page_size = int(page_size)
+    except (TypeError, ValueError):
+        return default
+    return page_size if page_size > 0 else default
+
+
+def parse_concurrency(concurrency, default=1) -> int:
+    try:
+        concurrency = int(concurrency)
+    except (TypeError, ValueError):
+        return default
+    return min(max(concurrency, 1), MAX_CONCURRENCY)
+
+
+def parse_fields(fields: Union[list, str, None]) -> Union[list, None]:
+    """
+    Parse the fields projection, either a list or a comma separated string of field names.
+    """
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(",")]
+    if not isinstance(fields, list):
+        raise ConnectorError(f"Unexpected fields type: {type(fields)}. Please pass a list or comma separated string.")
+    return [field for field in fields if field]
+
+
+def parse_filter(filter_value: Union[list, str, None]) -> Union[list, None]:
+    if not filter_value:
+        return None
+    if isinstance(filter_value, str):
+        try:
+            filter_value = json.loads(filter_value)
+        except json.JSONDecodeError as e:
+            raise ConnectorError(f"Could not parse filter JSON: {e}")
+    if not isinstance(filter_value, list):
+        raise ConnectorError(f"Unexpected filter type: {type(filter_value)}. Please pass a list.")
+    return filter_value
+
+
+def build_get_data(data: dict, fields: Union[list, None] = None, filter_value: Union[list, None] = None) -> dict:
+    """
+    Merge the fields and filter projection into the get data, without the paging options.
+    """
+    get_data = {key: value for key, value in data.items() if key not in ("range", "option")}
+    if fields:
+        get_data["fields"] = fields
+    if filter_value:
+        get_data["filter"] = filter_value
+    return get_data
+
+
+def get_page(fmg, url: str, get_data: dict, offset: int, page_size: int) -> list:
+    """
+    Fetch the rows in [offset, offset + page_size) of the table at url.
+    """
+    status, page = call_with_relogin(fmg, fmg.get, url=url, range=[offset, page_size], **get_data)
+    if status != 0:
+        message = page.get("status", {}).get("message") if isinstance(page, dict) else page
+        raise ConnectorError(f"Failed to get rows {offset} to {offset + page_size} of {url}. "
+                             f"Status: {status} {message}")
+    # pyFMG returns the bare result, holding only the status and url, when the page has no data
+    if page is None or (isinstance(page, dict) and set(page) <= {"status", "url"}):
+        return []
+    if not isinstance(page, list):
+        raise ConnectorError(f"URL {url} does not return a table and can not be paginated")
+    return page
+
+
+def iter_get_pages(fmg, url: str, data: dict, page_size: int = DEFAULT_PAGE_SIZE, fields: Union[list, None] = None,
+                   filter_value: Union[list, None] = None):
+    """
+    Yield the table at url one page of rows at a time using the JSON-RPC range option.
+    """
+    get_data = build_get_data(data, fields, filter_value)
+    offset = 0
+    while True:
+        page = get_page(fmg, url, get_data, offset, page_size)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def get_row_count(fmg, url: str, get_data: dict) -> int:
+    """
+    Ask FortiManager for the number of rows of the table at url matching the filter, without transferring them.
+    """
+    count_data = {key: value for key, value in get_data.items() if key != "fields"}
+    status, count = call_with_relogin(fmg, fmg.get, url=url, option="count", **count_data)
+    if status != 0:
+        raise ConnectorError(f"Failed to count rows of {url}. Status: {status}")
+    if isinstance(count, dict):
+        count = count.get("count", count.get("data"))
+    try:
+        return int(count)
+    except (TypeError, ValueError):
+        raise ConnectorError(f"URL {url} did not return a row count and can not be fetched in parallel")
+
+
+def fetch_page(config: dict, url: str, get_data: dict, offset: int, page_size: int) -> list:
+    with fmg_session(config) as fmg:
+        return get_page(fmg, url, get_data, offset, page_size)
+
+
+def iter_get_pages_parallel(config: dict, url: str, data: dict, page_size: int = DEFAULT_PAGE_SIZE,
+                            fields: Union[list, None] = None, filter_value: Union[list, None] = None,
+                            concurrency: int = 4):
+    """
+    Yield the table at url one page at a time, in order, while up to concurrency pages are fetched at the same time
+    over pooled sessions. The row count is requested first to plan the pages, and at most twice concurrency pages
+    are held in memory waiting for the pages ahead of them.
+    """
+    get_data = build_get_data(data, fields, filter_value)
+    with fmg_session(config) as fmg:
+        total = get_row_count(fmg, url, get_data)
+    offsets = iter(range(0, total, page_size))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            for offset in offsets:
+                pending.append(executor.submit(fetch_page, config, url, get_data, offset, page_size))
+                if len(pending) >= concurrency * 2:
+                    break
+            last_page = None
+            while pending:
+                last_page = pending.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(fetch_page, config, url, get_data, offset, page_size))
+                if last_page:
+                    yield last_page
+        finally:
+            for future in pending:
+                future.cancel()
+
+    # Rows added after the count was taken are picked up sequentially
+    if total and len(last_page or []) == page_size:
+        offset = -(-total // page_size) * page_size
+        with fmg_session(config) as fmg:
+            while True:
+                page = get_page(fmg, url, get_data, offset, page_size)
+                if page:
+                    yield page
+                if len(page) < page_size:
+                    return
+                offset += page_size
+
+
+def spool_pages(pages, output_file: Union[str, None] = None) -> tuple:
+    """
+    Write rows to a JSONL file as the pages arrive, so only one page is held in memory at a time.
+
+    :return: Tuple of (output file path, number of rows, number of pages)
+    """
+    if output_file:
+        handle = open(output_file, "w")
+    else:
+        fd, output_file = tempfile.mkstemp(prefix="fmg_get_", suffix=".jsonl")
+        handle = os.fdopen(fd, "w")
+    rows = page_count = 0
+    with handle:
+        for page in pages:
+            page_count += 1
+            for row in page:
+                handle.write(dumps(row))
+                handle.write("\n")
+            rows += len(page)
+    return output_file, rows, page_count
+
+
+def collect_pages(pages, output_mode: str, params: dict, response: dict) -> tuple:
+    """
+    Spool or accumulate pages into response according to the output mode.
+
+    :return: Tuple of (number of rows, number of pages)
+    """
+    if output_mode == OUTPUT_MODE_JSONL:
+        output_file, rows, page_count = spool_pages(pages, params.get("output_file"))
+        response["output_file"] = output_file
+        return rows, page_count
+    get_response = []
+    page_count = 0
+    for page in pages:
+        page_count += 1
+        get_response.extend(page)
+    response["get_response"] = get_response
+    return len(get_response), page_count
+
+
+def perform_paginated_get(config: dict, params: dict) -> dict:
+    url = params.get("url")
+    if not url:
+        raise ConnectorError("URL is required")
+    data = parse_data(params.get("data", {}))
+    page_size = parse_page_size(params.get("page_size"))
+    fields = parse_fields(params.get("fields"))
+    filter_value = parse_filter(params.get("filter"))
+    output_mode = params.get("output_mode") or OUTPUT_MODE_INLINE
+    concurrency = parse_concurrency(params.get("concurrency"))
+    response = {}
+    try:
+        if concurrency > 1:
+            rows, page_count = collect_pages(
+                iter_get_pages_parallel(config, url, data, page_size, fields, filter_value, concurrency),
+                output_mode, params, response)
+        else:
+            with fmg_session(config) as fmg:
+                rows, page_count = collect_pages(iter_get_pages(fmg, url, data, page_size, fields, filter_value),
+                                                 output_mode, params, response)
+    except ConnectorError:
+        raise
+    except Exception as e:
+        raise ConnectorError(e)
+    response.update({"rows": rows, "pages": page_count, "page_size": page_size, "concurrency": concurrency,
+                     "status": 0})
+    logger.debug(f"Paginated get of {url} returned {rows} rows in {page_count} pages")
+    return response
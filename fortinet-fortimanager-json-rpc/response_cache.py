@@ -0,0 +1,124 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import hashlib
+import json
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .cache_backends import CacheBackend, get_cache_backend
+from .codec import dumps, loads
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Seconds a cached get response is served for when no TTL prefix matches its URL
+DEFAULT_CACHE_TTL = 60
+
+
+class ResponseCache:
+    """
+    Cache of get responses on top of a CacheBackend.
+
+    Responses are stored serialized, so every hit returns a fresh copy that callers can modify freely.
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Union[dict, None]:
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return loads(value)
+
+    def put(self, key: str, value: dict, ttl: float, server: str, adom: str, url: str):
+        self.backend.set(key, dumps(value), ttl, server, adom, normalize_url(url))
+
+    def invalidate(self, server: str, adom: str, urls: list) -> int:
+        """
+        Drop the cached responses of server that read from adom, or whose URL is a prefix of, or prefixed by, one of
+        urls.
+
+        :return: Number of responses dropped
+        """
+        dropped = self.backend.invalidate(server, adom, [normalize_url(url) for url in urls if url])
+        if dropped:
+            logger.debug(f"Invalidated {dropped} cached responses for ADOM: {adom}")
+        return dropped
+
+    def clear(self):
+        self.backend.clear()
+
+    def __len__(self):
+        return len(self.backend)
+
+
+response_cache = ResponseCache(get_cache_backend({}))
+_response_caches = {id(response_cache.backend): response_cache}
+
+
+def normalize_url(url: str) -> str:
+    return "/" + url.strip("/") + "/"
+
+
+def make_cache_key(session_key: tuple, url: str, data: dict) -> str:
+    """
+    Hash of the session key, normalized URL and normalized data. Hashing keeps credentials out of the key.
+    """
+    normalized = json.dumps([list(session_key), normalize_url(url), data], sort_keys=True, default=str)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def parse_cache_ttls(config: dict) -> dict:
+    """
+    Parse the per URL prefix TTLs from the config, a json object of URL prefix to seconds. The "default" key sets the
+    TTL of URLs that match no prefix.
+    """
+    ttls = config.get("cache_ttls") or {}
+    if isinstance(ttls, str):
+        try:
+            ttls = json.loads(ttls)
+        except json.JSONDecodeError as e:
+            raise ConnectorError(f"Could not parse cache TTLs JSON: {e}")
+    if not isinstance(ttls, dict):
+        raise ConnectorError("Cache TTLs must be a json object of URL prefix to seconds")
+    return ttls
+
+
+def get_cache_ttl(config: dict, url: str) -> float:
+    """
+    TTL of the longest URL prefix matching url.
+    """
+    ttls = parse_cache_ttls(config)
+    url = normalize_url(url)
+    best_prefix, ttl = None, ttls.get("default", DEFAULT_CACHE_TTL)
+    for prefix, prefix_ttl in ttls.items():
+        if prefix == "default":
+            continue
+        normalized = normalize_url(prefix)
+        if url.startswith(normalized) and (best_prefix is None or len(normalized) > len(best_prefix)):
+            best_prefix, ttl = normalized, prefix_ttl
+    try:
+        return float(ttl)
+    except (TypeError, ValueError):
+        return DEFAULT_CACHE_TTL
+
+
+def get_response_cache(config: dict) -> ResponseCache:
+    """
+    Response cache on the backend selected by the config, which is capped at the memory budget of the config.
+    """
+    backend = get_cache_backend(config)
+    cache = _response_caches.get(id(backend))
+    if cache is None:
+        cache = _response_caches.setdefault(id(backend), ResponseCache(backend))
+    return cache
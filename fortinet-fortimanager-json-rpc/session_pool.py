@@ -0,0 +1,200 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Hashable
+
+from connectors.core.connector import get_logger, ConnectorError
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Seconds an idle session is kept in the pool before it is logged out. Kept below the FortiManager admin idle timeout
+DEFAULT_IDLE_TTL = 240
+# Idle sessions older than this are probed with a cheap request before they are handed out again
+PROBE_AFTER = 60
+# Maximum number of idle sessions kept per server/credential pair
+MAX_IDLE_PER_KEY = 8
+# FortiManager returns -11 (No permission for the resource) when the session id has expired
+INVALID_SESSION_CODE = -11
+# Status pyFMG returns for every free form request, the status of each item is in the response
+FREE_FORM_STATUS = 200
+
+
+def session_expired(status: int, response) -> bool:
+    """
+    Whether a response says the session id has expired. Free form requests always return FREE_FORM_STATUS, so the
+    status of each of their items is checked instead.
+    """
+    if status == INVALID_SESSION_CODE:
+        return True
+    if status != FREE_FORM_STATUS or not isinstance(response, list):
+        return False
+    return any(isinstance(entry, dict) and isinstance(entry.get("status"), dict) and
+               entry["status"].get("code") == INVALID_SESSION_CODE for entry in response)
+
+
+class SessionPool:
+    """
+    Pool of logged in pyFMG FortiManager sessions.
+
+    Sessions are checked out exclusively by one caller at a time, and are returned to the pool after the operation
+    so the next operation against the same server and credentials can skip the login and logout round trips.
+    """
+
+    def __init__(self, max_idle_per_key: int = MAX_IDLE_PER_KEY):
+        self.max_idle_per_key = max_idle_per_key
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: Hashable, factory: Callable, idle_ttl: int = DEFAULT_IDLE_TTL):
+        """
+        Get a logged in session for key, reusing an idle one when it is still valid.
+
+        :param key: Hashable identifying the server and credentials
+        :param factory: Callable returning a new FortiManager instance, logged in or not
+        :param idle_ttl: Seconds an idle session may be reused for
+        :return: Logged in FortiManager instance
+        """
+        while True:
+            with self._lock:
+                sessions = self._idle.get(key)
+                # Most recently used session first, it is the one most likely to still be valid
+                entry = sessions.pop() if sessions else None
+            if entry is None:
+                break
+            fmg, last_used = entry
+            idle_time = time.monotonic() - last_used
+            if idle_time > idle_ttl:
+                self._close(fmg)
+                continue
+            if idle_time > PROBE_AFTER and not self._is_alive(fmg):
+                self._close(fmg)
+                continue
+            return fmg
+        fmg = factory()
+        if fmg.sid is None:
+            fmg.login()
+        if fmg.sid is None:
+            raise ConnectorError("Failed to login to FortiManager")
+        return fmg
+
+    def release(self, key: Hashable, fmg, idle_ttl: int = DEFAULT_IDLE_TTL, discard: bool = False):
+        """
+        Return a session to the pool. ADOMs still locked by the session are unlocked first.
+
+        :param key: Key the session was acquired with
+        :param fmg: FortiManager instance to return
+        :param idle_ttl: Seconds an idle session may be reused for, 0 disables pooling
+        :param discard: Log the session out instead of pooling it
+        """
+        if discard or idle_ttl <= 0 or fmg.sid is None:
+            self._close(fmg)
+            return
+        try:
+            if fmg._lock_ctx.uses_workspace:
+                fmg._lock_ctx.run_unlock()
+        except Exception as e:
+            logger.debug("Failed to unlock ADOMs before pooling session, discarding it: {}".format(e))
+            self._close(fmg)
+            return
+        overflow = []
+        with self._lock:
+            sessions = self._idle.setdefault(key, [])
+            sessions.append((fmg, time.monotonic()))
+            while len(sessions) > self.max_idle_per_key:
+                overflow.append(sessions.pop(0)[0])
+        for stale in overflow:
+            self._close(stale)
+        self.evict_expired(idle_ttl)
+
+    @contextmanager
+    def session(self, key: Hashable, factory: Callable, idle_ttl: int = DEFAULT_IDLE_TTL):
+        fmg = self.acquire(key, factory, idle_ttl)
+        try:
+            yield fmg
+        except ConnectorError:
+            # Errors raised by the connector itself leave the session in a usable state
+            self.release(key, fmg, idle_ttl)
+            raise
+        except Exception:
+            self.release(key, fmg, idle_ttl, discard=True)
+            raise
+        else:
+            self.release(key, fmg, idle_ttl)
+
+    @staticmethod
+    def relogin(fmg):
+        """
+        Replace the expired session id of fmg with a new one.
+        """
+        if getattr(fmg, "pinned_transaction", None):
+            # The ADOM locks of a transaction die with its session, logging in again would write without them
+            fmg.session_expired = True
+            raise ConnectorError(f"FortiManager session of transaction {fmg.pinned_transaction} expired")
+        logger.debug("FortiManager session expired, logging in again")
+        fmg.relogins = getattr(fmg, "relogins", 0) + 1
+        fmg.sid = None
+        fmg._lock_ctx._locked_adom_list = []
+        # The new session id is not published to the other workers, so it is logged out like any private session
+        fmg.shared_session = False
+        fmg.login()
+        if fmg.sid is None:
+            raise ConnectorError("Failed to login to FortiManager")
+
+    def evict_expired(self, idle_ttl: int = DEFAULT_IDLE_TTL):
+        """
+        Log out every idle session that has not been used for idle_ttl seconds.
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key in list(self._idle):
+                keep = []
+                for fmg, last_used in self._idle[key]:
+                    if now - last_used > idle_ttl:
+                        expired.append(fmg)
+                    else:
+                        keep.append((fmg, last_used))
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+        for fmg in expired:
+            self._close(fmg)
+
+    def close_all(self):
+        with self._lock:
+            sessions = [fmg for entries in self._idle.values() for fmg, _ in entries]
+            self._idle.clear()
+        for fmg in sessions:
+            self._close(fmg)
+
+    @staticmethod
+    def _is_alive(fmg) -> bool:
+        try:
+            status, _ = fmg.get("/sys/status")
+            return status == 0
+        except Exception as e:
+            logger.debug("Idle FortiManager session failed liveness check: {}".format(e))
+            return False
+
+    @staticmethod
+    def _close(fmg):
+        if getattr(fmg, "shared_session", False):
+            # Session ids shared with other workers are left to expire on the server instead of being logged out
+            return
+        try:
+            fmg.logout()
+        except Exception as e:
+            logger.debug("Failed to logout FortiManager session: {}".format(e))
+
+
+session_pool = SessionPool()
+atexit.register(session_pool.close_all)
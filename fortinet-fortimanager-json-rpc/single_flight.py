@@ -0,0 +1,193 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import copy
+import hashlib
+import os
+import threading
+import time
+from typing import Callable, Union
+
+from connectors.core.connector import get_logger
+
+from .cache_backends import check_private, ensure_private_directory, open_private_file
+from .codec import dumps, loads
+from .metrics import metrics_registry
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Seconds a result file stays in the coalescing directory after its request finished
+RESULT_FILE_TTL = 60
+
+
+class Flight:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: the first caller of a key runs the call, and callers arriving while it is in
+    flight wait for it and get a copy of its result, or its exception.
+
+    A call only joins a flight of the same generation. Callers pass the write generation of what they read, so a call
+    that starts after a write never joins a flight that started before it.
+
+    With a directory, the callers running a key in different processes also coordinate through a lock file per key.
+    The directory and its files must be private to the user, as they hold get responses returned to callers.
+    The process holding the lock runs the call and writes the result next to the lock file, and the processes waiting
+    on the lock use that result if it was written after they started waiting and its call started after not_before,
+    instead of running the call again.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+
+    def record_write(self, scope: tuple):
+        """
+        Start a new generation for scope, so calls that start from now on do not join flights that started earlier.
+        """
+        with self._lock:
+            generation, _ = self._generations.get(scope, (0, 0.0))
+            self._generations[scope] = (generation + 1, time.time())
+
+    def generation(self, scopes: list) -> tuple:
+        """
+        :return: Tuple of (generations of scopes, wall clock time of the last write to any of them)
+        """
+        with self._lock:
+            states = [self._generations.get(scope, (0, 0.0)) for scope in scopes]
+        return tuple(generation for generation, _ in states), max((written for _, written in states), default=0.0)
+
+    def do(self, key: str, func: Callable, directory: Union[str, None] = None, generation: tuple = (),
+           not_before: float = 0.0) -> tuple:
+        """
+        :return: Tuple of (result, whether it was shared with another caller)
+        """
+        flight_key = (key, generation)
+        with self._lock:
+            flight = self._flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[flight_key] = Flight()
+            else:
+                flight.waiters += 1
+        if not leader:
+            flight.done.wait()
+            metrics_registry.increment("coalesced_requests_total", 1, "Requests answered by an identical request "
+                                                                      "in flight", scope="thread")
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result), True
+
+        try:
+            if directory and fcntl is not None:
+                result, shared = self._do_across_processes(key, func, directory, not_before)
+            else:
+                result, shared = func(), False
+        except Exception as e:
+            flight.error = e
+            self._land(flight_key, flight)
+            raise
+        flight.result = result
+        # Waiters are counted once the flight is removed, so none can join after the decision to copy
+        waiters = self._land(flight_key, flight)
+        return (copy.deepcopy(result) if waiters else result), shared
+
+    def _land(self, key: tuple, flight: Flight) -> int:
+        with self._lock:
+            del self._flights[key]
+            waiters = flight.waiters
+        flight.done.set()
+        return waiters
+
+    def _do_across_processes(self, key: str, func: Callable, directory: str, not_before: float) -> tuple:
+        ensure_private_directory(directory)
+        name = hashlib.sha256(key.encode()).hexdigest()
+        lock_path = os.path.join(directory, f"{name}.lock")
+        result_path = os.path.join(directory, f"{name}.json")
+        started = time.time()
+        with os.fdopen(open_private_file(lock_path), "r+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                result = read_result_file(result_path, started, not_before)
+                if result is not None:
+                    metrics_registry.increment("coalesced_requests_total", 1, "Requests answered by an identical "
+                                                                              "request in flight", scope="process")
+                    return result, True
+                called = time.time()
+                result = func()
+                write_result_file(result_path, called, result)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self._prune(directory)
+        return result, False
+
+    def _prune(self, directory: str):
+        """
+        Remove the result files of requests that finished more than RESULT_FILE_TTL seconds ago, at most once per
+        RESULT_FILE_TTL. Lock files are kept, as another process may be waiting on them.
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune < RESULT_FILE_TTL:
+                return
+            self._last_prune = now
+        try:
+            for entry in os.scandir(directory):
+                if entry.name.endswith(".json") and now - entry.stat().st_mtime > RESULT_FILE_TTL:
+                    os.remove(entry.path)
+        except OSError as e:
+            logger.debug(f"Failed to prune coalescing directory {directory}: {e}")
+
+
+single_flight = SingleFlight()
+
+
+def read_result_file(path: str, started: float, not_before: float) -> Union[dict, None]:
+    """
+    Result stored at path if the request that produced it finished after started, so it was in flight meanwhile, and
+    was sent after not_before, so it reflects the caller's last write.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    with os.fdopen(fd, "rb") as result_file:
+        # A result file another user could write may hold forged responses
+        check_private(path, os.fstat(fd))
+        try:
+            stored = loads(result_file.read())
+        except (OSError, ValueError):
+            return None
+    if not isinstance(stored, dict) or stored.get("finished", 0) < started or stored.get("called", 0) < not_before:
+        return None
+    return stored.get("result")
+
+
+def write_result_file(path: str, called: float, result):
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with os.fdopen(open_private_file(temporary_path, os.O_WRONLY | os.O_TRUNC), "w") as result_file:
+            result_file.write(dumps({"called": called, "finished": time.time(), "result": result}))
+        # Readers see either the previous or the new result, never a partial file
+        os.replace(temporary_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug(f"Failed to store coalesced result at {path}: {e}")
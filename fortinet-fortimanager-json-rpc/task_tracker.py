@@ -0,0 +1,231 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Hashable, Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Bounds in seconds of the adaptive interval between two progress reads of the same task
+MIN_POLL_INTERVAL = 1.0
+MAX_POLL_INTERVAL = 30.0
+# Seconds a finished task result is kept for json_rpc_get_task_result
+RESULT_RETENTION = 3600
+# Maximum number of task reads packed into a single multi-param request
+MAX_TASKS_PER_REQUEST = 100
+# Threads running completion callbacks, so their follow up calls never hold up the poller
+CALLBACK_WORKERS = 4
+
+
+class TrackedTask:
+    """
+    FortiManager task watched by the TaskTracker. future resolves to a (code, task_info) tuple like pyFMG's
+    track_task.
+    """
+
+    def __init__(self, task_id, key: Hashable, session_factory: Callable, timeout: int, zero_percent_timeout: int,
+                 task_stale_timeout: int):
+        now = time.monotonic()
+        self.handle = str(uuid.uuid4())
+        self.task_id = task_id
+        self.key = key
+        self.session_factory = session_factory
+        self.timeout = timeout
+        self.zero_percent_timeout = zero_percent_timeout
+        self.task_stale_timeout = task_stale_timeout
+        self.future = Future()
+        self.started = now
+        self.last_progress = now
+        self.percent = 0
+        self.task_info = None
+        self.interval = MIN_POLL_INTERVAL
+        self.next_poll = now
+        self.finished_at = None
+        self.callback = None
+        # Extra results attached by the completion callback, returned along with the task response
+        self.extra = {}
+
+    def update(self, task_info: dict, now: float):
+        """
+        Record a progress read and adapt the poll interval: poll sooner while the task progresses, back off while it
+        does not.
+        """
+        self.task_info = task_info
+        percent = int(task_info.get("percent", 0) or 0)
+        if percent != self.percent:
+            elapsed = now - self.last_progress
+            rate = (percent - self.percent) / elapsed if elapsed > 0 else 0
+            self.percent = percent
+            self.last_progress = now
+            # Aim for about two reads before the estimated completion time
+            estimate = (100 - percent) / rate / 2 if rate > 0 else MIN_POLL_INTERVAL
+            self.interval = min(max(estimate, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+        else:
+            self.interval = min(self.interval * 1.5, MAX_POLL_INTERVAL)
+        self.next_poll = now + self.interval
+
+    def check_timeouts(self, now: float) -> Union[str, None]:
+        if now - self.started >= self.timeout:
+            return f"Task did not complete in efficient time. The timeout value was {self.timeout}"
+        if self.percent == 0 and now - self.started >= self.zero_percent_timeout:
+            return f"Task did not progress past 0% in {self.zero_percent_timeout} seconds"
+        if self.percent and now - self.last_progress >= self.task_stale_timeout:
+            return f"Task did not progress for {self.task_stale_timeout} seconds"
+        return None
+
+    def status(self) -> dict:
+        result = {
+            "handle": self.handle,
+            "task": self.task_id,
+            "percent": self.percent,
+            "done": self.future.done()
+        }
+        if self.future.done():
+            code, task_info = self.future.result()
+            result.update({"status": code, "task_response": task_info})
+            result.update(self.extra)
+        return result
+
+
+class TaskTracker:
+    """
+    Background poller watching many FortiManager tasks at once. Each tick, the progress of every due task of a
+    server is read with a single multi-param request.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._callbacks = ThreadPoolExecutor(max_workers=CALLBACK_WORKERS, thread_name_prefix="fmg-task-callback")
+
+    def watch(self, task_id, key: Hashable, session_factory: Callable, timeout: int = 21600,
+              zero_percent_timeout: int = 30, task_stale_timeout: int = 120, callback: Union[Callable, None] = None,
+              **kwargs) -> TrackedTask:
+        """
+        Start tracking task_id in the background.
+
+        :param key: Tasks sharing a key are read with the same request
+        :param session_factory: Callable returning a context manager that yields a logged in FortiManager session
+        :param callback: Called with the TrackedTask and its (code, task_info) result once the task is finished,
+                         failed or timed out. It runs on a callback thread, and the future only resolves once it has
+                         returned, so anything it adds to extra is seen by every waiter
+        :return: TrackedTask, whose handle can be passed to get
+        """
+        task = TrackedTask(task_id, key, session_factory, timeout, zero_percent_timeout, task_stale_timeout)
+        task.callback = callback
+        with self._cond:
+            self._tasks[task.handle] = task
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="fmg-task-tracker", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return task
+
+    def get(self, handle: str) -> Union[TrackedTask, None]:
+        with self._cond:
+            return self._tasks.get(handle)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._prune()
+                now = time.monotonic()
+                # A finished task may still wait for its callback, it is not read again meanwhile
+                pending = [task for task in self._tasks.values() if task.finished_at is None]
+                if not pending:
+                    # Let the thread exit when there is nothing to watch, watch starts a new one
+                    self._thread = None
+                    return
+                wait_time = min(task.next_poll for task in pending) - now
+                if wait_time > 0:
+                    self._cond.wait(wait_time)
+                    continue
+                due = {}
+                for task in pending:
+                    if task.next_poll <= now:
+                        due.setdefault(task.key, []).append(task)
+            for tasks in due.values():
+                for start in range(0, len(tasks), MAX_TASKS_PER_REQUEST):
+                    self._poll(tasks[start:start + MAX_TASKS_PER_REQUEST])
+
+    def _poll(self, tasks: list):
+        try:
+            with tasks[0].session_factory() as fmg:
+                status, results = fmg.free_form("get", data=[{"url": f"/task/task/{task.task_id}"} for task in tasks])
+        except Exception as e:
+            logger.debug(f"Failed to read progress of {len(tasks)} tasks: {e}")
+            results = []
+        now = time.monotonic()
+        for position, task in enumerate(tasks):
+            entry = results[position] if isinstance(results, list) and position < len(results) else None
+            code = entry.get("status", {}).get("code", -1) if isinstance(entry, dict) else -1
+            task_info = entry.get("data") if isinstance(entry, dict) else None
+            if code == 0 and isinstance(task_info, dict):
+                task.update(task_info, now)
+                if task.percent >= 100:
+                    task_info["total_task_time"] = str(round(now - task.started, 3))
+                    self._finish(task, 0, task_info)
+                    continue
+            else:
+                task.interval = min(task.interval * 1.5, MAX_POLL_INTERVAL)
+                task.next_poll = now + task.interval
+            timeout_message = task.check_timeouts(now)
+            if timeout_message:
+                self._finish(task, 1, {"msg": timeout_message, "task": task.task_info})
+
+    def _finish(self, task: TrackedTask, code: int, task_info: dict):
+        task.finished_at = time.monotonic()
+        if task.callback is None:
+            task.future.set_result((code, task_info))
+        else:
+            self._callbacks.submit(self._run_callback, task, (code, task_info))
+
+    @staticmethod
+    def _run_callback(task: TrackedTask, result: tuple):
+        try:
+            task.callback(task, result)
+        except Exception as e:
+            logger.error(f"Task {task.task_id} completion callback failed: {e}")
+        finally:
+            task.future.set_result(result)
+
+    def _prune(self):
+        now = time.monotonic()
+        for handle in [handle for handle, task in self._tasks.items()
+                       if task.finished_at is not None and now - task.finished_at > RESULT_RETENTION]:
+            del self._tasks[handle]
+
+
+task_tracker = TaskTracker()
+
+
+def get_task_result(params: dict) -> dict:
+    """
+    Status of a task tracked in the background, optionally waiting up to wait_timeout seconds for it to finish.
+    """
+    handle = params.get("handle")
+    if isinstance(handle, dict):
+        handle = handle.get("handle")
+    task = task_tracker.get(handle) if handle else None
+    if task is None:
+        raise ConnectorError(f"No task is tracked by this worker with handle: {handle}")
+    try:
+        wait_timeout = float(params.get("wait_timeout") or 0)
+    except (TypeError, ValueError):
+        wait_timeout = 0
+    if wait_timeout > 0:
+        try:
+            task.future.result(timeout=wait_timeout)
+        except Exception:
+            pass
+    return task.status()
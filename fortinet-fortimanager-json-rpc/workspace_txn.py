@@ -0,0 +1,324 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import atexit
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Hashable, Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .adom_lock import BackoffStrategy, LockResult, lock_adom, unlock_adom
+from .session_pool import session_pool, DEFAULT_IDLE_TTL
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Seconds a transaction may stay without any operation before it is committed and its ADOMs are unlocked
+DEFAULT_TRANSACTION_TIMEOUT = 300
+
+
+class WorkspaceTransaction:
+    """
+    Workspace transaction pinning one pooled session and the ADOM locks it takes, so many writes are committed
+    together instead of one commit per write.
+
+    Every ADOM the transaction writes to is locked when it begins, in sorted order like any multi ADOM write, so two
+    transactions can not deadlock each other. The ADOM locks belong to the pinned session: if it expires, the locks
+    and the uncommitted writes are gone, and the transaction is aborted instead of logging in again.
+
+    Pending writes are committed when commit_every writes are pending, when the oldest pending write is
+    commit_interval seconds old, or when the transaction ends. A value of 0 disables the threshold.
+    """
+
+    def __init__(self, key: Hashable, factory: Callable, idle_ttl: int, lock_timeout: int, commit_every: int,
+                 commit_interval: float, timeout: float, adoms: Union[list, None] = None):
+        self.transaction_id = str(uuid.uuid4())
+        self.key = key
+        self.idle_ttl = idle_ttl
+        self.lock_timeout = lock_timeout
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.timeout = timeout
+        self.adoms = sorted(set(adoms or []))
+        self.fmg = session_pool.acquire(key, factory, idle_ttl)
+        # Makes session_pool.relogin fail instead of silently replacing the session holding the locks
+        self.fmg.pinned_transaction = self.transaction_id
+        self.locks = {}
+        # Pending write count per ADOM, and the time of the oldest uncommitted write
+        self.pending = {}
+        self.first_pending = None
+        self.last_activity = time.monotonic()
+        self.writes = 0
+        self.commits = 0
+        self.commit_errors = []
+        self.closed = False
+        self._lock = threading.RLock()
+
+    def lock_all(self):
+        """
+        Lock the ADOMs of the transaction in sorted order. On failure, the ADOMs already locked are unlocked and the
+        session is released.
+        """
+        with self._lock:
+            if not self.fmg._lock_ctx.uses_workspace:
+                return
+            try:
+                for adom in self.adoms:
+                    lock = lock_adom(self.fmg, adom, f"/dvmdb/adom/{adom}", f"transaction {self.transaction_id}",
+                                     BackoffStrategy(self.lock_timeout))
+                    if not lock:
+                        unlock_adom(self.fmg, lock)
+                        raise ConnectorError(f"Failed to lock ADOM: {adom} for transaction {self.transaction_id}")
+                    self.locks[adom] = lock
+            except Exception:
+                self.abort()
+                raise
+
+    @contextmanager
+    def session(self):
+        """
+        Yield the pinned session. Operations of one transaction are serialized.
+        """
+        with self._lock:
+            if self.closed:
+                raise ConnectorError(f"Transaction {self.transaction_id} is already closed")
+            try:
+                yield self.fmg
+            except Exception:
+                if getattr(self.fmg, "session_expired", False):
+                    self.abort()
+                    raise ConnectorError(f"The FortiManager session of transaction {self.transaction_id} expired, "
+                                         f"its ADOM locks and uncommitted writes are lost. The transaction was "
+                                         f"aborted")
+                raise
+            finally:
+                self.last_activity = time.monotonic()
+                self.commit_if_due()
+
+    def lock(self, adom: str, url: str, data: Union[list, dict]) -> LockResult:
+        """
+        Lock of adom taken when the transaction began. Writes to other ADOMs are refused, locking them now could
+        deadlock with another transaction.
+        """
+        with self._lock:
+            lock = self.locks.get(adom)
+            if lock is None:
+                raise ConnectorError(f"ADOM {adom} was not locked when transaction {self.transaction_id} began. "
+                                     f"List every ADOM the transaction writes to in its ADOMs")
+            return lock
+
+    def record_write(self, adom: str):
+        """
+        Record a write to adom in place of committing it right away.
+        """
+        with self._lock:
+            self.writes += 1
+            self.pending[adom] = self.pending.get(adom, 0) + 1
+            if self.first_pending is None:
+                self.first_pending = time.monotonic()
+
+    def commit_due(self, now: float) -> bool:
+        if not self.pending:
+            return False
+        if self.commit_every and sum(self.pending.values()) >= self.commit_every:
+            return True
+        return bool(self.commit_interval) and now - self.first_pending >= self.commit_interval
+
+    def commit_if_due(self):
+        with self._lock:
+            if not self.closed and self.commit_due(time.monotonic()):
+                self.commit()
+
+    def commit(self):
+        """
+        Commit every ADOM with pending writes, in sorted order.
+        """
+        with self._lock:
+            for adom in sorted(self.pending):
+                try:
+                    status, commit_response = self.fmg.commit_changes(adom)
+                except Exception as e:
+                    status, commit_response = -1, str(e)
+                if status != 0:
+                    logger.error(f"Failed to commit ADOM: {adom} in transaction {self.transaction_id}: "
+                                 f"{commit_response}")
+                    self.commit_errors.append({"adom": adom, "status": status, "response": commit_response})
+                self.commits += 1
+            logger.debug(f"Committed {sum(self.pending.values())} writes in transaction {self.transaction_id}")
+            self.pending = {}
+            self.first_pending = None
+
+    def next_deadline(self) -> float:
+        deadline = self.last_activity + self.timeout
+        if self.pending and self.commit_interval:
+            deadline = min(deadline, self.first_pending + self.commit_interval)
+        return deadline
+
+    def abort(self):
+        """
+        Close the transaction without committing, after its session was lost or its ADOMs could not be locked.
+        """
+        with self._lock:
+            self.closed = True
+            logger.error(f"Aborting transaction {self.transaction_id}, {sum(self.pending.values())} uncommitted "
+                         f"writes are discarded")
+            for lock in self.locks.values():
+                try:
+                    unlock_adom(self.fmg, lock)
+                except Exception as e:
+                    logger.debug(f"Failed to unlock ADOM: {lock.adom} of aborted transaction: {e}")
+            self.fmg.pinned_transaction = None
+            session_pool.release(self.key, self.fmg, self.idle_ttl, discard=True)
+
+    def end(self, commit: bool = True) -> dict:
+        """
+        Commit or discard the pending writes, unlock every ADOM and return the session to the pool. The ADOMs are
+        unlocked and the session is released even when the commit fails.
+        """
+        with self._lock:
+            if self.closed:
+                raise ConnectorError(f"Transaction {self.transaction_id} is already closed")
+            self.closed = True
+            discarded = 0
+            try:
+                if commit:
+                    self.commit()
+                else:
+                    discarded = sum(self.pending.values())
+            finally:
+                for lock in self.locks.values():
+                    try:
+                        unlock_adom(self.fmg, lock)
+                    except Exception as e:
+                        logger.error(f"Failed to unlock ADOM: {lock.adom} in transaction {self.transaction_id}: {e}")
+                self.fmg.pinned_transaction = None
+                session_pool.release(self.key, self.fmg, self.idle_ttl, discard=bool(self.commit_errors))
+            return {
+                "transaction_id": self.transaction_id,
+                "adoms": sorted(self.locks),
+                "writes": self.writes,
+                "commits": self.commits,
+                "discarded": discarded,
+                "commit_errors": self.commit_errors,
+                "status": 0 if not self.commit_errors else 1
+            }
+
+
+class TransactionManager:
+    """
+    Registry of the open transactions of this worker. A reaper thread applies the time based commit threshold and
+    ends transactions left idle past their timeout, committing their pending writes.
+    """
+
+    def __init__(self):
+        self._transactions = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def begin(self, key: Hashable, factory: Callable, idle_ttl: int = DEFAULT_IDLE_TTL, lock_timeout: int = 1800,
+              commit_every: int = 0, commit_interval: float = 0, timeout: float = DEFAULT_TRANSACTION_TIMEOUT,
+              adoms: Union[list, None] = None) -> WorkspaceTransaction:
+        transaction = WorkspaceTransaction(key, factory, idle_ttl, lock_timeout, commit_every, commit_interval,
+                                           timeout, adoms)
+        transaction.lock_all()
+        with self._cond:
+            self._transactions[transaction.transaction_id] = transaction
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="fmg-transaction-reaper", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return transaction
+
+    def get(self, transaction_id: str) -> WorkspaceTransaction:
+        with self._cond:
+            transaction = self._transactions.get(transaction_id)
+        if transaction is None or transaction.closed:
+            raise ConnectorError(f"No open transaction in this worker with id: {transaction_id}")
+        return transaction
+
+    def end(self, transaction_id: str, commit: bool = True) -> dict:
+        transaction = self.get(transaction_id)
+        with self._cond:
+            self._transactions.pop(transaction_id, None)
+        return transaction.end(commit)
+
+    def end_all(self):
+        with self._cond:
+            transactions = [t for t in self._transactions.values() if not t.closed]
+            self._transactions.clear()
+        for transaction in transactions:
+            try:
+                transaction.end()
+            except Exception as e:
+                logger.error(f"Failed to end transaction {transaction.transaction_id}: {e}")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Aborted transactions are closed without going through end
+                for transaction_id in [t.transaction_id for t in self._transactions.values() if t.closed]:
+                    del self._transactions[transaction_id]
+                if not self._transactions:
+                    self._thread = None
+                    return
+                now = time.monotonic()
+                due = [t for t in self._transactions.values() if t.next_deadline() <= now]
+                if not due:
+                    self._cond.wait(min(t.next_deadline() for t in self._transactions.values()) - now)
+                    continue
+            for transaction in due:
+                self._expire(transaction)
+
+    def _expire(self, transaction: WorkspaceTransaction):
+        # Skip transactions busy with an operation, they are checked again once it completes
+        if not transaction._lock.acquire(blocking=False):
+            time.sleep(0.1)
+            return
+        try:
+            if transaction.closed:
+                return
+            now = time.monotonic()
+            if now - transaction.last_activity >= transaction.timeout:
+                logger.warning(f"Transaction {transaction.transaction_id} timed out after {transaction.timeout} "
+                               f"idle seconds, committing and unlocking")
+                with self._cond:
+                    self._transactions.pop(transaction.transaction_id, None)
+                transaction.end()
+            else:
+                transaction.commit_if_due()
+        except Exception as e:
+            logger.error(f"Failed to expire transaction {transaction.transaction_id}: {e}")
+        finally:
+            transaction._lock.release()
+
+
+transaction_manager = TransactionManager()
+atexit.register(transaction_manager.end_all)
+
+
+def parse_transaction_params(params: dict) -> dict:
+    def parse_number(name, default):
+        try:
+            value = float(params.get(name) or default)
+        except (TypeError, ValueError):
+            return default
+        return value if value >= 0 else default
+
+    adoms = params.get("adoms") or []
+    if isinstance(adoms, str):
+        adoms = adoms.split(",")
+    if not isinstance(adoms, list):
+        raise ConnectorError(f"Unexpected ADOMs type: {type(adoms)}. Please pass a list or a comma separated string.")
+
+    return {
+        "adoms": [str(adom).strip() for adom in adoms if str(adom).strip()],
+        "commit_every": int(parse_number("commit_every", 0)),
+        "commit_interval": parse_number("commit_interval", 0),
+        "timeout": parse_number("timeout", DEFAULT_TRANSACTION_TIMEOUT) or DEFAULT_TRANSACTION_TIMEOUT
+    }
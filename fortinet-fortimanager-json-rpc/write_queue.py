@@ -0,0 +1,169 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import threading
+import time
+from typing import Union
+
+from connectors.core.connector import get_logger, ConnectorError
+
+from .bulk_rpc import perform_bulk_action, DEFAULT_CHUNK_SIZE
+from .generic_json_rpc import get_session_key, parse_data, parse_adoms_from_input, perform_rpc_action
+from .metrics import metrics_registry
+
+logger = get_logger('fortinet-fortimanager-json-rpc')
+
+# Actions whose single object writes can be merged into a group commit
+GROUPED_ACTIONS = ("add", "set", "delete")
+
+
+class PendingWrite:
+    __slots__ = ("method", "url", "data", "done", "response", "error")
+
+    def __init__(self, method: str, url: str, data):
+        self.method = method
+        self.url = url
+        self.data = data
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class WriteGroup:
+    def __init__(self):
+        self.writes = []
+        self.full = threading.Event()
+        self.opened = time.monotonic()
+
+
+class GroupCommitQueue:
+    """
+    Write combining per server and ADOM, like a database group commit. The first write to reach an ADOM opens a group
+    and waits for the window to pass, or for the group to fill up. Writes arriving meanwhile join the group, which is
+    then sent as multi-param requests under one ADOM lock and one commit, and each writer gets its own result back.
+    """
+
+    def __init__(self):
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def submit(self, config: dict, key: tuple, write: PendingWrite, window: float, max_size: int) -> dict:
+        with self._lock:
+            group = self._groups.get(key)
+            leader = group is None
+            if leader:
+                group = self._groups[key] = WriteGroup()
+            group.writes.append(write)
+            if len(group.writes) >= max_size:
+                # Close a full group right away, the next write opens a new one
+                del self._groups[key]
+                group.full.set()
+        if not leader:
+            write.done.wait()
+            if write.error is not None:
+                raise write.error
+            return write.response
+
+        group.full.wait(window)
+        with self._lock:
+            if self._groups.get(key) is group:
+                del self._groups[key]
+        self.commit(config, group)
+        if write.error is not None:
+            raise write.error
+        return write.response
+
+    def commit(self, config: dict, group: WriteGroup):
+        writes = group.writes
+        wait = round(time.monotonic() - group.opened, 3)
+        try:
+            response = perform_bulk_action(config, {"items": [{"method": write.method, "url": write.url,
+                                                               "data": write.data} for write in writes],
+                                                    "chunk_size": len(writes)})
+            metrics_registry.increment("group_commits_total", 1, "Group commits sent to FortiManager")
+            metrics_registry.increment("group_committed_writes_total", len(writes), "Writes applied by group commits")
+            logger.debug(f"Group commit of {len(writes)} writes in {response['requests']} requests")
+            for write, result in zip(writes, response["bulk_response"]):
+                write.response = demultiplex(write, result, response.get("lock_wait_time"), len(writes), wait)
+        except Exception as e:
+            logger.error(f"Group commit of {len(writes)} writes failed: {e}")
+            for write in writes:
+                write.error = e
+        finally:
+            # Every writer of the group is released, whatever happened to the group
+            for write in writes:
+                if write.response is None and write.error is None:
+                    write.error = ConnectorError("No result returned for write")
+                write.done.set()
+
+
+group_commit_queue = GroupCommitQueue()
+
+
+def demultiplex(write: PendingWrite, result: dict, lock_wait_time: Union[dict, None], size: int,
+                wait: float) -> dict:
+    """
+    Response of one write of a group, shaped like the response of the same write sent on its own.
+    """
+    response = {}
+    if lock_wait_time is not None:
+        response["lock_wait_time"] = round(sum(lock_wait_time.values()), 3)
+    # Results without data are returned whole by FortiManager, status included
+    action_response = result["data"]
+    if action_response is None:
+        action_response = {"status": {"code": result["status"], "message": result["message"]}, "url": write.url}
+    response[f"{write.method}_response"] = action_response
+    response["group_commit"] = {"size": size, "wait": wait}
+    response["status"] = result["status"]
+    return response
+
+
+def parse_group_commit_window(config: dict) -> float:
+    """
+    Group commit window in seconds, from the group_commit_window config value in milliseconds. 0 disables it.
+    """
+    window = config.get("group_commit_window")
+    if window in (None, ""):
+        return 0
+    try:
+        return max(float(window), 0) / 1000
+    except (TypeError, ValueError):
+        return 0
+
+
+def group_commit_key(action: str, config: dict, params: dict) -> Union[tuple, None]:
+    """
+    Key of the group a write may join, or None when it must be sent on its own: group commit is disabled, the write
+    belongs to a transaction or tracks a task, sets other request fields than data, or touches several ADOMs.
+    """
+    if action not in GROUPED_ACTIONS or not parse_group_commit_window(config) or not params.get("url") or \
+            params.get("transaction_id") or params.get("track_task", False):
+        return None
+    data = parse_data(params.get("data", {}))
+    if set(data) - {"data"}:
+        return None
+    adoms = parse_adoms_from_input(params.get("url"), data)
+    if len(adoms) != 1:
+        return None
+    return get_session_key(config) + (adoms[0],)
+
+
+def perform_write_action(action: str, config: dict, params: dict) -> dict:
+    """
+    Run an add, set or delete, merged with concurrent writes to the same ADOM when group commit is enabled.
+    """
+    key = group_commit_key(action, config, params)
+    if key is None:
+        return perform_rpc_action(action, config, params)
+    write = PendingWrite(action, params["url"], parse_data(params.get("data", {})).get("data"))
+    try:
+        # A full group fits in a single multi-param request
+        return group_commit_queue.submit(config, key, write, parse_group_commit_window(config), DEFAULT_CHUNK_SIZE)
+    except ConnectorError:
+        raise
+    except Exception as e:
+        raise ConnectorError(e)
@@ -0,0 +1,299 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# Add the grandparent directory to the system path
+current_directory = os.path.dirname(__file__)
+grandparent_directory = os.path.abspath(os.path.join(current_directory, os.pardir, os.pardir))
+sys.path.insert(0, str(grandparent_directory))
+
+from tests.simulator.fmg_simulator import FMGSimulator  # noqa: E402
+
+# Import the connector modules dynamically
+operations_package = importlib.import_module("fortinet-fortimanager-json-rpc.operations")
+generic_json_rpc_package = importlib.import_module("fortinet-fortimanager-json-rpc.generic_json_rpc")
+session_pool_package = importlib.import_module("fortinet-fortimanager-json-rpc.session_pool")
+operations = operations_package.operations
+
+# Relative slowdown of a benchmark's median against the baseline that counts as a regression
+DEFAULT_THRESHOLD = 0.25
+# Benchmarks whose baseline median is below this many seconds are too noisy to compare
+MIN_COMPARABLE_TIME = 0.0001
+ADDRESS_URL = "/pm/config/adom/{adom}/obj/firewall/address"
+
+
+def summarize_samples(samples: list, operations_count: int = 1) -> dict:
+    ordered = sorted(samples)
+    total = sum(ordered)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+    return {
+        "iterations": len(ordered),
+        "mean": total / len(ordered),
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "min": ordered[0],
+        "max": ordered[-1],
+        "stdev": statistics.pstdev(ordered),
+        "ops_per_sec": operations_count * len(ordered) / total if total else None
+    }
+
+
+def time_calls(func, iterations: int, warmup: int = 2, setup=None) -> list:
+    """
+    Time iterations calls of func after warmup untimed ones. setup, when set, runs untimed before every call.
+    """
+    samples = []
+    for index in range(-warmup, iterations):
+        if setup is not None:
+            setup(index)
+        if index < 0:
+            func(index)
+            continue
+        start = time.perf_counter()
+        func(index)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def address_row(index: int) -> dict:
+    return {"name": f"bench-{index}", "subnet": [f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}",
+                                                 "255.255.255.255"], "type": "ipmask"}
+
+
+def operation_benchmarks(config: dict) -> dict:
+    """
+    One callable per entry of operations.operations, taking the iteration index, or a (setup, callable) tuple when
+    the call needs untimed preparation. Writes go to names unique per iteration so every call does the same amount
+    of work.
+    """
+    url = ADDRESS_URL.format(adom="root")
+    state = {}
+    mirror_config = dict(config, mirror_path=os.path.join(tempfile.mkdtemp(), "mirror.sqlite3"))
+
+    def task_result(index):
+        if "handle" not in state:
+            response = operations['json_rpc_execute'](config, {
+                "url": "/securityconsole/install/package", "data": {"adom": "root"}, "track_task": True,
+                "track_task_in_background": True})
+            state["handle"] = response["task_handle"]["handle"]
+        operations['json_rpc_get_task_result'](config, {"handle": state["handle"]})
+
+    def begin_transaction(index):
+        state["transaction_id"] = operations['json_rpc_begin_transaction'](config, {"adoms": "root"})["transaction_id"]
+
+    def end_transaction(index):
+        if "transaction_id" in state:
+            operations['json_rpc_end_transaction'](config, {"transaction_id": state.pop("transaction_id")})
+
+    benchmarks = {
+        "check_health": lambda i: operations['check_health'](dict(config, health_cache_window=0)),
+        "json_rpc_add": lambda i: operations['json_rpc_add'](config, {"url": url, "data": [address_row(i + 100000)]}),
+        "json_rpc_set": lambda i: operations['json_rpc_set'](config, {"url": url, "data": [address_row(i)]}),
+        "json_rpc_get": lambda i: operations['json_rpc_get'](config, {"url": url, "data": {"fields": ["name"]}}),
+        "json_rpc_execute": lambda i: operations['json_rpc_execute'](config, {"url": "/sys/proxy/json",
+                                                                              "data": {}}),
+        "json_rpc_delete": lambda i: operations['json_rpc_delete'](config, {"url": f"{url}/bench-{i + 100000}"}),
+        "json_rpc_freeform": lambda i: operations['json_rpc_freeform'](config, {
+            "method": "set", "data": [{"url": url, "data": [address_row(i)]}]}),
+        "json_rpc_bulk": lambda i: operations['json_rpc_bulk'](config, {
+            "items": [{"method": "set", "url": url, "data": [address_row(i * 10 + n)]} for n in range(10)]}),
+        "json_rpc_fanout": lambda i: operations['json_rpc_fanout'](config, {
+            "method": "set", "url": ADDRESS_URL, "data": [address_row(i)], "adoms": "all"}),
+        "json_rpc_get_paginated": lambda i: operations['json_rpc_get_paginated'](config, {
+            "url": url, "page_size": 100}),
+        "json_rpc_sync": lambda i: operations['json_rpc_sync'](config, {
+            "url": url, "objects": [address_row(n) for n in range(100)]}),
+        "json_rpc_mirror_query": lambda i: operations['json_rpc_mirror_query'](mirror_config, {
+            "url": url, "attributes": {"subnet": "10.0.0.1"}, "max_staleness": 0}),
+        "json_rpc_address_lookup": lambda i: operations['json_rpc_address_lookup'](config, {
+            "queries": [f"10.0.{i % 256}.1", "10.0.0.0/24"], "max_staleness": 0}),
+        "json_rpc_install_packages": lambda i: operations['json_rpc_install_packages'](config, {
+            "adom": "root", "packages": [{"pkg": "default", "scope": [{"name": "FGT-1", "vdom": "root"}]}],
+            "mode": "Install Only"}),
+        "json_rpc_get_task_result": task_result,
+        "json_rpc_begin_transaction": (end_transaction, begin_transaction),
+        "json_rpc_end_transaction": (begin_transaction, end_transaction),
+        "json_rpc_get_metrics": lambda i: operations['json_rpc_get_metrics'](config, {})
+    }
+    missing = set(operations) - set(benchmarks)
+    if missing:
+        raise RuntimeError(f"No benchmark defined for operations: {', '.join(sorted(missing))}")
+    return benchmarks
+
+
+def bench_operations(config: dict, iterations: int) -> dict:
+    results = {}
+    benchmarks = operation_benchmarks(config)
+    for name in operations:
+        setup, func = benchmarks[name] if isinstance(benchmarks[name], tuple) else (None, benchmarks[name])
+        results[f"operation.{name}"] = summarize_samples(time_calls(func, iterations, setup=setup))
+        if name == "json_rpc_begin_transaction":
+            setup(iterations)
+    return results
+
+
+def bench_session_setup(config: dict, iterations: int) -> dict:
+    pooled = time_calls(lambda i: operations['json_rpc_get'](config, {"url": "/sys/status"}), iterations)
+    unpooled_config = dict(config, session_idle_ttl=0)
+    unpooled = time_calls(lambda i: operations['json_rpc_get'](unpooled_config, {"url": "/sys/status"}), iterations)
+    return {
+        "session.pooled": summarize_samples(pooled),
+        "session.login_per_call": summarize_samples(unpooled)
+    }
+
+
+def bench_parsing(iterations: int, payload_size: int) -> dict:
+    items = [{"url": f"/pm/config/adom/adom-{n % 50}/obj/firewall/address", "data": [address_row(n)]}
+             for n in range(payload_size)]
+    payload_text = json.dumps(items)
+    payload = generic_json_rpc_package.parse_data(payload_text)
+    parse_adoms = getattr(generic_json_rpc_package, "parse_adoms_from_input", None)
+    results = {
+        "parse.parse_data": summarize_samples(time_calls(
+            lambda i: generic_json_rpc_package.parse_data(payload_text), iterations)),
+        "parse.parse_adom_from_input": summarize_samples(time_calls(
+            lambda i: generic_json_rpc_package.parse_adom_from_input(None, payload), iterations))
+    }
+    if parse_adoms is not None:
+        results["parse.parse_adoms_from_input"] = summarize_samples(time_calls(
+            lambda i: parse_adoms(None, payload), iterations))
+    return results
+
+
+def bench_lock_contention(config: dict, workers: int, writes_per_worker: int) -> dict:
+    """
+    workers threads writing to the same ADOM at the same time, each write locking and committing it.
+    """
+    url = ADDRESS_URL.format(adom="root")
+    samples = []
+    lock_waits = []
+    samples_lock = threading.Lock()
+
+    def worker(worker_index):
+        for n in range(writes_per_worker):
+            start = time.perf_counter()
+            response = operations['json_rpc_set'](config, {
+                "url": url, "data": [address_row(200000 + worker_index * writes_per_worker + n)]})
+            with samples_lock:
+                samples.append(time.perf_counter() - start)
+                lock_waits.append(response.get("lock_wait_time", 0))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(worker, range(workers)))
+    elapsed = time.perf_counter() - start
+    result = summarize_samples(samples)
+    result.update({
+        "workers": workers,
+        "ops_per_sec": len(samples) / elapsed,
+        "mean_lock_wait": statistics.mean(lock_waits),
+        "max_lock_wait": max(lock_waits)
+    })
+    return {f"lock_contention.{workers}_workers": result}
+
+
+def bench_bulk(config: dict, iterations: int, items_count: int) -> dict:
+    url = ADDRESS_URL.format(adom="root")
+
+    def bulk(index):
+        operations['json_rpc_bulk'](config, {"items": [
+            {"method": "set", "url": url, "data": [address_row(300000 + n)]} for n in range(items_count)]})
+
+    result = summarize_samples(time_calls(bulk, iterations), items_count)
+    return {f"bulk.{items_count}_items": result}
+
+
+def compare_results(current: dict, baseline: dict, threshold: float) -> list:
+    """
+    :return: List of (benchmark, baseline median, current median) that slowed down by more than threshold
+    """
+    regressions = []
+    for name, result in current.items():
+        previous = baseline.get(name)
+        if not previous or previous.get("p50", 0) < MIN_COMPARABLE_TIME:
+            continue
+        if result["p50"] > previous["p50"] * (1 + threshold):
+            regressions.append((name, previous["p50"], result["p50"]))
+    return regressions
+
+
+def run_benchmarks(args) -> dict:
+    results = {}
+    results.update(bench_parsing(args.iterations, args.payload_size))
+    with FMGSimulator(latency=args.latency, adoms=("root", "customer-a", "customer-b"), task_duration=0,
+                      seed=1) as simulator:
+        config = simulator.config(lock_timeout=60)
+        results.update(bench_session_setup(config, args.iterations))
+        results.update(bench_operations(config, args.iterations))
+        results.update(bench_lock_contention(config, args.workers, args.writes_per_worker))
+        results.update(bench_bulk(config, max(args.iterations // 10, 3), args.bulk_items))
+    session_pool_package.session_pool.close_all()
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the connector against the local FortiManager simulator")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated server latency in seconds")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent writers of the lock contention benchmark")
+    parser.add_argument("--writes-per-worker", type=int, default=10)
+    parser.add_argument("--bulk-items", type=int, default=1000)
+    parser.add_argument("--payload-size", type=int, default=10000, help="Items of the parsing benchmark payload")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Relative slowdown of a median that fails the run, 0.25 is 25%%")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "arguments": vars(args)
+        },
+        "results": results
+    }
+    for name, result in results.items():
+        print(f"{name:45} p50 {result['p50'] * 1000:9.3f} ms  p95 {result['p95'] * 1000:9.3f} ms  "
+              f"{result['ops_per_sec'] or 0:10.1f} ops/s")
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file).get("results", {})
+        regressions = compare_results(results, baseline, args.threshold)
+        for name, previous, current in regressions:
+            print(f"REGRESSION {name}: p50 {previous * 1000:.3f} ms -> {current * 1000:.3f} ms")
+        if regressions:
+            return 1
+        print(f"No regression above {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
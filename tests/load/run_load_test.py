@@ -0,0 +1,267 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+# Add the grandparent directory to the system path
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+grandparent_directory = os.path.abspath(os.path.join(parent_directory, os.pardir))
+sys.path.insert(0, str(grandparent_directory))
+
+from tests.simulator.fmg_simulator import FMGSimulator  # noqa: E402
+
+# Import the operations dynamically
+operations_package = importlib.import_module("fortinet-fortimanager-json-rpc.operations")
+session_pool_package = importlib.import_module("fortinet-fortimanager-json-rpc.session_pool")
+operations = operations_package.operations
+
+ADDRESS_URL = "/pm/config/adom/{adom}/obj/firewall/address"
+# Relative weights of the actions issued by every worker
+DEFAULT_MIX = "add=2,set=2,delete=1,get=5"
+# Upper bounds in seconds of the reported lock wait buckets
+LOCK_WAIT_BUCKETS = (0, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        action, _, weight = part.partition("=")
+        action = action.strip()
+        if action not in ("add", "set", "delete", "get"):
+            raise ValueError(f"Unknown action '{action}' in traffic mix, expected add, set, delete or get")
+        weights[action] = float(weight or 1)
+    if not any(weights.values()):
+        raise ValueError("The traffic mix needs at least one action with a positive weight")
+    return weights
+
+
+def get_live_config(auth_method: str) -> dict:
+    """
+    Connection settings of a live FortiManager, read from the tests .env file like the other test suites.
+    """
+    load_dotenv(dotenv_path=os.path.join(parent_directory, '.env'))
+    config = {
+        "address": os.getenv("ADDRESS"),
+        "verify_ssl": os.getenv("VERIFY_SSL", "False").lower() in ("true", "1", "t"),
+        "port": os.getenv("PORT"),
+        "debug_connection": os.getenv("DEBUG_CONNECTION", "False").lower() in ("true", "1", "t"),
+        "verbose_json": os.getenv("VERBOSE_JSON", "True").lower() in ("true", "1", "t"),
+        "auth_method": auth_method
+    }
+    if auth_method == "Username/Password":
+        config.update({"username": os.getenv("USERNAME"), "password": os.getenv("PASSWORD")})
+    else:
+        config["api_key"] = os.getenv("API_KEY")
+    return config
+
+
+def address_data(name: str, index: int) -> list:
+    return [{"name": name, "subnet": [f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}",
+                                      "255.255.255.255"], "type": "ipmask", "comment": f"load test {index}"}]
+
+
+def choose_action(rng: random.Random, weights: dict, created: list) -> str:
+    action = rng.choices(list(weights), list(weights.values()))[0]
+    # set and delete need an object this worker created, add one first
+    if action in ("set", "delete") and not created:
+        return "add"
+    return action
+
+
+def run_worker(worker_index: int, config: dict, adoms: list, weights: dict, requests: int, duration: float,
+               seed: int) -> list:
+    """
+    Issue mixed traffic until requests actions are done or duration seconds have passed, whichever comes first.
+    Every worker only touches the objects it created, named after the worker, and deletes them when done.
+
+    :return: One record per action: action, adom, latency, success, lock wait time and error
+    """
+    rng = random.Random(seed + worker_index)
+    created = []
+    records = []
+    deadline = time.monotonic() + duration if duration else None
+    count = 0
+    while (not requests or count < requests) and (deadline is None or time.monotonic() < deadline):
+        action = choose_action(rng, weights, created)
+        if action == "add":
+            adom = rng.choice(adoms)
+            name = f"load-{os.getpid()}-{worker_index}-{count}"
+            params = {"url": ADDRESS_URL.format(adom=adom), "data": address_data(name, count)}
+        elif action == "get":
+            adom = rng.choice(adoms)
+            params = {"url": ADDRESS_URL.format(adom=adom), "data": {"fields": ["name", "subnet"]}}
+        else:
+            adom, name = created.pop(rng.randrange(len(created))) if action == "delete" else rng.choice(created)
+            url = f"{ADDRESS_URL.format(adom=adom)}/{name}"
+            params = {"url": url} if action == "delete" else {"url": url, "data": {"comment": f"set {count}"}}
+        start = time.perf_counter()
+        error = None
+        response = {}
+        try:
+            response = operations[f"json_rpc_{action}"](config, params)
+            if response.get("status", 0) != 0:
+                error = f"status {response.get('status')}"
+        except Exception as e:
+            error = str(e)
+        latency = time.perf_counter() - start
+        if action == "add" and error is None:
+            created.append((adom, name))
+        records.append((action, adom, latency, error is None, response.get("lock_wait_time"), error))
+        count += 1
+
+    for adom, name in created:
+        try:
+            operations['json_rpc_delete'](config, {"url": f"{ADDRESS_URL.format(adom=adom)}/{name}"})
+        except Exception:
+            pass
+    return records
+
+
+def run_process(args: tuple) -> list:
+    """
+    Run threads workers in one process, which has its own session pool like a FortiSOAR worker process.
+    """
+    first_worker, threads, config, adoms, weights, requests, duration, seed = args
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(run_worker, first_worker + index, config, adoms, weights, requests, duration,
+                                       seed) for index in range(threads)]
+            return [record for future in futures for record in future.result()]
+    finally:
+        session_pool_package.session_pool.close_all()
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def percentile(fraction):
+        return round(ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))], 6)
+
+    return {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99), "max": round(ordered[-1], 6)}
+
+
+def lock_wait_distribution(lock_waits: list) -> dict:
+    distribution = {}
+    for bound in LOCK_WAIT_BUCKETS:
+        distribution[f"<={bound}s"] = sum(1 for wait in lock_waits if wait <= bound)
+    distribution[f">{LOCK_WAIT_BUCKETS[-1]}s"] = sum(1 for wait in lock_waits if wait > LOCK_WAIT_BUCKETS[-1])
+    return distribution
+
+
+def build_report(records: list, elapsed: float) -> dict:
+    report = {"elapsed": round(elapsed, 3), "requests": len(records),
+              "throughput": round(len(records) / elapsed, 3) if elapsed else None, "actions": {}}
+    for action in sorted({record[0] for record in records}):
+        action_records = [record for record in records if record[0] == action]
+        failures = [record for record in action_records if not record[3]]
+        report["actions"][action] = dict(
+            percentiles([record[2] for record in action_records]),
+            requests=len(action_records),
+            errors=len(failures),
+            error_rate=round(len(failures) / len(action_records), 4),
+            throughput=round(len(action_records) / elapsed, 3) if elapsed else None
+        )
+    report["latency"] = percentiles([record[2] for record in records])
+    errors = [record for record in records if not record[3]]
+    report["error_rate"] = round(len(errors) / len(records), 4) if records else 0
+    report["top_errors"] = Counter(record[5] for record in errors).most_common(5)
+
+    lock_waits = [record[4] for record in records if isinstance(record[4], (int, float))]
+    report["lock_wait"] = dict(percentiles(lock_waits), samples=len(lock_waits),
+                               distribution=lock_wait_distribution(lock_waits))
+    report["adoms"] = dict(Counter(record[1] for record in records))
+    return report
+
+
+def print_report(report: dict):
+    print(f"{report['requests']} requests in {report['elapsed']}s, {report['throughput']} req/s, "
+          f"error rate {report['error_rate']:.2%}")
+    print(f"{'action':8} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for action, result in report["actions"].items():
+        print(f"{action:8} {result['requests']:9} {result['errors']:7} {result['throughput']:9.1f} "
+              f"{result['p50'] * 1000:9.2f} {result['p95'] * 1000:9.2f} {result['p99'] * 1000:9.2f}")
+    lock_wait = report["lock_wait"]
+    if lock_wait["samples"]:
+        print(f"lock wait over {lock_wait['samples']} writes: p50 {lock_wait['p50']}s p95 {lock_wait['p95']}s "
+              f"p99 {lock_wait['p99']}s max {lock_wait['max']}s")
+        print("  " + "  ".join(f"{bucket} {count}" for bucket, count in lock_wait["distribution"].items()))
+    for error, count in report["top_errors"]:
+        print(f"  {count} x {error}")
+
+
+def run_load_test(args, config: dict) -> dict:
+    weights = parse_mix(args.mix)
+    adoms = [adom.strip() for adom in args.adoms.split(",") if adom.strip()]
+    if args.processes > 1:
+        jobs = [(process * args.workers, args.workers, config, adoms, weights, args.requests, args.duration,
+                 args.seed) for process in range(args.processes)]
+        start = time.perf_counter()
+        with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+            records = [record for records in pool.map(run_process, jobs) for record in records]
+    else:
+        start = time.perf_counter()
+        records = run_process((0, args.workers, config, adoms, weights, args.requests, args.duration, args.seed))
+    return build_report(records, time.perf_counter() - start)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Mixed add/set/delete/get load against FortiManager")
+    parser.add_argument("--target", choices=("simulator", "live"), default="simulator",
+                        help="Local simulator, or the FortiManager of the tests .env file")
+    parser.add_argument("--auth", choices=("Username/Password", "API Key"), default="Username/Password")
+    parser.add_argument("--workers", type=int, default=8, help="Threads per process")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes, each with its own session pool")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per worker, 0 to only use --duration")
+    parser.add_argument("--duration", type=float, default=0, help="Seconds to run each worker for, 0 for no limit")
+    parser.add_argument("--adoms", default="root", help="Comma separated ADOMs to spread the traffic over")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Comma separated action=weight pairs")
+    parser.add_argument("--lock-timeout", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.01, help="Simulator request latency in seconds")
+    parser.add_argument("--commit-latency", type=float, default=0.05, help="Simulator commit latency in seconds")
+    parser.add_argument("--lock-contention", type=float, default=0.0,
+                        help="Probability that the simulator reports an ADOM locked by another user")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a simulated internal error")
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args()
+    if not args.requests and not args.duration:
+        parser.error("--requests or --duration is needed to stop the workers")
+
+    if args.target == "live":
+        report = run_load_test(args, dict(get_live_config(args.auth), lock_timeout=args.lock_timeout))
+    else:
+        adoms = tuple(dict.fromkeys(["root"] + [adom.strip() for adom in args.adoms.split(",") if adom.strip()]))
+        with FMGSimulator(latency=args.latency, commit_latency=args.commit_latency, adoms=adoms,
+                          lock_contention=args.lock_contention, error_rate=args.error_rate,
+                          seed=args.seed) as simulator:
+            report = run_load_test(args, simulator.config(args.auth, lock_timeout=args.lock_timeout))
+    report["arguments"] = vars(args)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Report written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -5,6 +5,7 @@ Copyright (c) 2024 Fortinet Inc
 Copyright end
 """
 
+import asyncio
 import importlib
 import logging
 import os
@@ -32,6 +33,7 @@ operations_module_name = "fortinet-fortimanager-json-rpc.operations"
 operations_package = importlib.import_module(operations_module_name)
 # Import the operations dictionary from the module
 operations = operations_package.operations
+async_operations = operations_package.async_operations
 
 # import the generic_json_rpc module
 generic_json_rpc_module_name = "fortinet-fortimanager-json-rpc.generic_json_rpc"
@@ -39,8 +41,29 @@ generic_json_rpc_package = importlib.import_module(generic_json_rpc_module_name)
 
 # import the generic_json_rpc functions
 parse_adom_from_input = generic_json_rpc_package.parse_adom_from_input
+parse_adoms_from_input = generic_json_rpc_package.parse_adoms_from_input
 parse_task_timeout = generic_json_rpc_package.parse_task_timeout
 parse_data = generic_json_rpc_package.parse_data
+get_config = generic_json_rpc_package.get_config
+get_session_key = generic_json_rpc_package.get_session_key
+session_pool = generic_json_rpc_package.session_pool
+
+# import the response_cache module
+response_cache_module_name = "fortinet-fortimanager-json-rpc.response_cache"
+response_cache_package = importlib.import_module(response_cache_module_name)
+response_cache = response_cache_package.response_cache
+
+# import the log_utils module
+log_utils_module_name = "fortinet-fortimanager-json-rpc.log_utils"
+log_utils_package = importlib.import_module(log_utils_module_name)
+
+# import the codec module
+codec_module_name = "fortinet-fortimanager-json-rpc.codec"
+codec_package = importlib.import_module(codec_module_name)
+
+# import the adom_lock module
+adom_lock_module_name = "fortinet-fortimanager-json-rpc.adom_lock"
+adom_lock_package = importlib.import_module(adom_lock_module_name)
 
 
 @pytest.fixture(params=["Username/Password", "API Key"])
@@ -222,6 +245,42 @@ def test_adom_and_data_parse_functions(auth_config):
         assert acquired_adom == correct_adom, f"Expected adom {correct_adom} but got {acquired_adom}"
 
 
+def test_parse_adoms_from_input(auth_config):
+    payload = [
+        {
+            "url": "/pm/config/adom/root/obj/firewall/address",
+            "data": {"adom": "ignored"},
+            "adoms": ["root"]
+        },
+        {
+            "url": None,
+            "data": {"data": [{"url": "/pm/config/adom/a/obj/firewall/address/"},
+                              {"url": "/pm/config/adom/b/obj/firewall/address/"},
+                              {"url": "/pm/config/adom/a/obj/firewall/addrgrp/"}]},
+            "adoms": ["a", "b"]
+        },
+        {
+            "url": "/securityconsole/install/package",
+            "data": {"data": {"scope": [{"name": "device"}], "adom": "c"}},
+            "adoms": ["c"]
+        },
+        {
+            "url": "/sys/status",
+            "data": {},
+            "adoms": ["global"]
+        }
+    ]
+    for test in payload:
+        adoms = parse_adoms_from_input(test["url"], test["data"])
+        assert adoms == test["adoms"], f"Expected adoms {test['adoms']} but got {adoms}"
+
+    # Payloads nested deeper than the depth cap are not searched
+    data = {"adom": "too-deep"}
+    for _ in range(generic_json_rpc_package.MAX_ADOM_SEARCH_DEPTH + 1):
+        data = {"nested": data}
+    assert parse_adoms_from_input("/sys/status", data) == ["global"]
+
+
 def test_parse_task_timeout(auth_config):
     payload = [
         {
@@ -469,3 +528,296 @@ def test_special_case(auth_config):
     assert "special_case_response" in response, "Response missing 'special_case_response' key"
     special_case_response = response.get("special_case_response", {})
     assert "message" in special_case_response, "Response missing 'message' key"
+
+
+def test_session_pool_reuse(auth_config):
+    session_pool.close_all()
+    params = {"url": "/sys/status"}
+    response = operations['json_rpc_get'](auth_config, params)
+    assert response.get("status", None) == 0
+    pooled = session_pool._idle.get(get_session_key(auth_config), [])
+    assert len(pooled) == 1, "Expected the session to be returned to the pool"
+    sid = pooled[0][0].sid
+
+    response = operations['json_rpc_get'](auth_config, params)
+    assert response.get("status", None) == 0
+    pooled = session_pool._idle.get(get_session_key(auth_config), [])
+    assert len(pooled) == 1 and pooled[0][0].sid == sid, "Expected the pooled session to be reused"
+
+    no_pool_config = auth_config.copy()
+    no_pool_config["session_idle_ttl"] = 0
+    response = operations['json_rpc_get'](no_pool_config, params)
+    assert response.get("status", None) == 0
+    assert not session_pool._idle.get(get_session_key(no_pool_config)), "Expected no pooled session with TTL 0"
+
+
+def test_lock_backoff_strategy(auth_config):
+    strategy = adom_lock_package.BackoffStrategy(timeout=60, base=0.5, cap=10)
+    delays = strategy.delays()
+    for _ in range(100):
+        delay = next(delays)
+        assert 0.5 <= delay <= 10, f"Expected backoff delay between base and cap but got {delay}"
+
+
+def test_rpc_add_reports_lock_wait(setup_params):
+    auth_config, params_add, params_delete = setup_params
+    response = operations['json_rpc_add'](auth_config, params_add)
+    assert response.get("status", None) == 0
+    if response.get("lock_wait_time") is not None:
+        assert response["lock_wait_time"] >= 0, "Expected a non negative lock wait time"
+    assert adom_lock_package.lock_wait_queue.waiting((get_config(auth_config)[0], "root")) == 0, \
+        "Expected the ADOM wait queue to be empty after the action"
+
+    response = operations['json_rpc_delete'](auth_config, params_delete)
+
+
+def test_rpc_bulk(auth_config):
+    address_objects = [
+        {"name": f"host-172-23-201-{i}", "subnet": [f"172.23.201.{i}", "255.255.255.255"], "type": "ipmask"}
+        for i in range(1, 6)
+    ]
+    items = [{"method": "add", "url": "/pm/config/adom/root/obj/firewall/address", "data": [addr_obj]}
+             for addr_obj in address_objects]
+    # Adding the first object twice makes one item fail without failing the rest of the batch
+    items.append(items[0])
+    response = operations['json_rpc_bulk'](auth_config, {"items": items, "chunk_size": 2})
+
+    assert "bulk_response" in response, "Response missing 'bulk_response' key"
+    assert response.get("total") == len(items), "Expected a result for every item"
+    assert response.get("requests") == 3, "Expected items to be packed into 3 requests"
+    assert response.get("failed") == 1, "Expected only the duplicate item to fail"
+    assert response["bulk_response"][-1]["status"] != 0, "Expected the duplicate item to report its failure"
+
+    items = [["delete", f"/pm/config/adom/root/obj/firewall/address/{addr_obj['name']}"]
+             for addr_obj in address_objects]
+    response = operations['json_rpc_bulk'](auth_config, {"items": items})
+
+    assert response.get("status") == 0, "Expected every delete to succeed"
+    assert response.get("succeeded") == len(address_objects)
+
+
+def test_rpc_get_paginated(auth_config):
+    params = {"url": "/pm/config/adom/root/obj/firewall/address", "fields": "name,subnet"}
+    full_response = operations['json_rpc_get'](auth_config, {"url": params["url"], "data": {"fields": ["name"]}})
+    expected_rows = len(full_response.get("get_response", []))
+
+    response = operations['json_rpc_get_paginated'](auth_config, dict(params, page_size=2))
+    assert response.get("status") == 0
+    assert response.get("rows") == expected_rows, "Expected the pages to add up to the full table"
+    assert len(response.get("get_response", [])) == expected_rows
+    assert all(set(row) <= {"name", "subnet", "oid"} for row in response["get_response"]), \
+        "Expected only the projected fields"
+
+    response = operations['json_rpc_get_paginated'](auth_config, dict(params, page_size=2, concurrency=4))
+    assert response.get("rows") == expected_rows, "Expected the parallel pages to add up to the full table"
+    assert [row["name"] for row in response["get_response"]] == \
+           [row["name"] for row in full_response.get("get_response", [])], "Expected pages to be reassembled in order"
+
+    response = operations['json_rpc_get_paginated'](auth_config, dict(params, page_size=2, output_mode="JSONL File"))
+    output_file = response.get("output_file")
+    try:
+        with open(output_file) as handle:
+            assert sum(1 for _ in handle) == expected_rows, "Expected one JSONL line per row"
+    finally:
+        os.remove(output_file)
+
+
+def test_async_rpc_operations(setup_params):
+    auth_config, params_add, params_delete = setup_params
+
+    async def run():
+        add_response, get_response = await asyncio.gather(
+            async_operations['json_rpc_add'](auth_config, params_add),
+            async_operations['json_rpc_get'](auth_config, {"url": "/sys/status"}))
+        delete_response = await async_operations['json_rpc_delete'](auth_config, params_delete)
+        return add_response, get_response, delete_response
+
+    add_response, get_response, delete_response = asyncio.run(run())
+    assert add_response.get("status", None) == 0
+    assert add_response.get("add_response", {}).get("name", None) == "host-172-23-200-121"
+    assert get_response.get("status", None) == 0 and get_response.get("get_response"), "Expected system status"
+    assert delete_response.get("status", None) == 0
+
+
+def test_rpc_execute_track_task_in_background(auth_config):
+    params = {
+        "url": "/dvm/cmd/add/device",
+        "data": {
+            "adom": "root",
+            "flags": ["create_task", "nonblocking"],
+            "device": {
+                "mr": 4,
+                "sn": "FGT60F0123456789",
+                "name": "",
+                "patch": 0,
+                "os_ver": 6,
+                "os_type": "fos",
+                "mgmt_mode": "fmg",
+                "device action": "add_model"
+            }
+        },
+        "track_task": True,
+        "track_task_in_background": True
+    }
+    response = operations['json_rpc_execute'](auth_config, params)
+    assert response.get("status", None) == 0
+    assert "task_handle" in response, "Response missing 'task_handle' key"
+    assert "task_response" not in response, "Expected the action to return before the task is tracked"
+
+    result = operations['json_rpc_get_task_result'](auth_config, {"handle": response["task_handle"]["handle"],
+                                                                  "wait_timeout": 300})
+    assert result.get("done"), "Expected the task to complete"
+    assert result.get("task_response", {}).get("percent", None) == 100, "Expected percent 100 in task response"
+
+    params = {
+        "url": "/dvm/cmd/del/device",
+        "data": {"data": {"adom": "root", "flags": ["create_task", "nonblocking"], "device": "FGT60F0123456789"}},
+        "track_task": True
+    }
+    response = operations['json_rpc_execute'](auth_config, params)
+    assert response.get("status", None) == 0
+
+
+def test_rpc_get_response_cache(setup_params):
+    auth_config, params_add, params_delete = setup_params
+    cache_config = dict(auth_config, cache_enabled=True, cache_ttls={"default": 300})
+    response_cache.clear()
+    params_get = {"url": "/pm/config/adom/root/obj/firewall/address", "data": {"fields": ["name"]}}
+
+    response = operations['json_rpc_get'](cache_config, params_get)
+    assert response.get("status", None) == 0
+    assert not response.get("cached"), "Expected the first get to reach FortiManager"
+    response = operations['json_rpc_get'](cache_config, params_get)
+    assert response.get("cached"), "Expected the second get to be served from the cache"
+
+    # A write to the same collection invalidates the cached table
+    operations['json_rpc_add'](cache_config, params_add)
+    try:
+        response = operations['json_rpc_get'](cache_config, params_get)
+        assert not response.get("cached"), "Expected the add to invalidate the cached response"
+        names = [row.get("name") for row in response.get("get_response", [])]
+        assert "host-172-23-200-121" in names, "Expected the added object in the fresh response"
+    finally:
+        operations['json_rpc_delete'](cache_config, params_delete)
+
+
+def test_rpc_get_disk_cache_and_shared_session(setup_params, tmp_path):
+    auth_config, params_add, params_delete = setup_params
+    cache_config = dict(auth_config, cache_enabled=True, cache_ttls={"default": 300}, cache_backend="Local Disk",
+                        cache_path=str(tmp_path / "cache.sqlite3"), share_sessions=True)
+    cache = response_cache_package.get_response_cache(cache_config)
+    cache.clear()
+    params_get = {"url": "/pm/config/adom/root/obj/firewall/address", "data": {"fields": ["name"]}}
+
+    response = operations['json_rpc_get'](cache_config, params_get)
+    assert response.get("status", None) == 0
+    assert not response.get("cached"), "Expected the first get to reach FortiManager"
+    response = operations['json_rpc_get'](cache_config, params_get)
+    assert response.get("cached"), "Expected the second get to be served from the disk cache"
+
+    operations['json_rpc_add'](cache_config, params_add)
+    try:
+        response = operations['json_rpc_get'](cache_config, params_get)
+        assert not response.get("cached"), "Expected the add to invalidate the cached response"
+    finally:
+        operations['json_rpc_delete'](cache_config, params_delete)
+
+    # A new worker adopts the published session id instead of logging in again
+    if cache_config.get("auth_method") == "Username/Password":
+        session_pool.close_all()
+        fmg = generic_json_rpc_package.open_session(cache_config)
+        if not fmg._lock_ctx.uses_workspace:
+            assert getattr(fmg, "shared_session", False), "Expected the published session id to be reused"
+            status, _ = fmg.get("/sys/status")
+            assert status == 0
+
+
+def test_rpc_workspace_transaction(setup_params):
+    auth_config, params_add, params_delete = setup_params
+    response = operations['json_rpc_begin_transaction'](auth_config, {"adoms": "root", "commit_every": 0,
+                                                                      "timeout": 120})
+    assert response.get("status", None) == 0
+    transaction_id = response["transaction_id"]
+
+    try:
+        response = operations['json_rpc_add'](auth_config, dict(params_add, transaction_id=transaction_id))
+        assert response.get("status", None) == 0
+        response = operations['json_rpc_delete'](auth_config, dict(params_delete, transaction_id=transaction_id))
+        assert response.get("status", None) == 0
+    finally:
+        response = operations['json_rpc_end_transaction'](auth_config, {"transaction_id": transaction_id})
+    assert response.get("status", None) == 0
+    assert response.get("writes") == 2
+
+    # The transaction is closed once ended
+    with pytest.raises(Exception):
+        operations['json_rpc_end_transaction'](auth_config, {"transaction_id": transaction_id})
+
+
+def test_rpc_fanout(setup_params):
+    auth_config, params_add, params_delete = setup_params
+    params_fanout = {
+        "method": "add",
+        "url": "/pm/config/adom/{adom}/obj/firewall/address",
+        "data": params_add["data"],
+        "adoms": "root",
+        "concurrency": 4
+    }
+    response = operations['json_rpc_fanout'](auth_config, params_fanout)
+    try:
+        assert response.get("status", None) == 0
+        assert [result["adom"] for result in response["fanout_response"]] == ["root"]
+    finally:
+        response = operations['json_rpc_fanout'](auth_config, dict(
+            params_fanout, method="delete", data={},
+            url=params_delete["url"].replace("/adom/root/", "/adom/{adom}/")))
+    assert response.get("succeeded") == 1
+
+
+def test_rpc_metrics(setup_params):
+    auth_config, params_add, params_delete = setup_params
+    metrics_config = dict(auth_config, include_metrics=True)
+    response = operations['json_rpc_add'](metrics_config, params_add)
+    try:
+        assert response.get("status", None) == 0
+        metrics = response.get("metrics", {})
+        assert {"parse", "session", "rpc"} <= set(metrics.get("phases", {}))
+        assert metrics.get("bytes_sent", 0) > 0 and metrics.get("bytes_received", 0) > 0
+    finally:
+        operations['json_rpc_delete'](metrics_config, params_delete)
+
+    response = operations['json_rpc_get_metrics'](auth_config, {})
+    assert response.get("status", None) == 0
+    assert 'fmg_rpc_phase_duration_seconds_bucket{action="add",phase="rpc",le="+Inf"}' in response["metrics"]
+
+
+def test_payload_log_summary(auth_config):
+    payload = {"data": [{"name": f"host-{i}", "subnet": ["10.0.0.1", "255.255.255.255"]} for i in range(10000)]}
+    payload_summary = log_utils_package.summarize(payload, {"log_max_size": 64})
+    summary = str(payload_summary)
+    assert "items=1" in summary and "sha256=" in summary
+    assert len(summary) < 200, "Expected the summary to be bounded by the max log size"
+    assert str(payload_summary) is summary, "Expected the summary to be rendered once"
+
+    trace = str(log_utils_package.summarize(payload, {"trace_payloads": True}))
+    assert trace.endswith('"host-9999", "subnet": ["10.0.0.1", "255.255.255.255"]}]}')
+
+
+def test_json_codecs(auth_config):
+    payload = {"url": "/pm/config/adom/root/obj/firewall/address", "data": [{"name": "h\u00f4st", "id": 2 ** 70}]}
+    selected = codec_package.get_codec().name
+    try:
+        for name in codec_package.CODECS:
+            try:
+                codec = codec_package.set_codec(name)
+            except operations_package.ConnectorError:
+                continue
+            assert codec.loads(codec.dumps(payload)) == payload
+            assert codec.loads(codec.dumps(payload).encode()) == payload
+            assert parse_data(codec.dumps(payload).encode()) == payload
+            with pytest.raises(operations_package.ConnectorError):
+                parse_data(b'{"url": ')
+    finally:
+        codec_package.set_codec(selected)
+    # Payloads that are already decoded are returned as they are
+    assert parse_data(payload) is payload
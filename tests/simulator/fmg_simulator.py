@@ -0,0 +1,499 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import argparse
+import fnmatch
+import json
+import random
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Status codes returned by the simulator, matching the ones the connector handles
+OK = 0
+OBJECT_EXISTS = -2
+OBJECT_NOT_FOUND = -3
+INVALID_URL = -6
+WORKSPACE_DISABLED = -9
+INVALID_SESSION = -11
+INTERNAL_ERROR = -1
+# FortiManager does not document a single code for these, the simulator uses one code for each
+LOCK_REQUIRED = -10
+LOCKED_BY_OTHER = -20055
+
+WORKSPACE_OPERATIONS = ("lock", "unlock", "commit")
+# Enum fields FortiManager returns as integers unless the get request sets verbose
+ENUM_VALUES = {"type": {"ipmask": 0, "iprange": 1, "fqdn": 2, "wildcard": 3}}
+
+
+class FMGSimulator:
+    """
+    Local stand-in for the FortiManager JSON-RPC API, serving plain HTTP on /jsonrpc.
+
+    It implements login and logout, get, add, set, update, replace and delete on an in-memory object store, exec with
+    /task/task progress and per device install lines, install previews, and the ADOM workspace lock, unlock and
+    commit. Latency, lock contention and errors can be injected to measure the connector without a live FortiManager.
+    Point the connector at it with config["address"] = simulator.address, or use simulator.config().
+
+    :param latency: Seconds added to every request
+    :param jitter: Maximum random seconds added on top of latency
+    :param lock_contention: Probability that a lock attempt fails as if another administrator held the ADOM
+    :param error_rate: Probability that a request fails with an internal error
+    :param session_expiry_rate: Probability that a session expires right before a request
+    :param workspace_mode: Whether ADOM writes must be locked and committed
+    :param adoms: Names of the ADOMs of the simulated server
+    :param task_duration: Seconds an exec task takes to reach 100 percent
+    :param commit_latency: Seconds added to every workspace commit
+    :param users: Dict of username to password, or None to accept any credentials
+    :param api_key: Accepted API key, or None to accept any key
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 lock_contention: float = 0.0, error_rate: float = 0.0, session_expiry_rate: float = 0.0,
+                 workspace_mode: bool = True, adoms: tuple = ("root",), task_duration: float = 2.0,
+                 commit_latency: float = 0.0, users=None, api_key=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.lock_contention = lock_contention
+        self.error_rate = error_rate
+        self.session_expiry_rate = session_expiry_rate
+        self.workspace_mode = workspace_mode
+        self.adoms = list(adoms)
+        self.task_duration = task_duration
+        self.commit_latency = commit_latency
+        self.users = users
+        self.api_key = api_key
+        self.random = random.Random(seed)
+        self.sessions = {}
+        self.locks = {}
+        self.tables = {}
+        self.tasks = {}
+        # Device names whose install tasks end in error
+        self.failing_devices = set()
+        # ADOMs listed with state 0, as disabled ADOMs are
+        self.disabled_adoms = set()
+        self.stats = {}
+        self._lock = threading.RLock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def config(self, auth_method: str = "Username/Password", **extra) -> dict:
+        """
+        Connector config pointing at the simulator.
+        """
+        config = {"address": self.address, "verify_ssl": False, "auth_method": auth_method}
+        if auth_method == "API Key":
+            config["api_key"] = self.api_key or "simulator-api-key"
+        else:
+            username, password = next(iter(self.users.items())) if self.users else ("admin", "password")
+            config.update({"username": username, "password": password})
+        config.update(extra)
+        return config
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fmg-simulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def _handler_class(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections alive so clients reuse them like they would with a real FortiManager
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, without this delayed ACKs add 40ms to every response
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                try:
+                    response = simulator.handle(json.loads(body), self.headers.get("Authorization"))
+                    status = 200
+                except (ValueError, KeyError, TypeError) as e:
+                    response, status = {"error": f"Malformed request: {e}"}, 400
+                payload = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def handle(self, request: dict, authorization=None) -> dict:
+        """
+        Answer one JSON-RPC request, shaped like FortiManager's responses.
+        """
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        method = request["method"]
+        params = request.get("params") or [{}]
+        self.count("requests")
+        self.count(f"method_{method}")
+        response = {"id": request.get("id")}
+
+        if params and params[0].get("url", "").strip("/") == "sys/login/user" and method == "exec":
+            data = params[0].get("data") or {}
+            if self.users is not None and self.users.get(data.get("user")) != data.get("passwd"):
+                response["result"] = [result_entry(params[0], -22, "Login fail")]
+                return response
+            session = str(uuid.uuid4())
+            with self._lock:
+                self.sessions[session] = data.get("user")
+            self.count("logins")
+            response["session"] = session
+            response["result"] = [result_entry(params[0], OK)]
+            return response
+
+        session = self.authenticate(request.get("session"), authorization)
+        if session is None:
+            response["result"] = [result_entry(params[0], INVALID_SESSION, "Invalid session")]
+            return response
+
+        if self.session_expiry_rate and self.random.random() < self.session_expiry_rate and \
+                not session.startswith("api-key:"):
+            self.logout(session)
+            self.count("expired_sessions")
+            response["result"] = [result_entry(params[0], INVALID_SESSION, "Invalid session")]
+            return response
+
+        response["result"] = [self.handle_param(method, param, session) for param in params]
+        if method == "get" and not request.get("verbose"):
+            for entry in response["result"]:
+                if "data" in entry:
+                    entry["data"] = without_verbose(entry["data"])
+        return response
+
+    def authenticate(self, session, authorization):
+        if authorization and authorization.startswith("Bearer "):
+            key = authorization[len("Bearer "):]
+            # Each API key client sends its own random session id, used to tell lock owners apart
+            return f"api-key:{session}" if self.api_key is None or key == self.api_key else None
+        with self._lock:
+            return session if session in self.sessions else None
+
+    def logout(self, session: str):
+        with self._lock:
+            self.sessions.pop(session, None)
+            for adom in [adom for adom, owner in self.locks.items() if owner == session]:
+                del self.locks[adom]
+
+    def handle_param(self, method: str, param: dict, session: str) -> dict:
+        url = "/" + param.get("url", "").strip("/")
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.count("injected_errors")
+            return result_entry(param, INTERNAL_ERROR, "Simulated internal error")
+        try:
+            if url == "/sys/logout":
+                self.logout(session)
+                return result_entry(param, OK)
+            if url == "/sys/status":
+                return result_entry(param, OK, data={"Hostname": "FMG-SIMULATOR", "Version": "v7.4.3-build2487",
+                                                     "Admin Domain Configuration": "Enabled"})
+            if url == "/cli/global/system/global":
+                return self.handle_system_global(method, param)
+            if url == "/dvmdb/adom" and method == "get":
+                return result_entry(param, OK, data=[{"name": adom, "state": int(adom not in self.disabled_adoms)}
+                                                     for adom in self.adoms])
+            if url.startswith("/task/task/"):
+                return self.handle_task(param, url.rsplit("/", 1)[1])
+            workspace = parse_workspace_url(url)
+            if workspace:
+                return self.handle_workspace(param, session, *workspace)
+            if method == "exec" and url == "/securityconsole/preview/result":
+                return self.handle_preview_result(param)
+            if method == "exec":
+                return self.create_task(param)
+            if method == "get":
+                return self.handle_get(param, url)
+            if method in ("add", "set", "update", "replace", "delete"):
+                return self.handle_write(method, param, url, session)
+            return result_entry(param, INVALID_URL, "Invalid url")
+        except Exception as e:
+            return result_entry(param, INTERNAL_ERROR, f"Simulator error: {e}")
+
+    def handle_system_global(self, method: str, param: dict) -> dict:
+        if method in ("set", "update"):
+            data = param.get("data") or {}
+            if "workspace-mode" in data:
+                self.workspace_mode = data["workspace-mode"] not in (0, "0", "disabled")
+            return result_entry(param, OK)
+        return result_entry(param, OK, data={"workspace-mode": 1 if self.workspace_mode else 0, "adom-status": 1})
+
+    def handle_workspace(self, param: dict, session: str, adom: str, operation: str) -> dict:
+        if not self.workspace_mode:
+            return result_entry(param, WORKSPACE_DISABLED, "Workspace mode is not enabled")
+        if adom != "global" and adom not in self.adoms:
+            return result_entry(param, INVALID_URL, "Invalid url")
+        with self._lock:
+            owner = self.locks.get(adom)
+            if operation == "lock":
+                self.count("lock_attempts")
+                if owner not in (None, session) or self.random.random() < self.lock_contention:
+                    self.count("lock_conflicts")
+                    return result_entry(param, LOCKED_BY_OTHER, "Workspace is locked by another user")
+                self.locks[adom] = session
+                return result_entry(param, OK)
+            if owner != session:
+                return result_entry(param, LOCK_REQUIRED, "Workspace is not locked by this session")
+            if operation == "unlock":
+                del self.locks[adom]
+                return result_entry(param, OK)
+        if self.commit_latency:
+            time.sleep(self.commit_latency)
+        self.count("commits")
+        return result_entry(param, OK)
+
+    def create_task(self, param: dict) -> dict:
+        data = param.get("data") or {}
+        # Install and preview tasks report one line per device of their scope
+        devices = (data.get("scope") or data.get("device") or []) if isinstance(data, dict) else []
+        devices = [(device.get("name"), device.get("vdom", "root")) for device in devices if isinstance(device, dict)]
+        with self._lock:
+            task_id = max(self.tasks, default=0) + 1
+            self.tasks[task_id] = (time.monotonic(), int(time.time()), devices)
+        self.count("tasks")
+        return result_entry(param, OK, data={"task": task_id})
+
+    def handle_task(self, param: dict, task_id: str) -> dict:
+        try:
+            started, start_tm, devices = self.tasks[int(task_id)]
+        except (KeyError, ValueError):
+            return result_entry(param, OBJECT_NOT_FOUND, "Object does not exist")
+        elapsed = time.monotonic() - started
+        percent = 100 if self.task_duration <= 0 else min(100, int(elapsed / self.task_duration * 100))
+        lines = []
+        for name, vdom in devices:
+            failed = percent == 100 and name in self.failing_devices
+            lines.append({"name": name, "vdom": vdom, "percent": percent, "err": 1 if failed else 0,
+                          "state": "error" if failed else "done" if percent == 100 else "running",
+                          "detail": "install failed" if failed else "install and save finished status=OK"
+                          if percent == 100 else "installing"})
+        num_err = sum(1 for line in lines if line["err"])
+        return result_entry(param, OK, data={"id": int(task_id), "percent": percent,
+                                             "num_done": len(lines) - num_err if percent == 100 else 0,
+                                             "num_err": num_err, "num_lines": len(lines) or 1, "start_tm": start_tm,
+                                             "end_tm": int(time.time()) if percent == 100 else 0, "line": lines,
+                                             "state": "done" if percent == 100 else "running"})
+
+    def handle_preview_result(self, param: dict) -> dict:
+        devices = (param.get("data") or {}).get("device") or []
+        message = "".join(f"{device.get('name')}: config firewall policy\n    edit 1\n    next\nend\n"
+                          for device in devices if isinstance(device, dict))
+        return result_entry(param, OK, data={"message": message})
+
+    def check_write_lock(self, url: str, session: str):
+        if not self.workspace_mode:
+            return None
+        adom = parse_url_adom(url)
+        if adom is None:
+            return None
+        with self._lock:
+            if self.locks.get(adom) != session:
+                return LOCK_REQUIRED
+        return None
+
+    def handle_get(self, param: dict, url: str) -> dict:
+        with self._lock:
+            table = self.tables.get(url)
+            if table is None:
+                parent, _, name = url.rpartition("/")
+                obj = self.tables.get(parent, {}).get(name)
+                if obj is None:
+                    # Unknown tables read as empty, like a FortiManager table with no entries
+                    if "/obj/" in url or "/adom/" in url:
+                        return result_entry(param, OK, data=[])
+                    return result_entry(param, OBJECT_NOT_FOUND, "Object does not exist")
+                return result_entry(param, OK, data=project(obj, param.get("fields")))
+            rows = [row for row in table.values() if matches_filter(row, param.get("filter"))]
+        if param.get("option") == "count":
+            return result_entry(param, OK, data=len(rows))
+        if param.get("option") == "chksum":
+            # Changes with every write to the table, like the FortiManager table checksum
+            return result_entry(param, OK, data={"chksum": zlib.crc32(json.dumps(rows, sort_keys=True).encode())})
+        if param.get("range"):
+            offset, limit = param["range"]
+            rows = rows[offset:offset + limit]
+        if not rows:
+            # FortiManager omits the data key for an empty table page
+            return result_entry(param, OK)
+        return result_entry(param, OK, data=[project(row, param.get("fields")) for row in rows])
+
+    def handle_write(self, method: str, param: dict, url: str, session: str) -> dict:
+        code = self.check_write_lock(url, session)
+        if code is not None:
+            return result_entry(param, code, "Workspace lock is required")
+        data = param.get("data")
+        with self._lock:
+            if method == "delete":
+                if url in self.tables:
+                    self.tables[url].clear()
+                    return result_entry(param, OK)
+                parent, _, name = url.rpartition("/")
+                if name not in self.tables.get(parent, {}):
+                    return result_entry(param, OBJECT_NOT_FOUND, "Object does not exist")
+                del self.tables[parent][name]
+                return result_entry(param, OK)
+
+            rows = data if isinstance(data, list) else [data]
+            table_url = url
+            parent, _, name = url.rpartition("/")
+            if name in self.tables.get(parent, {}) or (isinstance(data, dict) and "name" not in data):
+                # Write to a single object URL
+                table_url = parent
+                rows = [dict(data or {}, name=name)]
+            table = self.tables.setdefault(table_url, OrderedDict())
+            for row in rows:
+                if not isinstance(row, dict) or "name" not in row:
+                    return result_entry(param, INVALID_URL, "Object name is required")
+                exists = str(row["name"]) in table
+                if method == "add" and exists:
+                    return result_entry(param, OBJECT_EXISTS, "Object already exists")
+                if method == "update" and not exists:
+                    return result_entry(param, OBJECT_NOT_FOUND, "Object does not exist")
+                if method == "update":
+                    table[str(row["name"])].update(row)
+                else:
+                    table[str(row["name"])] = dict(row)
+            return result_entry(param, OK, data={"name": rows[-1]["name"]} if len(rows) == 1 else None)
+
+
+def result_entry(param: dict, code: int, message: str = "OK", data=None) -> dict:
+    entry = {"status": {"code": code, "message": message}, "url": param.get("url", "")}
+    if data is not None:
+        entry["data"] = data
+    return entry
+
+
+def without_verbose(data):
+    """
+    Get response data as FortiManager returns it without the verbose flag, enum values as integers.
+    """
+    if isinstance(data, list):
+        return [without_verbose(row) for row in data]
+    if not isinstance(data, dict):
+        return data
+    return {key: ENUM_VALUES[key].get(value, value) if key in ENUM_VALUES and isinstance(value, str) else value
+            for key, value in data.items()}
+
+
+def parse_workspace_url(url: str):
+    parts = url.strip("/").split("/")
+    if len(parts) == 4 and parts[0] == "dvmdb" and parts[1] == "global" and parts[2] == "workspace" and \
+            parts[3] in WORKSPACE_OPERATIONS:
+        return "global", parts[3]
+    if len(parts) == 5 and parts[:2] == ["dvmdb", "adom"] and parts[3] == "workspace" and \
+            parts[4] in WORKSPACE_OPERATIONS:
+        return parts[2], parts[4]
+    if len(parts) == 6 and parts[:3] == ["pm", "config", "adom"] and parts[4] == "workspace" and \
+            parts[5] == "commit":
+        return parts[3], "commit"
+    return None
+
+
+def parse_url_adom(url: str):
+    parts = url.strip("/").split("/")
+    if "adom" in parts and parts.index("adom") + 1 < len(parts):
+        return parts[parts.index("adom") + 1]
+    if parts[:3] == ["pm", "config", "global"]:
+        return "global"
+    return None
+
+
+def project(row: dict, fields) -> dict:
+    if not fields:
+        return dict(row)
+    return {key: value for key, value in row.items() if key in fields or key == "name"}
+
+
+def matches_filter(row: dict, filter_value) -> bool:
+    """
+    Evaluate a FortiManager style filter: [field, op, value...], or a list of those joined with "&&" or "||".
+    """
+    if not filter_value:
+        return True
+    if isinstance(filter_value[0], list):
+        result = matches_filter(row, filter_value[0])
+        for position in range(1, len(filter_value) - 1, 2):
+            operator, condition = filter_value[position], filter_value[position + 1]
+            if operator == "||":
+                result = result or matches_filter(row, condition)
+            else:
+                result = result and matches_filter(row, condition)
+        return result
+    field, operator, *values = filter_value
+    value = row.get(field)
+    if operator == "==":
+        return value == values[0]
+    if operator == "!=":
+        return value != values[0]
+    if operator == "in":
+        return value in values
+    if operator == "like":
+        return fnmatch.fnmatchcase(str(value), str(values[0]).replace("%", "*"))
+    if operator == "contain":
+        return values[0] in (value or [])
+    raise ValueError(f"Unsupported filter operator: {operator}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local FortiManager JSON-RPC simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--lock-contention", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--session-expiry-rate", type=float, default=0.0)
+    parser.add_argument("--no-workspace", action="store_true")
+    parser.add_argument("--adoms", default="root", help="Comma separated ADOM names")
+    parser.add_argument("--task-duration", type=float, default=2.0)
+    parser.add_argument("--commit-latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    simulator = FMGSimulator(args.host, args.port, args.latency, args.jitter, args.lock_contention, args.error_rate,
+                             args.session_expiry_rate, not args.no_workspace, tuple(args.adoms.split(",")),
+                             args.task_duration, args.commit_latency)
+    print(f"FortiManager simulator listening on {simulator.address}")
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
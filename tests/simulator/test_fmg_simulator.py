@@ -0,0 +1,633 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc
+Copyright end
+"""
+
+import asyncio
+import gc
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+import pyFMG.fortimgr
+
+# Add the grandparent directory to the system path
+current_directory = os.path.dirname(__file__)
+grandparent_directory = os.path.abspath(os.path.join(current_directory, os.pardir, os.pardir))
+sys.path.insert(0, str(grandparent_directory))
+
+from tests.simulator.fmg_simulator import FMGSimulator  # noqa: E402
+
+# Import the operations dynamically
+operations_module_name = "fortinet-fortimanager-json-rpc.operations"
+operations_package = importlib.import_module(operations_module_name)
+operations = operations_package.operations
+
+session_pool_module_name = "fortinet-fortimanager-json-rpc.session_pool"
+session_pool = importlib.import_module(session_pool_module_name).session_pool
+
+health_module_name = "fortinet-fortimanager-json-rpc.health"
+health_checker = importlib.import_module(health_module_name).health_checker
+
+async_operations = operations_package.async_operations
+transaction_manager = importlib.import_module("fortinet-fortimanager-json-rpc.workspace_txn").transaction_manager
+async_session_pool = importlib.import_module("fortinet-fortimanager-json-rpc.async_rpc").async_session_pool
+
+single_flight_module = importlib.import_module("fortinet-fortimanager-json-rpc.single_flight")
+cache_backends_module = importlib.import_module("fortinet-fortimanager-json-rpc.cache_backends")
+generic_json_rpc_module = importlib.import_module("fortinet-fortimanager-json-rpc.generic_json_rpc")
+metrics_module = importlib.import_module("fortinet-fortimanager-json-rpc.metrics")
+
+address_index_module_name = "fortinet-fortimanager-json-rpc.address_index"
+address_index_cache = importlib.import_module(address_index_module_name).address_index_cache
+
+ADDRESS_URL = "/pm/config/adom/root/obj/firewall/address"
+
+
+@pytest.fixture
+def simulator():
+    with FMGSimulator(adoms=("root", "customer-a"), task_duration=0.2, seed=1) as fmg_simulator:
+        yield fmg_simulator
+    session_pool.close_all()
+    health_checker.reset()
+    address_index_cache.clear()
+
+
+@pytest.fixture(params=["Username/Password", "API Key"])
+def simulator_config(request, simulator):
+    return simulator.config(request.param, lock_timeout=2)
+
+
+def test_simulator_add_get_delete(simulator_config):
+    params_add = {"url": ADDRESS_URL, "data": [{"name": "host-10.0.0.1", "subnet": ["10.0.0.1", "255.255.255.255"]}]}
+    response = operations['json_rpc_add'](simulator_config, params_add)
+    assert response.get("status", None) == 0
+    assert response["add_response"] == {"name": "host-10.0.0.1"}
+
+    response = operations['json_rpc_get'](simulator_config, {"url": f"{ADDRESS_URL}/host-10.0.0.1"})
+    assert response["get_response"]["subnet"] == ["10.0.0.1", "255.255.255.255"]
+
+    response = operations['json_rpc_delete'](simulator_config, {"url": f"{ADDRESS_URL}/host-10.0.0.1"})
+    assert response.get("status", None) == 0
+
+
+def test_simulator_codec_scoped_to_connector_sessions(simulator, simulator_config):
+    # Request bodies are sent as UTF-8 whatever the codec escapes
+    name = "h\u00f4st-\u4e3b"
+    response = operations['json_rpc_add'](simulator_config, {"url": ADDRESS_URL, "data": [{"name": name}]})
+    assert response.get("status", None) == 0 and list(simulator.tables[ADDRESS_URL]) == [name]
+    # pyFMG keeps the json module for FortiManager instances created outside the connector
+    assert pyFMG.fortimgr.json is json
+
+    fmg = generic_json_rpc_module.create_session(dict(simulator_config, address="http://127.0.0.1:1"))
+    fmg._url, fmg.sid = "http://127.0.0.1:1/jsonrpc", "session"
+    with pytest.raises(pyFMG.fortimgr.FMGConnectionError):
+        fmg.get(ADDRESS_URL)
+
+
+def test_metrics_count_encoded_bytes():
+    fmg = metrics_module.instrument_session(SimpleNamespace(sess=SimpleNamespace(hooks={"response": []})))
+    count_bytes = fmg.sess.hooks["response"][0]
+    count_bytes(SimpleNamespace(request=SimpleNamespace(body='{"name": "h\u00f4st"}'), content=b"{}"))
+    count_bytes(SimpleNamespace(request=SimpleNamespace(body=b"{}"), content=None))
+    assert (fmg.bytes_sent, fmg.bytes_received) == (len('{"name": "h\u00f4st"}') + 1 + 2, 2)
+
+
+def test_simulator_workspace_commit(simulator, simulator_config):
+    operations['json_rpc_add'](simulator_config, {"url": ADDRESS_URL, "data": [{"name": "host-10.0.0.2"}]})
+    assert simulator.stats.get("commits", 0) == 1
+    assert not simulator.locks, "Expected the ADOM to be unlocked after the action"
+
+
+
+def test_simulator_fanout_all_adoms(simulator, simulator_config):
+    simulator.adoms += ["customer-b", "FortiCarrier", "Syslog", "Unmanaged_Devices"]
+    simulator.disabled_adoms.add("customer-b")
+    params = {"method": "add", "adoms": "all", "url": "/pm/config/adom/{adom}/obj/firewall/address",
+              "data": {"name": "host-10.0.9.1"}}
+    response = operations['json_rpc_fanout'](simulator_config, params)
+    # all is every enabled ADOM except the built-in ones FortiManager creates for other products and logs
+    assert response["status"] == 0
+    assert sorted(result["adom"] for result in response["fanout_response"]) == ["customer-a", "root"]
+
+def test_simulator_execute_track_task(simulator_config):
+    params = {"url": "/securityconsole/install/package", "data": {"adom": "root"}, "track_task": True}
+    response = operations['json_rpc_execute'](simulator_config, params)
+    assert response.get("status", None) == 0
+    assert response["task_response"]["percent"] == 100
+
+
+
+def test_simulator_background_task_special_case(simulator, simulator_config, monkeypatch):
+    threads = []
+    handle_special_cases = generic_json_rpc_module.handle_special_cases
+
+    def record_thread(*args):
+        threads.append(threading.current_thread().name)
+        return handle_special_cases(*args)
+
+    monkeypatch.setattr(generic_json_rpc_module, "handle_special_cases", record_thread)
+    params = {"url": "/securityconsole/install/preview", "data": {"adom": "root"}, "track_task": True,
+              "track_task_in_background": True}
+    response = operations['json_rpc_execute'](simulator_config, params)
+    # A slow follow up call must still finish before waiters see the task as done
+    simulator.latency = 0.3
+    result = operations['json_rpc_get_task_result'](simulator_config, {"handle": response["task_handle"],
+                                                                       "wait_timeout": 30})
+    assert result["done"] and result["status"] == 0
+    assert "special_case_response" in result
+    # The follow up call ran on a callback thread, not on the poller
+    assert threads and threads[0].startswith("fmg-task-callback")
+
+def test_simulator_lock_contention(simulator, simulator_config):
+    simulator.lock_contention = 1
+    with pytest.raises(operations_package.ConnectorError):
+        operations['json_rpc_add'](simulator_config, {"url": ADDRESS_URL, "data": [{"name": "host-10.0.0.3"}]})
+    assert simulator.stats.get("lock_conflicts", 0) > 1, "Expected the lock to be retried"
+
+
+def test_simulator_lock_error_releases_queue(simulator, monkeypatch):
+    config = simulator.config(lock_timeout=2)
+    lock_adom = pyFMG.fortimgr.FortiManager.lock_adom
+    failures = []
+
+    def failing_lock_adom(fmg, adom=None, *args, **kwargs):
+        if not failures:
+            failures.append(adom)
+            raise pyFMG.fortimgr.FMGConnectionError("Simulated connection error")
+        return lock_adom(fmg, adom, *args, **kwargs)
+
+    monkeypatch.setattr(pyFMG.fortimgr.FortiManager, "lock_adom", failing_lock_adom)
+    with pytest.raises(operations_package.ConnectorError):
+        operations['json_rpc_add'](config, {"url": ADDRESS_URL, "data": [{"name": "host-10.0.0.4"}]})
+    # The failed attempt left the ADOM queue, so the next write does not wait for the lock timeout
+    response = operations['json_rpc_add'](config, {"url": ADDRESS_URL, "data": [{"name": "host-10.0.0.4"}]})
+    assert response.get("status", None) == 0 and failures == ["root"]
+
+
+def test_simulator_session_expiry(simulator):
+    config = simulator.config()
+    operations['json_rpc_get'](config, {"url": "/sys/status"})
+    simulator.sessions.clear()
+    # The pooled session has expired on the server, the connector logs in again transparently
+    response = operations['json_rpc_get'](config, {"url": "/sys/status"})
+    assert response.get("status", None) == 0
+    assert simulator.stats["logins"] == 2
+
+
+
+def test_simulator_shared_session_relogin(simulator, tmp_path):
+    simulator.workspace_mode = False
+    config = simulator.config(share_sessions=True, cache_backend="Local Disk",
+                              cache_path=str(tmp_path / "cache.sqlite3"))
+    operations['json_rpc_get'](config, {"url": "/sys/status"})
+    simulator.sessions.clear()
+    response = operations['json_rpc_get'](config, {"url": "/sys/status"})
+    assert response.get("status", None) == 0 and len(simulator.sessions) == 1
+    # The published session id expired, the one logged in to replace it is private to this worker and logged out
+    session_pool.close_all()
+    assert not simulator.sessions
+
+def test_simulator_bulk_session_expiry(simulator):
+    config = simulator.config()
+    operations['json_rpc_get'](config, {"url": "/sys/status"})
+    simulator.sessions.clear()
+    # Free form requests report the expired session per item, the chunk is sent again after logging in. Gets take no
+    # ADOM lock, so the bulk request is the first to meet the expired session
+    response = operations['json_rpc_bulk'](config, {"items": [{"method": "get", "url": ADDRESS_URL},
+                                                              {"method": "get", "url": "/sys/status"}]})
+    assert response["status"] == 0 and response["succeeded"] == 2
+    assert simulator.stats["logins"] == 2
+
+
+def test_simulator_error_injection(simulator, simulator_config):
+    simulator.error_rate = 1
+    simulator.workspace_mode = False
+    response = operations['json_rpc_get'](simulator_config, {"url": ADDRESS_URL})
+    assert response.get("status", None) == -1
+
+
+def test_simulator_health_check(simulator):
+    config = simulator.config(health_cache_window=60)
+    operations['json_rpc_get'](config, {"url": "/sys/status"})
+    response = operations['check_health'](config)
+    assert response["cached"] is False and response["latency"] > 0
+    assert simulator.stats["logins"] == 1, "Expected the probe to reuse the pooled session"
+    # The second check is served from the cached probe
+    requests = simulator.stats["requests"]
+    assert operations['check_health'](config)["cached"] is True
+    assert simulator.stats["requests"] == requests
+
+    unreachable = dict(config, address="http://127.0.0.1:1")
+    with pytest.raises(operations_package.ConnectorError):
+        operations['check_health'](unreachable)
+    # Unreachable servers are not probed again until their backoff has passed
+    with pytest.raises(operations_package.ConnectorError, match="next probe in"):
+        operations['check_health'](unreachable)
+
+
+def test_simulator_install_pipeline(simulator):
+    simulator.failing_devices = {"FGT-3"}
+    params = {
+        "adom": "root",
+        "packages": [
+            {"pkg": "branch", "scope": [{"name": "FGT-1", "vdom": "root"}, {"name": "FGT-2", "vdom": "root"}]},
+            {"pkg": "datacenter", "scope": [{"name": "FGT-3", "vdom": "root"}]}
+        ]
+    }
+    response = operations['json_rpc_install_packages'](simulator.config(), params)
+    assert response["status"] == 1
+    assert response["failed"] == ["datacenter"]
+    branch, datacenter = response["packages"]
+    assert branch["status"] == "installed"
+    assert "FGT-1: config firewall policy" in branch["preview"]["result"]["message"]
+    assert [device["state"] for device in branch["install"]["task"]["devices"]] == ["done", "done"]
+    # The preview of datacenter failed on FGT-3, so it was not installed
+    assert datacenter["status"] == "failed" and "install" not in datacenter
+    assert response["devices"]["FGT-3/root"]["err"] == 1
+    assert any(event["device"] == "FGT-2/root" and event["percent"] == 100 for event in response["progress"])
+
+
+def test_simulator_install_pipeline_streams_progress(simulator):
+    install_pipeline = importlib.import_module("fortinet-fortimanager-json-rpc.install_pipeline")
+    params = {"packages": [{"pkg": "branch", "scope": [{"name": "FGT-1", "vdom": "root"}]}], "mode": "Install Only"}
+    events = []
+    response = install_pipeline.perform_install_pipeline(simulator.config(), params, events.append)
+    # Every event was passed on as it was read, the result only logs them
+    assert response["status"] == 0 and events and events == response["progress"]
+
+
+def test_simulator_sync(simulator):
+    config = simulator.config()
+    objects = [{"name": f"host-10.0.1.{i}", "subnet": [f"10.0.1.{i}", "255.255.255.255"]} for i in range(5)]
+    operations['json_rpc_bulk'](config, {"items": [{"method": "add", "url": ADDRESS_URL, "data": obj}
+                                                   for obj in objects + [{"name": "stale"}]]})
+    commits = simulator.stats["commits"]
+
+    desired = [dict(obj) for obj in objects[1:]]
+    desired.append({"name": "host-10.0.1.9", "subnet": ["10.0.1.9", "255.255.255.255"]})
+    desired[0]["subnet"] = ["10.0.1.99", "255.255.255.255"]
+    params = {"url": ADDRESS_URL, "objects": desired, "delete_missing": True, "dry_run": True}
+    response = operations['json_rpc_sync'](config, params)
+    assert response["summary"] == {"added": 1, "updated": 1, "deleted": 2, "unchanged": 3, "current": 6, "desired": 5}
+    assert simulator.stats["commits"] == commits, "Expected a dry run not to write"
+
+    response = operations['json_rpc_sync'](config, dict(params, dry_run=False))
+    assert response["status"] == 0 and response["requests"] == 3
+    assert simulator.stats["commits"] == commits + 1, "Expected every write under a single commit"
+    assert sorted(simulator.tables[ADDRESS_URL]) == sorted(obj["name"] for obj in desired)
+
+    # Nothing differs anymore, so nothing is written
+    response = operations['json_rpc_sync'](config, dict(params, dry_run=False))
+    assert response["summary"]["unchanged"] == 5 and "requests" not in response
+
+
+def test_simulator_sync_without_verbose(simulator):
+    # Without verbose output FortiManager returns enums as integers, the sync still compares the symbolic values
+    config = simulator.config(verbose_json=False)
+    objects = [{"name": f"host-10.0.4.{i}", "type": "ipmask", "subnet": [f"10.0.4.{i}", "255.255.255.255"]}
+               for i in range(3)]
+    operations['json_rpc_bulk'](config, {"items": [{"method": "add", "url": ADDRESS_URL, "data": obj}
+                                                   for obj in objects]})
+    response = operations['json_rpc_get'](config, {"url": f"{ADDRESS_URL}/host-10.0.4.0"})
+    assert response["get_response"]["type"] == 0
+
+    response = operations['json_rpc_sync'](config, {"url": ADDRESS_URL, "objects": objects, "dry_run": True})
+    assert response["summary"]["unchanged"] == 3 and not response["diff"]["updated"]
+
+
+def test_simulator_sync_subnet_forms(simulator):
+    config = simulator.config()
+    objects = [{"name": f"host-10.0.5.{i}", "subnet": [f"10.0.5.{i}", "255.255.255.255"]} for i in range(3)]
+    operations['json_rpc_bulk'](config, {"items": [{"method": "add", "url": ADDRESS_URL, "data": obj}
+                                                   for obj in objects]})
+    # The same subnets given as strings are unchanged, a different mask is not
+    desired = [{"name": "host-10.0.5.0", "subnet": "10.0.5.0/32"},
+               {"name": "host-10.0.5.1", "subnet": "10.0.5.1 255.255.255.255"},
+               {"name": "host-10.0.5.2", "subnet": "10.0.5.2/24"}]
+    response = operations['json_rpc_sync'](config, {"url": ADDRESS_URL, "objects": desired, "dry_run": True})
+    assert response["summary"]["unchanged"] == 2
+    assert [update["name"] for update in response["diff"]["updated"]] == ["host-10.0.5.2"]
+
+
+def test_simulator_object_mirror(simulator, tmp_path):
+    config = simulator.config(mirror_path=str(tmp_path / "mirror.sqlite3"))
+    objects = [{"name": f"host-10.0.2.{i}", "subnet": [f"10.0.2.{i}", "255.255.255.255"]} for i in range(50)]
+    operations['json_rpc_add'](config, {"url": ADDRESS_URL, "data": objects})
+
+    params = {"url": ADDRESS_URL, "attributes": {"subnet": "10.0.2.7"}, "max_staleness": 0}
+    response = operations['json_rpc_mirror_query'](config, params)
+    assert [obj["name"] for obj in response["objects"]] == ["host-10.0.2.7"]
+    assert response["mirror"]["added"] == 50
+    assert os.stat(tmp_path / "mirror.sqlite3").st_mode & 0o777 == 0o600
+
+    # Within the staleness bound FortiManager is not asked at all
+    requests = simulator.stats["requests"]
+    response = operations['json_rpc_mirror_query'](config, dict(params, max_staleness=3600))
+    assert response["count"] == 1 and simulator.stats["requests"] == requests
+
+    # Past it, an unchanged checksum keeps the mirror without reading the table again
+    gets = simulator.stats["method_get"]
+    response = operations['json_rpc_mirror_query'](config, params)
+    assert response["mirror"] == {"refreshed": False, "checksum_checked": True, "age": 0}
+    assert simulator.stats["method_get"] == gets + 1
+
+    operations['json_rpc_set'](config, {"url": ADDRESS_URL, "data": [{"name": "host-10.0.2.7",
+                                                                      "subnet": ["10.0.3.7", "255.255.255.255"]}]})
+    response = operations['json_rpc_mirror_query'](config, params)
+    assert response["count"] == 0
+    assert (response["mirror"]["added"], response["mirror"]["updated"]) == (0, 1)
+
+    # Another account on the same server gets its own mirror, read with its own rights
+    other_config = dict(config, username="auditor")
+    response = operations['json_rpc_mirror_query'](other_config, dict(params, max_staleness=3600))
+    assert response["mirror"]["refreshed"] and response["mirror"]["added"] == 50
+
+
+def test_simulator_address_lookup(simulator):
+    config = simulator.config()
+    addresses = [{"name": "net-10", "subnet": ["10.0.0.0", "255.0.0.0"]},
+                 {"name": "host-10.1.2.3", "subnet": "10.1.2.3/32"},
+                 {"name": "range-10.1.2", "type": "iprange", "start-ip": "10.1.2.1", "end-ip": "10.1.2.20"},
+                 {"name": "wildcard-x.x.x.3", "type": "wildcard", "wildcard": ["0.0.0.3", "0.0.0.255"]},
+                 {"name": "web", "type": "fqdn", "fqdn": "example.com"}]
+    groups = [{"name": "grp-hosts", "member": ["host-10.1.2.3"]},
+              {"name": "grp-servers", "member": ["grp-hosts", "range-10.1.2"]},
+              {"name": "grp-all", "member": ["grp-servers", "web"]}]
+    operations['json_rpc_add'](config, {"url": ADDRESS_URL, "data": addresses})
+    operations['json_rpc_add'](config, {"url": "/pm/config/adom/root/obj/firewall/addrgrp", "data": groups})
+
+    params = {"queries": "10.1.2.3, 10.1.2.0/28, 192.168.0.1", "max_staleness": 0}
+    response = operations['json_rpc_address_lookup'](config, params)
+    results = response["results"]
+    assert results["10.1.2.3"] == {"addresses": ["host-10.1.2.3", "net-10", "range-10.1.2", "wildcard-x.x.x.3"],
+                                   "groups": ["grp-all", "grp-hosts", "grp-servers"]}
+    # The range starts at 10.1.2.1, so it does not cover the whole subnet
+    assert results["10.1.2.0/28"] == {"addresses": ["net-10"], "groups": []}
+    assert results["192.168.0.1"] == {"addresses": [], "groups": []}
+    assert response["index"]["rebuilt"] and response["index"]["addresses"] == 5
+
+    # Within the staleness bound the cached index answers without FortiManager
+    requests = simulator.stats["requests"]
+    response = operations['json_rpc_address_lookup'](config, dict(params, max_staleness=3600))
+    assert not response["index"]["rebuilt"] and simulator.stats["requests"] == requests
+
+    # Past it, unchanged checksums keep the index, a changed table rebuilds it
+    response = operations['json_rpc_address_lookup'](config, params)
+    assert not response["index"]["rebuilt"]
+    operations['json_rpc_set'](config, {"url": ADDRESS_URL, "data": [{"name": "host-10.1.2.3",
+                                                                      "subnet": "10.9.9.9/32"}]})
+    response = operations['json_rpc_address_lookup'](config, params)
+    assert response["index"]["rebuilt"]
+    assert response["results"]["10.1.2.3"]["groups"] == ["grp-all", "grp-servers"]
+
+
+def test_simulator_coalesced_gets(simulator):
+    config = simulator.config(coalesce_reads=True)
+    operations['json_rpc_add'](config, {"url": ADDRESS_URL, "data": [{"name": "host-10.0.4.1",
+                                                                      "subnet": ["10.0.4.1", "255.255.255.255"]}]})
+    operations['json_rpc_get'](config, {"url": ADDRESS_URL})
+    simulator.latency = 0.5
+    gets = simulator.stats["method_get"]
+    barrier = threading.Barrier(8)
+
+    def get(_):
+        barrier.wait()
+        return operations['json_rpc_get'](config, {"url": ADDRESS_URL})
+
+    with ThreadPoolExecutor(8) as executor:
+        responses = list(executor.map(get, range(8)))
+    coalesced = [response for response in responses if response.get("coalesced")]
+    assert all(response["get_response"][0]["name"] == "host-10.0.4.1" for response in responses)
+    assert len(coalesced) >= 6 and simulator.stats["method_get"] - gets == 8 - len(coalesced)
+    # Every caller gets its own copy of the shared response
+    assert len({id(response["get_response"]) for response in responses}) == 8
+
+    # Gets that bypass the cache are never coalesced
+    with ThreadPoolExecutor(2) as executor:
+        responses = list(executor.map(lambda _: operations['json_rpc_get'](config, {"url": ADDRESS_URL,
+                                                                                    "bypass_cache": True}), range(2)))
+    assert not any(response.get("coalesced") for response in responses)
+
+
+def test_simulator_coalesced_gets_read_own_writes(simulator):
+    config = simulator.config(coalesce_reads=True)
+    handle_get = simulator.handle_get
+    in_flight = threading.Event()
+
+    def slow_first_get(param, url):
+        # The first get of the table is still in flight while the add and the next get run
+        if url == ADDRESS_URL and not in_flight.is_set():
+            in_flight.set()
+            time.sleep(1)
+        return handle_get(param, url)
+
+    simulator.handle_get = slow_first_get
+    with ThreadPoolExecutor(1) as executor:
+        slow_get = executor.submit(operations['json_rpc_get'], config, {"url": ADDRESS_URL})
+        in_flight.wait()
+        operations['json_rpc_add'](config, {"url": ADDRESS_URL, "data": [{"name": "host-10.0.6.1",
+                                                                          "subnet": ["10.0.6.1", "255.255.255.255"]}]})
+        response = operations['json_rpc_get'](config, {"url": ADDRESS_URL})
+        assert not slow_get.result().get("coalesced")
+    assert not response.get("coalesced")
+    assert [obj["name"] for obj in response["get_response"]] == ["host-10.0.6.1"]
+
+
+def test_single_flight_across_processes(tmp_path):
+    # Two SingleFlight instances stand in for two worker processes sharing the lock directory
+    first, second = single_flight_module.SingleFlight(), single_flight_module.SingleFlight()
+    started = threading.Event()
+    calls = []
+
+    def slow_call():
+        calls.append("first")
+        started.set()
+        time.sleep(0.3)
+        return {"status": 0, "value": 1}
+
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(first.do, "key", slow_call, str(tmp_path))
+        started.wait()
+        result, shared = second.do("key", lambda: calls.append("second"), str(tmp_path))
+        assert future.result() == ({"status": 0, "value": 1}, False)
+    assert (result, shared, calls) == ({"status": 0, "value": 1}, True, ["first"])
+
+    # A result written before the call started is not reused
+    result, shared = second.do("key", lambda: {"status": 0, "value": 2}, str(tmp_path))
+    assert (result, shared) == ({"status": 0, "value": 2}, False)
+
+    # Nor one sent before the caller's last write
+    started.clear()
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(first.do, "key", slow_call, str(tmp_path))
+        started.wait()
+        result, shared = second.do("key", lambda: {"status": 0, "value": 3}, str(tmp_path),
+                                   not_before=time.time())
+        future.result()
+    assert (result, shared) == ({"status": 0, "value": 3}, False)
+
+
+def test_disk_cache_file_permissions(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.sqlite3")
+    backend = cache_backends_module.SqliteCacheBackend(path)
+    backend.set("key", "value", 60)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    # A file other users can write is refused rather than read
+    os.chmod(path, 0o666)
+    with pytest.raises(cache_backends_module.ConnectorError, match="writable by its group or others"):
+        cache_backends_module.SqliteCacheBackend(path).get("key")
+
+    # The default directory is created private to the user, and refused once others can enter it
+    data_dir = str(tmp_path / "data")
+    monkeypatch.setattr(cache_backends_module, "DEFAULT_DATA_DIR", data_dir)
+    cache_backends_module.SqliteCacheBackend(os.path.join(data_dir, "cache.sqlite3")).clear()
+    assert os.stat(data_dir).st_mode & 0o777 == 0o700
+    os.chmod(data_dir, 0o755)
+    with pytest.raises(cache_backends_module.ConnectorError, match="not a directory private to its owner"):
+        cache_backends_module.SqliteCacheBackend(os.path.join(data_dir, "cache.sqlite3")).clear()
+
+
+
+def test_cache_backend_size_caps():
+    small = cache_backends_module.get_cache_backend({"cache_max_size": 1})
+    large = cache_backends_module.get_cache_backend({"cache_max_size": 64})
+    # Each config keeps the cap it asked for, whichever config asked for a backend last
+    assert small is not large and small is cache_backends_module.get_cache_backend({"cache_max_size": 1})
+    assert (small.max_bytes, large.max_bytes) == (1024 * 1024, 64 * 1024 * 1024)
+    assert cache_backends_module.get_cache_backend({}).max_bytes == cache_backends_module.DEFAULT_MAX_BYTES
+    with pytest.raises(TypeError):
+        cache_backends_module.CacheBackend()
+
+def test_single_flight_directory_permissions(tmp_path):
+    flight = single_flight_module.SingleFlight()
+    directory = tmp_path / "coalesce"
+    assert flight.do("key", lambda: {"status": 0}, str(directory)) == ({"status": 0}, False)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    assert {os.stat(entry).st_mode & 0o777 for entry in directory.iterdir()} == {0o600}
+
+    # A planted result file other users can write is refused rather than returned
+    result_path = next(directory.glob("*.json"))
+    os.chmod(result_path, 0o666)
+    with pytest.raises(cache_backends_module.ConnectorError, match="writable by its group or others"):
+        flight.do("key", lambda: {"status": 0}, str(directory))
+
+    # So is a directory shared with other users
+    shared = tmp_path / "shared"
+    shared.mkdir(mode=0o777)
+    os.chmod(shared, 0o777)
+    with pytest.raises(cache_backends_module.ConnectorError, match="not a directory private to its owner"):
+        flight.do("key", lambda: {"status": 0}, str(shared))
+
+
+def test_simulator_group_commit(simulator):
+    config = simulator.config(group_commit_window=300)
+    operations['json_rpc_add'](config, {"url": ADDRESS_URL, "data": [{"name": "host-10.0.5.0",
+                                                                      "subnet": ["10.0.5.0", "255.255.255.255"]}]})
+    commits = simulator.stats.get("commits", 0)
+    barrier = threading.Barrier(8)
+
+    def add(i):
+        barrier.wait()
+        return operations['json_rpc_add'](config, {"url": ADDRESS_URL, "data": [
+            {"name": f"host-10.0.5.{i}", "subnet": [f"10.0.5.{i}", "255.255.255.255"]}]})
+
+    with ThreadPoolExecutor(8) as executor:
+        responses = list(executor.map(add, range(8)))
+    # Every writer gets its own result, including the one adding an object that already exists
+    assert responses[0]["status"] != 0
+    assert [response["add_response"] for response in responses[1:]] == [{"name": f"host-10.0.5.{i}"}
+                                                                        for i in range(1, 8)]
+    assert all(response["status"] == 0 for response in responses[1:])
+    groups = sum(1 / response["group_commit"]["size"] for response in responses)
+    assert round(groups) < 8 and simulator.stats["commits"] - commits == round(groups)
+
+    response = operations['json_rpc_get'](config, {"url": ADDRESS_URL})
+    assert len(response["get_response"]) == 8
+
+    # Writes in a transaction are never grouped
+    handle = operations['json_rpc_begin_transaction'](config, {"adoms": "root"})["transaction_id"]
+    response = operations['json_rpc_delete'](config, {"url": f"{ADDRESS_URL}/host-10.0.5.1",
+                                                      "transaction_id": handle})
+    assert "group_commit" not in response
+    operations['json_rpc_end_transaction'](config, {"transaction_id": handle})
+
+
+def test_simulator_async_sessions_closed_with_loop(simulator):
+    config = simulator.config()
+
+    async def run(i):
+        add = async_operations['json_rpc_add'](config, {"url": ADDRESS_URL, "data": [
+            {"name": f"host-10.0.7.{i}", "subnet": [f"10.0.7.{i}", "255.255.255.255"]}]})
+        get = async_operations['json_rpc_get'](config, {"url": ADDRESS_URL})
+        return await asyncio.gather(add, get)
+
+    logins = simulator.stats.get("logins", 0)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        for i in range(4):
+            responses = asyncio.run(run(i))
+            assert all(response["status"] == 0 for response in responses)
+        gc.collect()
+    # Every loop logged in and out again, and left nothing in the pool
+    assert simulator.stats["logins"] > logins
+    assert not simulator.sessions and len(async_session_pool) == 0
+    assert not [warning for warning in caught if "Unclosed" in str(warning.message)]
+
+
+def test_simulator_async_write_invalidates_cache(simulator):
+    config = simulator.config(cache_enabled=True)
+    response = operations['json_rpc_get'](config, {"url": ADDRESS_URL})
+    assert not response.get("cached") and operations['json_rpc_get'](config, {"url": ADDRESS_URL})["cached"] is True
+    add = async_operations['json_rpc_add'](config, {"url": ADDRESS_URL, "data": [{"name": "host-10.0.8.1"}]})
+    assert asyncio.run(add)["status"] == 0
+    # The async add dropped the cached list, so the next sync get reads the new object from the server
+    response = operations['json_rpc_get'](config, {"url": ADDRESS_URL})
+    assert not response.get("cached")
+    assert "host-10.0.8.1" in [obj["name"] for obj in response["get_response"]]
+    # Transactions only exist on the sync path, an async call inside one is refused rather than run outside it
+    with pytest.raises(Exception, match="not supported by the asyncio operations"):
+        asyncio.run(async_operations['json_rpc_set'](config, {"url": ADDRESS_URL, "transaction_id": "txn",
+                                                              "data": [{"name": "host-10.0.8.1"}]}))
+
+
+def test_simulator_transaction_locks_and_expiry(simulator):
+    config = simulator.config(lock_timeout=10)
+    customer_url = ADDRESS_URL.replace("/adom/root/", "/adom/customer-a/")
+    first = operations['json_rpc_begin_transaction'](config, {"adoms": "root, customer-a"})["transaction_id"]
+
+    # A transaction listing the same ADOMs in the other order waits for the first one instead of deadlocking
+    with ThreadPoolExecutor(1) as executor:
+        second = executor.submit(operations['json_rpc_begin_transaction'], config, {"adoms": ["customer-a", "root"]})
+        for url in (customer_url, ADDRESS_URL):
+            response = operations['json_rpc_add'](config, {"url": url, "transaction_id": first, "data": [
+                {"name": "host-10.0.8.1", "subnet": ["10.0.8.1", "255.255.255.255"]}]})
+            assert response["status"] == 0
+        assert not second.done()
+        assert operations['json_rpc_end_transaction'](config, {"transaction_id": first})["status"] == 0
+        second = second.result(timeout=10)["transaction_id"]
+
+    # Only the ADOMs listed at begin can be written to
+    transaction = transaction_manager.get(second)
+    with pytest.raises(Exception, match="was not locked"):
+        operations['json_rpc_delete'](config, {"url": f"{ADDRESS_URL}/host-10.0.8.1".replace("/root/", "/global/"),
+                                               "transaction_id": second})
+
+    # An expired session aborts the transaction instead of writing without its locks
+    simulator.logout(transaction.fmg.sid)
+    with pytest.raises(Exception, match="aborted"):
+        operations['json_rpc_delete'](config, {"url": f"{ADDRESS_URL}/host-10.0.8.1", "transaction_id": second})
+    with pytest.raises(Exception, match="No open transaction"):
+        operations['json_rpc_end_transaction'](config, {"transaction_id": second})
+    response = operations['json_rpc_delete'](config, {"url": f"{ADDRESS_URL}/host-10.0.8.1"})
+    assert response["status"] == 0